@@ -0,0 +1,119 @@
+import unittest.main
+from unittest.mock import Mock
+from unittest.mock import patch
+from unittest import TestCase
+
+import os
+import sys
+import json
+
+GOOGLE_MOCK = Mock()
+sys.modules['google.cloud'] = GOOGLE_MOCK
+OAUTH_MOCK = Mock()
+sys.modules['google.oauth2'] = OAUTH_MOCK
+
+import main
+
+STOCLIENT_MOCK = Mock()
+SESSION_MOCK = Mock()
+MAPPING_MOCK = Mock()
+
+
+@patch.dict(os.environ, {
+    "PROJECT_ID":"id",
+    "IMAGE_BUCKET":"images",
+    "DATABASE_URL":"https://database"})
+@patch('main.STORAGE_CLIENT', STOCLIENT_MOCK)
+@patch('main.DATABASE_SESSION', SESSION_MOCK)
+@patch('main.MAPPING_STORE', MAPPING_MOCK)
+@patch('main.SIGNING_CREDENTIALS', None)
+class TestDatabaseUpload(TestCase):
+
+    def setUp(self, *args):
+        STOCLIENT_MOCK.reset_mock()
+        SESSION_MOCK.reset_mock()
+        MAPPING_MOCK.reset_mock()
+        OAUTH_MOCK.reset_mock()
+        main.SIGNED_URLS.clear()
+        # sanitised data, and a new signed URL each time one is generated
+        STOCLIENT_MOCK.bucket.return_value.blob.return_value.download_as_bytes.return_value = json.dumps(
+            {"extractedFields": ["total weight"]}).encode("utf-8")
+        self.signed = 0
+        def sign(**kwargs):
+            self.signed += 1
+            return f"https://signed/{self.signed}"
+        STOCLIENT_MOCK.bucket.return_value.blob.return_value.generate_signed_url.side_effect = sign
+        MAPPING_MOCK.image_name.return_value = "abc.png"
+
+        self.file = {"name": "abc.json", "bucket": "gpr_sanitised_data", "metadata": {"image": "abc.jpg"}}
+
+
+    def posted(self):
+        return SESSION_MOCK.post.call_args.kwargs["json"]
+
+
+    def test_successCase(self, *args):
+        main.database_upload(self.file, None)
+        self.assertEqual(self.posted(), {"extractedFields": ["total weight"], "image_url": "https://signed/1"})
+        self.assertEqual(SESSION_MOCK.post.call_args.kwargs["url"], "https://database/newTicket")
+        # the image named in the metadata is signed without looking it up
+        STOCLIENT_MOCK.bucket.return_value.blob.assert_called_with("abc.jpg")
+        MAPPING_MOCK.image_name.assert_not_called()
+        STOCLIENT_MOCK.list_blobs.assert_not_called()
+
+
+    def test_edgeCase_imageLookedUp(self, *args):
+        del self.file["metadata"]
+        main.database_upload(self.file, None)
+        MAPPING_MOCK.image_name.assert_called_once_with("abc")
+        STOCLIENT_MOCK.bucket.return_value.blob.assert_called_with("abc.png")
+        STOCLIENT_MOCK.list_blobs.assert_not_called()
+
+        # images stored before the mapping store are found by listing
+        MAPPING_MOCK.image_name.return_value = None
+        STOCLIENT_MOCK.list_blobs.return_value = [Mock()]
+        STOCLIENT_MOCK.list_blobs.return_value[0].name = "abc.jpeg"
+        main.database_upload(self.file, None)
+        STOCLIENT_MOCK.list_blobs.assert_called_once_with("images", prefix="abc")
+        STOCLIENT_MOCK.bucket.return_value.blob.assert_called_with("abc.jpeg")
+
+
+    @patch("time.time")
+    def test_edgeCase_signedUrlCache(self, time_mock, *args):
+        time_mock.return_value = 1000.0
+        main.database_upload(self.file, None)
+        time_mock.return_value = 1000.0 + 24 * 60
+        main.database_upload(self.file, None)
+        self.assertEqual(self.posted()["image_url"], "https://signed/1")
+        self.assertEqual(self.signed, 1)
+
+        # within URL_REFRESH_MINUTES of expiring, the URL is signed again
+        time_mock.return_value = 1000.0 + 26 * 60
+        main.database_upload(self.file, None)
+        self.assertEqual(self.posted()["image_url"], "https://signed/2")
+        self.file["metadata"]["image"] = "def.jpg"
+        main.database_upload(self.file, None)
+        self.assertEqual(self.posted()["image_url"], "https://signed/3")
+
+        # the credentials are read from disk once
+        OAUTH_MOCK.service_account.Credentials.from_service_account_file.assert_called_once_with("auxiliary.json")
+
+
+    def test_failureCase_imageNotFound(self, *args):
+        del self.file["metadata"]
+        MAPPING_MOCK.image_name.return_value = None
+        for blobs in [[], [Mock(), Mock()]]:
+            STOCLIENT_MOCK.list_blobs.return_value = blobs
+            with self.subTest(test_data=len(blobs)):
+                self.assertRaises(FileNotFoundError, main.database_upload, self.file, None)
+        SESSION_MOCK.post.assert_not_called()
+
+
+    def test_failureCase_malformedFileInformation(self, *args):
+        for test in [{"bucket": "b"}, {"name": "n"}]:
+            with self.subTest(test_data=test):
+                self.assertRaises(ValueError, main.database_upload, test, None)
+
+
+if __name__ == "__main__":
+    unittest.main()
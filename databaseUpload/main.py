@@ -1,13 +1,56 @@
 import os
 import json
-import requests
 import datetime
-
-from google.cloud import storage
-from google.oauth2 import service_account
-import gcsfs
-
-STORAGE_CLIENT = storage.Client()
+import threading
+import time
+
+from mapping_store import mapping_store_from_env
+
+STORAGE_CLIENT = None
+MAPPING_STORE = None
+MAPPING_STORE_LOCK = threading.Lock()
+# the URL signing credentials, read from auxiliary.json once per instance
+SIGNING_CREDENTIALS = None
+SIGNING_CREDENTIALS_LOCK = threading.Lock()
+# (bucket, image name) -> (signed URL, time it expires), reused until URL_REFRESH_MINUTES before it expires
+SIGNED_URLS = {}
+SIGNED_URLS_LOCK = threading.Lock()
+# one HTTP session, so the connection to the database is kept alive between uploads
+DATABASE_SESSION = None
+
+
+def get_storage_client():
+    global STORAGE_CLIENT
+    if STORAGE_CLIENT is None:
+        from google.cloud import storage
+        STORAGE_CLIENT = storage.Client()
+    return STORAGE_CLIENT
+
+
+def get_signing_credentials():
+    global SIGNING_CREDENTIALS
+    with SIGNING_CREDENTIALS_LOCK:
+        if SIGNING_CREDENTIALS is None:
+            from google.oauth2 import service_account
+            SIGNING_CREDENTIALS = service_account.Credentials.from_service_account_file('auxiliary.json')
+    return SIGNING_CREDENTIALS
+
+
+def get_database_session():
+    global DATABASE_SESSION
+    if DATABASE_SESSION is None:
+        import requests
+        DATABASE_SESSION = requests.Session()
+    return DATABASE_SESSION
+
+
+def get_mapping_store():
+    # one store per instance, so its cache of mappings outlives the request
+    global MAPPING_STORE
+    with MAPPING_STORE_LOCK:
+        if MAPPING_STORE is None:
+            MAPPING_STORE = mapping_store_from_env(get_storage_client())
+    return MAPPING_STORE
 
 
 def validate_message(file, field):
@@ -24,19 +67,18 @@ def read_file(
         project_id: str, 
         bucket: str
     ):
-    fs = gcsfs.GCSFileSystem(project=project_id)
-
-    with fs.open(f"{bucket}/{filename}") as f:
-        data = json.load(f)
-    
-    return data
+    return json.loads(get_storage_client().bucket(bucket).blob(filename).download_as_bytes())
 
 
 def get_image_file(filename: str, project_id: str, image_bucket:str):
-    fs = gcsfs.GCSFileSystem(project=project_id)
+    # the mapping store knows the extension of every image receiveImage has stored
+    image_name = get_mapping_store().image_name(filename)
+    if image_name is not None:
+        return image_name
 
-    # gather all image files with correct prefix; images could be jpeg, jpg, or png
-    blobs = list(STORAGE_CLIENT.list_blobs(image_bucket, prefix=filename))
+    # images stored before the mapping store: gather all image files with correct prefix; images could be jpeg, jpg,
+    # or png
+    blobs = list(get_storage_client().list_blobs(image_bucket, prefix=filename))
 
     # check that only one matching image is found
     if len(blobs) < 1:
@@ -53,16 +95,30 @@ def get_image_file(filename: str, project_id: str, image_bucket:str):
 
 
 def generate_URL(filename:str, image_bucket:str):
-    bucket = STORAGE_CLIENT.bucket(image_bucket)
+    expiration = datetime.timedelta(minutes=int(os.environ.get("URL_EXPIRATION_MINUTES", "30")))
+    refresh = datetime.timedelta(minutes=int(os.environ.get("URL_REFRESH_MINUTES", "5"))).total_seconds()
+    key = (image_bucket, filename)
+    with SIGNED_URLS_LOCK:
+        cached = SIGNED_URLS.get(key)
+    if cached is not None and cached[1] - time.time() > refresh:
+        return cached[0]
+
+    bucket = get_storage_client().bucket(image_bucket)
     blob = bucket.blob(filename)
 
+    expires_at = time.time() + expiration.total_seconds()
     url = blob.generate_signed_url(
         version="v4",
-        expiration=datetime.timedelta(minutes=30),
+        expiration=expiration,
         method="GET",
-        credentials=service_account.Credentials.from_service_account_file('auxiliary.json'),
+        credentials=get_signing_credentials(),
         service_account_email='url-signing@ib-group-project-romeo.iam.gserviceaccount.com'
     )
+    with SIGNED_URLS_LOCK:
+        # expired URLs are dropped as new ones are signed
+        for other in [k for k, (_, other_expires_at) in SIGNED_URLS.items() if other_expires_at <= time.time()]:
+            del SIGNED_URLS[other]
+        SIGNED_URLS[key] = (url, expires_at)
 
     return url
 
@@ -84,11 +140,13 @@ def database_upload(file, context):
     # read in data to upload
     data = read_file(filename, project_id, bucket)
 
-    # find the corresponding image file
-    file_prefix = filename.split(".")[0]
-    image_name = get_image_file(file_prefix, project_id, image_bucket)
+    # find the corresponding image file: processExtractedData records it in the metadata of the data
+    image_name = (file.get("metadata") or {}).get("image")
+    if image_name is None:
+        file_prefix = filename.split(".")[0]
+        image_name = get_image_file(file_prefix, project_id, image_bucket)
     image_url = generate_URL(image_name, image_bucket)
 
     data['image_url'] = image_url
 
-    requests.post(url=f"{os.environ['DATABASE_URL']}/newTicket", json=data)
\ No newline at end of file
+    get_database_session().post(url=f"{os.environ['DATABASE_URL']}/newTicket", json=data)
\ No newline at end of file
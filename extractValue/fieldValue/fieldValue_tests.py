@@ -0,0 +1,124 @@
+import unittest.main
+from unittest.mock import Mock
+from unittest.mock import patch
+from unittest import TestCase
+
+import json
+import os
+import sys
+import tempfile
+
+# mock all google cloud modules
+sys.modules['google.cloud'] = Mock()
+
+import main
+import publisher
+
+
+# records every call while delivering through the local publisher, so results are tracked as in production
+PUBSUB_MOCK = Mock(wraps=publisher.LocalPublisherClient())
+
+# mock environment variables
+@patch.dict(os.environ, {"PROJECT_ID":'id'})
+@patch('main.PUB_CLIENT', PUBSUB_MOCK)
+@patch('main.PUBLISHER', None)
+class TestFieldValueExtraction(TestCase):
+
+    def setUp(self, *args):
+        # default request contains valid fields
+        self.request = Mock(json={"valueString":"263 3466 02", "topic":"t"}, path="/vatNumber")
+
+
+    def test_successCase(self, *args):
+        main.extract_field_value(self.request)
+        message = json.loads(PUBSUB_MOCK.publish.call_args.args[1])
+
+        self.assertTrue(message['success'])
+        self.assertIsNone(message['error'])
+        self.assertEqual(message["value"], "263346602")
+        self.assertEqual(message["checks"], {"lengthCheck": True})
+
+
+    def test_edgeCase_fieldTypes(self, *args):
+        # (field type, value string, value, checks), from the values in processExtractedData/sample_input.csv
+        testCases = [
+            ("weight", "1964.688Kgs", "1964.688", {"decimalPlaceCheck": True, "rangeCheck": True}),
+            ("weight", ": 12,345.53", "12345.53", {"decimalPlaceCheck": False, "rangeCheck": True}),
+            ("volume", "3.274M3", "3.274", {"rangeCheck": True}),
+            ("vatNumber", "GB 263 3466 02", "263346602", {"lengthCheck": True}),
+            ("vatNumber", "GB123456789012", "123456789012", {"lengthCheck": True}),
+            ("vatNumber", "123-456-789-012", "123456789012", {"lengthCheck": True}),
+            ("date", "20/02/2020 @ 09:10:56", "20/02/2020", {"dateFormatCheck": True}),
+            ("date", "31/02/2020", "31/02/2020", {"dateFormatCheck": False}),
+            ("orderNumber", "5528856/0", "5528856/0", {"lengthCheck": True})]
+
+        for field_type, value_string, value, checks in testCases:
+            with self.subTest(test_data=(field_type, value_string)):
+                result = main.extract_field_value_from_string(value_string, field_type)
+                self.assertEqual(result["value"], value)
+                self.assertEqual(result["checks"], checks)
+
+
+    def test_edgeCase_fieldTypeInPayload(self, *args):
+        self.request.json = {"valueString":"3.274M3", "topic":"t", "fieldType":"volume", "correlationId":"c",
+                             "instanceId":"i"}
+        main.extract_field_value(self.request)
+        message = json.loads(PUBSUB_MOCK.publish.call_args.args[1])
+        self.assertEqual(message["value"], "3.274")
+        self.assertEqual(message["correlationId"], "c")
+        # the reply is routed to the requesting instance's subscription by this attribute
+        self.assertEqual(PUBSUB_MOCK.publish.call_args.kwargs["instanceId"], "i")
+
+
+    def test_edgeCase_specsCompiledOnce(self, *args):
+        specs = {"ticketNumber": {"normalise": [{"step": "upper"}], "pattern": "T\\d{4}",
+                                  "checks": [{"name": "lengthCheck", "check": "length", "min": 5, "max": 5}]}}
+        with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as f:
+            json.dump(specs, f)
+        try:
+            with patch.dict(os.environ, {"FIELD_SPECS": f.name}), patch('re.compile', wraps=main.re.compile) as compile_mock:
+                for _ in range(3):
+                    result = main.extract_field_value_from_string("ticket t1234", "ticketNumber")
+                self.assertEqual(compile_mock.call_count, 1)
+        finally:
+            os.remove(f.name)
+        self.assertEqual(result["value"], "T1234")
+        self.assertTrue(result["checks"]["lengthCheck"])
+
+
+    def test_failureCase_noAppropriateValue(self, *args):
+        self.request.json["valueString"] = "VAT No"
+        main.extract_field_value(self.request)
+        message = json.loads(PUBSUB_MOCK.publish.call_args.args[1])
+        self.assertFalse(message['success'])
+        self.assertEqual(message['error']['description'], "Matched field value does not match the vatNumber pattern")
+
+
+    def test_failureCase_invalidSpec(self, *args):
+        testCases = [
+            {"pattern": "("},
+            {"normalise": [{"step": "reverse"}], "pattern": "\\d+"},
+            {"pattern": "\\d+", "checks": [{"name": "c", "check": "range", "minimum": 1}]},
+            {"checks": []}]
+
+        for test in testCases:
+            with self.subTest(test_data=test):
+                self.assertRaises(main.SpecException, main.CompiledSpec, "t", test)
+
+
+    def test_failureCase_malformedRequest(self, *args):
+        testCases = [
+            ({"topic":"t"}, "/vatNumber"),
+            ({"valueString":"263 3466 02"}, "/vatNumber"),
+            ({"topic":"t", "valueString":"263 3466 02"}, "/"),
+            ({"topic":"t", "valueString":"263 3466 02"}, "/registrationNumber")]
+
+        for payload, path in testCases:
+            self.request.json = payload
+            self.request.path = path
+            with self.subTest(test_data=(payload, path)):
+                self.assertRaises(ValueError, main.extract_field_value, self.request)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,197 @@
+import datetime
+import json
+import os
+import re
+
+from publisher import TrackedPublisher, batch_settings
+
+
+PUB_CLIENT = None
+PUBLISHER = None
+
+
+def get_publisher_client():
+    global PUB_CLIENT
+    if PUB_CLIENT is None:
+        from google.cloud import pubsub_v1
+        PUB_CLIENT = pubsub_v1.PublisherClient(batch_settings(
+            max_messages=int(os.environ.get("PUBLISH_MAX_MESSAGES", "100")),
+            max_bytes=int(os.environ.get("PUBLISH_MAX_BYTES", "1000000")),
+            max_latency=float(os.environ.get("PUBLISH_MAX_LATENCY", "0.01"))))
+    return PUB_CLIENT
+
+
+def get_publisher() -> TrackedPublisher:
+    global PUBLISHER
+    if PUBLISHER is None:
+        PUBLISHER = TrackedPublisher(get_publisher_client(), int(os.environ.get("PUBLISH_STATS_WINDOW", "1000")))
+    return PUBLISHER
+
+
+class ValueNotMatchedException(Exception):
+    pass
+
+
+class SpecException(Exception):
+    pass
+
+
+# normalisation step -> factory from the step's parameters to a function of the value string
+NORMALISE_STEPS = {
+    "remove": lambda chars: (lambda value: value.translate(str.maketrans("", "", chars))),
+    "replace": lambda old, new: (lambda value: value.replace(old, new)),
+    "upper": lambda: str.upper,
+    "lower": lambda: str.lower,
+    "strip": lambda: str.strip,
+}
+
+
+def decimal_places_check(places: int):
+    def check(value: str) -> bool:
+        ind_of_dec = value.find(".")
+        return ind_of_dec == -1 or ind_of_dec == len(value) - 1 or len(value[ind_of_dec + 1:]) == places
+    return check
+
+
+def range_check(min: float = float("-inf"), max: float = float("inf")):
+    return lambda value: min <= float(value) <= max
+
+
+def length_check(min: int = 0, max: int = None):
+    return lambda value: min <= len(value) and (max is None or len(value) <= max)
+
+
+def date_format_check(formats: list):
+    def check(value: str) -> bool:
+        for date_format in formats:
+            try:
+                datetime.datetime.strptime(value, date_format)
+                return True
+            except ValueError:
+                pass
+        return False
+    return check
+
+
+# check -> factory from the check's parameters to a function of the matched value
+CHECKS = {
+    "decimalPlaces": decimal_places_check,
+    "range": range_check,
+    "length": length_check,
+    "dateFormat": date_format_check,
+}
+
+
+class CompiledSpec:
+    """
+    A field type's spec, compiled once: the normalisation steps as one function, the pattern as a compiled regex, and
+    each check as a function of the matched value. The value is the pattern's `value` group if it has one, otherwise
+    the whole match.
+    """
+    def __init__(self, field_type: str, spec: dict):
+        self.field_type = field_type
+        try:
+            self.steps = [NORMALISE_STEPS[step["step"]](**{k: v for k, v in step.items() if k != "step"})
+                          for step in spec.get("normalise", [])]
+            self.pattern = re.compile(spec["pattern"])
+            self.checks = [(check["name"], CHECKS[check["check"]](**{k: v for k, v in check.items()
+                                                                    if k not in ("name", "check")}))
+                           for check in spec.get("checks", [])]
+        except (KeyError, TypeError, re.error) as e:
+            raise SpecException(f"Invalid spec for field type {field_type}: {e!r}")
+        self.group = "value" if "value" in self.pattern.groupindex else 0
+
+    def extract(self, value_string: str) -> str:
+        for step in self.steps:
+            value_string = step(value_string)
+        z = self.pattern.search(value_string)
+        if z:
+            return z.group(self.group)
+        else:
+            raise ValueNotMatchedException
+
+    def run_checks(self, value: str) -> dict:
+        return {name: bool(check(value)) for name, check in self.checks}
+
+
+# specs path -> field type -> CompiledSpec, compiled once per process
+COMPILED_SPECS = {}
+
+
+def get_compiled_specs() -> dict:
+    specs_path = os.environ.get("FIELD_SPECS", os.path.join(os.path.dirname(os.path.abspath(__file__)), "specs.json"))
+    if specs_path not in COMPILED_SPECS:
+        with open(specs_path) as f:
+            specs = json.load(f)
+        COMPILED_SPECS[specs_path] = {field_type: CompiledSpec(field_type, spec) for field_type, spec in specs.items()}
+    return COMPILED_SPECS[specs_path]
+
+
+def get_compiled_spec(field_type: str) -> CompiledSpec:
+    specs = get_compiled_specs()
+    if field_type not in specs:
+        raise ValueError(f"No spec for field type {field_type}. Known field types: {', '.join(sorted(specs))}")
+    return specs[field_type]
+
+
+def reply_attributes(payload: dict) -> dict:
+    """The attributes of a reply: the instanceId of the requesting instance, whose subscription filters on it."""
+    return {"instanceId": payload["instanceId"]} if "instanceId" in payload else {}
+
+
+def validate_payload(message, param):
+    var = message.get(param)
+    if not var:
+        raise ValueError(
+            "{} is not provided. Make sure you have \
+                          property {} in the request".format(
+                param, param
+            )
+        )
+    return var
+
+
+def extract_field_value_from_string(value_string, field_type):
+    """
+    The result for a matched field value of type field_type, in the format specified by databaseUpload.
+    Also callable in-process, by processExtractedData, when this module is deployed alongside it.
+    """
+    spec = get_compiled_spec(field_type)
+    try:
+        value = spec.extract(value_string)
+        return {"success": True,
+                "error": None,
+                "value": value,
+                "checks": spec.run_checks(value)}
+    except ValueNotMatchedException:
+        return {"success": False,
+                "error": {"type": "field value", "description": f"Matched field value does not match the {field_type} pattern"},
+                "value": None,
+                "checks": None}
+
+
+def extract_field_value(request):
+    """
+    The generic extractor entry point. The field type is the `fieldType` of the payload, or else the last segment of
+    the request path, so that the function name `fieldValue/vatNumber` given to processExtractedData calls this
+    function with the vatNumber spec.
+    """
+    payload = request.json
+    value_string = validate_payload(payload, "valueString")
+    topic_id = validate_payload(payload, "topic")
+    field_type = payload.get("fieldType") or request.path.strip("/").split("/")[-1]
+    if not field_type:
+        raise ValueError("fieldType is not provided. Make sure you call fieldValue/[fieldType] or have property "
+                         "fieldType in the request")
+    to_publish = extract_field_value_from_string(value_string, field_type)
+
+    # replies to a shared result topic are routed back to the waiting request by correlation ID
+    for key in ["correlationId", "expiresAt"]:
+        if key in payload:
+            to_publish[key] = payload[key]
+
+    project_id = os.environ["PROJECT_ID"]
+    topic_path = get_publisher().topic_path(project_id, topic_id)
+    message = json.dumps(to_publish).encode('utf-8')
+    future = get_publisher().publish(topic_path, message, **reply_attributes(payload))
+    get_publisher().flush([future], timeout=float(os.environ.get("PUBLISH_TIMEOUT", "30")))
@@ -1,18 +1,242 @@
+import io
+import logging
 import numpy as np
-import pandas as pd
 import os
 import re
 import json
-from google.cloud import pubsub_v1
+import threading
+import time
 
+from publisher import TrackedPublisher, batch_settings
+from sketch import KLLSketch
 
-PUB_CLIENT = pubsub_v1.PublisherClient()
+
+PUB_CLIENT = None
+PUBLISHER = None
+STORAGE_CLIENT = None
+
+
+def get_publisher_client():
+    global PUB_CLIENT
+    if PUB_CLIENT is None:
+        from google.cloud import pubsub_v1
+        PUB_CLIENT = pubsub_v1.PublisherClient(batch_settings(
+            max_messages=int(os.environ.get("PUBLISH_MAX_MESSAGES", "100")),
+            max_bytes=int(os.environ.get("PUBLISH_MAX_BYTES", "1000000")),
+            max_latency=float(os.environ.get("PUBLISH_MAX_LATENCY", "0.01"))))
+    return PUB_CLIENT
+
+
+def get_publisher() -> TrackedPublisher:
+    global PUBLISHER
+    if PUBLISHER is None:
+        PUBLISHER = TrackedPublisher(get_publisher_client(), int(os.environ.get("PUBLISH_STATS_WINDOW", "1000")))
+    return PUBLISHER
+
+
+def get_storage_client():
+    global STORAGE_CLIENT
+    if STORAGE_CLIENT is None:
+        from google.cloud import storage
+        STORAGE_CLIENT = storage.Client()
+    return STORAGE_CLIENT
 
 
 class ValueNotMatchedException(Exception):
     pass
 
 
+class WeightsIndex:
+    """
+    The weights history as a sorted array, so the fraction of weights at or beyond a value is a binary search.
+    Tagged with the object generation and ETag it was loaded from.
+    """
+    def __init__(self, weights, database: str, version: tuple):
+        self.weights = np.sort(np.asarray(weights, dtype=float))
+        self.database = database
+        self.version = version
+
+    def tail_probability(self, value: float) -> float:
+        """
+        min(Pr(W <= value), Pr(W >= value)) under the empirical distribution of the weights. value may also be an
+        array of values.
+        """
+        n = len(self.weights)
+        at_most = np.searchsorted(self.weights, value, side="right") / n
+        at_least = (n - np.searchsorted(self.weights, value, side="left")) / n
+        return np.minimum(at_most, at_least)
+
+
+WEIGHTS_INDEX = None
+
+
+def get_weights_index() -> WeightsIndex:
+    """
+    The index of WEIGHTS_DATABASE, loaded once per instance. Each call only fetches the object's metadata, and the
+    weights are downloaded again only if its generation or ETag has changed.
+    """
+    global WEIGHTS_INDEX
+    import pandas as pd
+
+    weights_database = os.environ["WEIGHTS_DATABASE"]
+    bucket_name, blob_name = weights_database.split("/", 1)
+    blob = get_storage_client().bucket(bucket_name).get_blob(blob_name)
+    version = (blob.generation, blob.etag)
+    if WEIGHTS_INDEX is None or WEIGHTS_INDEX.database != weights_database or WEIGHTS_INDEX.version != version:
+        weights = pd.read_csv(io.BytesIO(blob.download_as_bytes(if_generation_match=blob.generation)))
+        WEIGHTS_INDEX = WeightsIndex(weights["Weight"].dropna(), weights_database, version)
+    return WEIGHTS_INDEX
+
+
+class WeightsSketch:
+    """A KLLSketch of the weights history, tagged like WeightsIndex with the object it was loaded from."""
+    def __init__(self, sketch: KLLSketch, database: str, version: tuple):
+        self.sketch = sketch
+        self.database = database
+        self.version = version
+
+    def tail_probability(self, value: float) -> float:
+        return self.sketch.tail_probability(value)
+
+
+WEIGHTS_SKETCH = None
+# accepted weights not yet merged into the stored sketch, and when they were last merged
+PENDING_WEIGHTS = KLLSketch()
+PENDING_WEIGHTS_LOCK = threading.Lock()
+LAST_WEIGHTS_FLUSH = time.time()
+
+
+def build_weights_sketch(weights_sketch: str) -> WeightsSketch:
+    """
+    The sketch of WEIGHTS_DATABASE, built once per version of the CSV and uploaded to WEIGHTS_SKETCH unless another
+    instance got there first, so later calls, here and on every other instance, load it instead.
+    """
+    from google.api_core.exceptions import PreconditionFailed
+
+    index = get_weights_index()
+    version = ("built", index.database, index.version)
+    if WEIGHTS_SKETCH is not None and WEIGHTS_SKETCH.database == weights_sketch and WEIGHTS_SKETCH.version == version:
+        return WEIGHTS_SKETCH
+    sketch = KLLSketch()
+    sketch.extend(index.weights)
+    bucket_name, blob_name = weights_sketch.split("/", 1)
+    blob = get_storage_client().bucket(bucket_name).blob(blob_name)
+    try:
+        blob.upload_from_string(sketch.to_json(), content_type="application/json", if_generation_match=0)
+        version = (blob.generation, blob.etag)
+    except PreconditionFailed:
+        # uploaded meanwhile by another instance, which the next call loads
+        pass
+    except Exception:
+        logging.exception("Could not upload the sketch built from %s to %s", index.database, weights_sketch)
+    return WeightsSketch(sketch, weights_sketch, version)
+
+
+def load_weights_sketch(blob) -> WeightsSketch:
+    """
+    The sketch at WEIGHTS_SKETCH, reusing the loaded one if the blob's generation and ETag are unchanged. If the
+    sketch does not exist yet, it is built from WEIGHTS_DATABASE.
+    """
+    global WEIGHTS_SKETCH
+    weights_sketch = os.environ["WEIGHTS_SKETCH"]
+    if blob is None:
+        WEIGHTS_SKETCH = build_weights_sketch(weights_sketch)
+        return WEIGHTS_SKETCH
+    version = (blob.generation, blob.etag)
+    if WEIGHTS_SKETCH is None or WEIGHTS_SKETCH.database != weights_sketch or WEIGHTS_SKETCH.version != version:
+        sketch = KLLSketch.from_json(blob.download_as_bytes(if_generation_match=blob.generation))
+        WEIGHTS_SKETCH = WeightsSketch(sketch, weights_sketch, version)
+    return WEIGHTS_SKETCH
+
+
+def get_weights_sketch_blob():
+    bucket_name, blob_name = os.environ["WEIGHTS_SKETCH"].split("/", 1)
+    bucket = get_storage_client().bucket(bucket_name)
+    return bucket, blob_name, bucket.get_blob(blob_name)
+
+
+def get_weights_distribution():
+    """The sketch at WEIGHTS_SKETCH if it is set, otherwise the sorted index of WEIGHTS_DATABASE."""
+    if not os.environ.get("WEIGHTS_SKETCH"):
+        return get_weights_index()
+    _, _, blob = get_weights_sketch_blob()
+    return load_weights_sketch(blob)
+
+
+def flush_weights_sketch() -> bool:
+    """
+    Merges the pending weights into the stored sketch. The write is conditional on the generation that was read, so
+    concurrent instances never overwrite each other's weights; on a conflict the sketch is read again and the merge
+    retried. Returns False, keeping the weights pending, if every attempt conflicted.
+    """
+    global WEIGHTS_SKETCH, PENDING_WEIGHTS, LAST_WEIGHTS_FLUSH
+    from google.api_core.exceptions import PreconditionFailed
+
+    with PENDING_WEIGHTS_LOCK:
+        LAST_WEIGHTS_FLUSH = time.time()
+        if PENDING_WEIGHTS.n == 0:
+            return True
+        for _ in range(int(os.environ.get("WEIGHTS_SKETCH_RETRIES", "5"))):
+            bucket, blob_name, blob = get_weights_sketch_blob()
+            merged = KLLSketch.from_json(load_weights_sketch(blob).sketch.to_json())
+            merged.merge(PENDING_WEIGHTS)
+            new_blob = bucket.blob(blob_name)
+            try:
+                new_blob.upload_from_string(merged.to_json(), content_type="application/json",
+                                            if_generation_match=0 if blob is None else blob.generation)
+            except PreconditionFailed:
+                continue
+            WEIGHTS_SKETCH = WeightsSketch(merged, os.environ["WEIGHTS_SKETCH"], (new_blob.generation, new_blob.etag))
+            PENDING_WEIGHTS = KLLSketch()
+            return True
+        return False
+
+
+def learning_enabled() -> bool:
+    """Whether accepted weights are added to the sketch: only with WEIGHTS_SKETCH set and WEIGHTS_SKETCH_LEARN=true."""
+    return bool(os.environ.get("WEIGHTS_SKETCH")) and os.environ.get("WEIGHTS_SKETCH_LEARN", "false").lower() == "true"
+
+
+def record_weights(values):
+    """
+    Adds accepted weights to the history. They are merged into the stored sketch once WEIGHTS_SKETCH_FLUSH_SIZE
+    (default 1000) are pending or WEIGHTS_SKETCH_FLUSH_SECONDS (default 300) have passed since the last merge, so the
+    sketch object is rewritten rarely whatever the request rate. A failed merge is logged, and the weights kept pending,
+    rather than failing the extraction.
+    """
+    with PENDING_WEIGHTS_LOCK:
+        PENDING_WEIGHTS.extend(values)
+        pending = PENDING_WEIGHTS.n
+        since_flush = time.time() - LAST_WEIGHTS_FLUSH
+    if pending >= int(os.environ.get("WEIGHTS_SKETCH_FLUSH_SIZE", "1000")) \
+            or since_flush >= float(os.environ.get("WEIGHTS_SKETCH_FLUSH_SECONDS", "300")):
+        flush_pending_weights()
+
+
+def flush_pending_weights():
+    """flush_weights_sketch, logging rather than raising any failure. Also called by batch workers as they exit."""
+    if not learning_enabled():
+        return
+    try:
+        flush_weights_sketch()
+    except Exception:
+        logging.exception("Could not merge %d pending weights into %s", PENDING_WEIGHTS.n, os.environ["WEIGHTS_SKETCH"])
+
+
+def learn_from_results(results: list):
+    """Records the weights of results that passed every check, if learning is enabled."""
+    if not learning_enabled():
+        return
+    accepted = [float(result["value"]) for result in results if result["success"] and all(result["checks"].values())]
+    if accepted:
+        record_weights(accepted)
+
+
+def reply_attributes(payload: dict) -> dict:
+    """The attributes of a reply: the instanceId of the requesting instance, whose subscription filters on it."""
+    return {"instanceId": payload["instanceId"]} if "instanceId" in payload else {}
+
+
 def validate_payload(message, param):
     var = message.get(param)
     if not var:
@@ -25,10 +249,13 @@ def validate_payload(message, param):
     return var
 
 
+VALUE_PATTERN = re.compile(r"\d+\.?\d*")
+
+
 def extract_value_from_string(value_str):
     value_str = value_str.replace(',', '')
     value_str = value_str.replace(' ', '')
-    z = re.search(r"\d+\.?\d*", value_str)
+    z = VALUE_PATTERN.search(value_str)
 
     # TODO: Compute likelihood for z, need more data from QualisFlow
 
@@ -38,15 +265,21 @@ def extract_value_from_string(value_str):
         raise ValueNotMatchedException
 
 
+def extract_values_from_strings(value_strings) -> list:
+    """extract_value_from_string over many strings in one pass, with None where a string contains no number."""
+    import pandas as pd
+
+    cleaned = pd.Series(value_strings, dtype=object).str.replace(",", "", regex=False).str.replace(" ", "", regex=False)
+    values = cleaned.str.extract(f"({VALUE_PATTERN.pattern})", expand=False)
+    return [None if pd.isna(value) else value for value in values]
+
+
 def run_heuristic_checks(value):
-    weights_database = os.environ["WEIGHTS_DATABASE"]
     checks = {}
 
     # CHECK 1: Extreme Value Check
-    weights = pd.read_csv("gs://"+weights_database)
-    w = weights["Weight"]
     value_float = float(value)
-    p = min(np.mean(w <= value_float), np.mean(w >= value_float))
+    p = get_weights_distribution().tail_probability(value_float)
     if p < 0.05:
         checks["extremeValueCheck"] = False
     else:
@@ -65,26 +298,108 @@ def run_heuristic_checks(value):
     return checks
 
 
-def extract_total_weight(request):
-    payload = request.json
-    value_string = validate_payload(payload, "valueString")
-    topic_id = validate_payload(payload, "topic")
-    to_publish = {}
+def run_heuristic_checks_batch(values: list) -> list:
+    """run_heuristic_checks over many values, checking them all against the weights history at once."""
+    import pandas as pd
+
+    values = pd.Series(values, dtype=object)
+    extreme_value_checks = get_weights_distribution().tail_probability(values.astype(float).to_numpy()) >= 0.05
+    decimals = values.str.partition(".")[2].str.len()
+    decimal_place_checks = ~(values.str.contains(".", regex=False) & (decimals != 0) & (decimals != 3))
+    return [{"extremeValueCheck": bool(extreme), "decimalPlaceCheck": bool(decimal)}
+            for extreme, decimal in zip(extreme_value_checks, decimal_place_checks)]
+
+
+def extract_total_weight_from_string(value_string, learn: bool = True):
+    """
+    The total weight result for a matched field value, in the format specified by databaseUpload.
+    Also callable in-process, by processExtractedData, when this module is deployed alongside it.
+    With learn, an accepted weight is recorded straight away (see learn_from_results).
+    """
     try:
         value = extract_value_from_string(value_string)
         checks = run_heuristic_checks(value)
-        to_publish = {"success": True,
-                      "error": None,
-                      "value": value,
-                      "checks": checks}
+        result = {"success": True,
+                  "error": None,
+                  "value": value,
+                  "checks": checks}
+        if learn:
+            learn_from_results([result])
+        return result
     except ValueNotMatchedException:
-        to_publish = {"success": False,
-                      "error": {"type": "field value", "description": "Matched field value does not contain number"},
-                      "value": None,
-                      "checks": None}
+        return {"success": False,
+                "error": {"type": "field value", "description": "Matched field value does not contain number"},
+                "value": None,
+                "checks": None}
+
+
+def extract_total_weights_from_strings(value_strings: list, learn: bool = True) -> list:
+    """extract_total_weight_from_string over many matched field values, parsed and checked in one pass each."""
+    values = extract_values_from_strings(value_strings)
+    matched = [value for value in values if value is not None]
+    checks = iter(run_heuristic_checks_batch(matched) if matched else [])
+
+    results = []
+    for value in values:
+        if value is None:
+            results.append({"success": False,
+                            "error": {"type": "field value", "description": "Matched field value does not contain number"},
+                            "value": None,
+                            "checks": None})
+            continue
+        results.append({"success": True, "error": None, "value": value, "checks": next(checks)})
+    if learn:
+        learn_from_results(results)
+    return results
+
+
+def extract_total_weight_batch(payload, topic_id):
+    """
+    Handles a payload with `items`, an object from item key to valueString. The results are published keyed by item,
+    in messages of at most BATCH_MESSAGE_ITEMS items each.
+    """
+    items = payload["items"]
+    if not isinstance(items, dict):
+        raise ValueError("items must be an object from item key to valueString")
+    keys = list(items.keys())
+    results = extract_total_weights_from_strings([items[key] for key in keys], learn=False)
 
     project_id = os.environ["PROJECT_ID"]
-    topic_path = PUB_CLIENT.topic_path(project_id, topic_id)
-    message = json.dumps(to_publish).encode('utf-8')
-    future = PUB_CLIENT.publish(topic_path, message)
+    topic_path = get_publisher().topic_path(project_id, topic_id)
+    message_items = int(os.environ.get("BATCH_MESSAGE_ITEMS", "500"))
+    futures = []
+    for start in range(0, len(keys), message_items):
+        to_publish = {"results": dict(zip(keys[start:start + message_items], results[start:start + message_items]))}
+        for key in ["correlationId", "expiresAt"]:
+            if key in payload:
+                to_publish[key] = payload[key]
+        message = json.dumps(to_publish).encode('utf-8')
+        futures.append(get_publisher().publish(topic_path, message, **reply_attributes(payload)))
+    get_publisher().flush(futures, timeout=float(os.environ.get("PUBLISH_TIMEOUT", "30")))
+    # learnt from only once published, so a retried task does not record its weights twice
+    learn_from_results(results)
 
+
+def extract_total_weight(request):
+    payload = request.json
+    if "items" in payload:
+        topic_id = validate_payload(payload, "topic")
+        validate_payload(payload, "items")
+        return extract_total_weight_batch(payload, topic_id)
+    value_string = validate_payload(payload, "valueString")
+    topic_id = validate_payload(payload, "topic")
+    to_publish = extract_total_weight_from_string(value_string, learn=False)
+
+    # replies to a shared result topic are routed back to the waiting request by correlation ID
+    for key in ["correlationId", "expiresAt"]:
+        if key in payload:
+            to_publish[key] = payload[key]
+
+    project_id = os.environ["PROJECT_ID"]
+    topic_path = get_publisher().topic_path(project_id, topic_id)
+    message = json.dumps(to_publish).encode('utf-8')
+    future = get_publisher().publish(topic_path, message, **reply_attributes(payload))
+    # the result must reach Pub/Sub before the instance can be throttled; a failure is raised so the task is retried
+    get_publisher().flush([future], timeout=float(os.environ.get("PUBLISH_TIMEOUT", "30")))
+    # learnt from only once published, so a retried task does not record its weight twice
+    learn_from_results([to_publish])
@@ -0,0 +1,128 @@
+"""
+Publishing to Pub/Sub with every message tracked until it is delivered.
+
+TrackedPublisher wraps a PublisherClient (or the LocalPublisherClient below). It keeps the future of every message it
+publishes until it is delivered, so a function can wait for the messages it published to be flushed before returning,
+and it records how long each of the last `window` messages took to be acknowledged by Pub/Sub and how many messages
+each of the last `window` flushes waited for.
+"""
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, wait
+
+
+class PublishException(Exception):
+    pass
+
+
+def batch_settings(max_messages: int, max_bytes: int, max_latency: float):
+    """The PublisherClient batch settings: a batch is sent once any one limit is reached."""
+    from google.cloud import pubsub_v1
+
+    return pubsub_v1.types.BatchSettings(max_messages=max_messages, max_bytes=max_bytes, max_latency=max_latency)
+
+
+def percentile(values: list, q: float) -> float:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class TrackedPublisher:
+    def __init__(self, client, window: int = 1000):
+        self.client = client
+        self.outstanding = set()
+        self.published = 0
+        self.failed = 0
+        self.flushes = 0
+        self.latencies = deque(maxlen=window)
+        self.batch_sizes = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def topic_path(self, project_id: str, topic_id: str) -> str:
+        return self.client.topic_path(project_id, topic_id)
+
+    def publish(self, topic_path: str, data: bytes, **attributes):
+        start = time.perf_counter()
+        future = self.client.publish(topic_path, data, **attributes)
+        with self._lock:
+            self.outstanding.add(future)
+
+        def done(future):
+            with self._lock:
+                self.outstanding.discard(future)
+                if future.exception() is None:
+                    self.published += 1
+                    self.latencies.append(time.perf_counter() - start)
+                else:
+                    self.failed += 1
+        future.add_done_callback(done)
+        return future
+
+    def flush(self, futures: list = None, timeout: float = None):
+        """
+        Waits for the messages of futures, as returned by publish, to be delivered, or for every outstanding message if
+        futures is None. Raises PublishException if any of them failed, or was still outstanding after timeout seconds,
+        so concurrent requests only wait for, and fail on, their own messages. The number of messages waited for is
+        recorded as the flush's batch size.
+        """
+        if futures is None:
+            with self._lock:
+                futures = list(self.outstanding)
+        with self._lock:
+            self.flushes += 1
+            self.batch_sizes.append(len(futures))
+        done, not_done = wait(futures, timeout=timeout)
+        errors = [future.exception() for future in done if future.exception() is not None]
+        if not_done or errors:
+            raise PublishException(f"{len(errors)} of {len(futures)} messages failed to publish and "
+                                   f"{len(not_done)} were not delivered within {timeout}s. "
+                                   f"Errors: {', '.join(str(error) for error in errors[:3])}")
+
+    def stats(self) -> dict:
+        """Counts since the publisher was created, and latencies and batch sizes over the last `window` of each."""
+        with self._lock:
+            latencies = list(self.latencies)
+            batch_sizes = list(self.batch_sizes)
+            return {"published": self.published,
+                    "failed": self.failed,
+                    "outstanding": len(self.outstanding),
+                    "latencyMean": sum(latencies) / len(latencies) if latencies else None,
+                    "latencyP50": percentile(latencies, 0.5),
+                    "latencyP95": percentile(latencies, 0.95),
+                    "latencyMax": max(latencies) if latencies else None,
+                    "flushes": self.flushes,
+                    "batchSizeMean": sum(batch_sizes) / len(batch_sizes) if batch_sizes else None,
+                    "batchSizeMax": max(batch_sizes) if batch_sizes else None}
+
+
+class LocalPublisherClient:
+    """
+    Stand-in for a PublisherClient, for tests and for running without Pub/Sub. Messages are delivered after latency
+    seconds, or fail with error if it is set.
+    """
+    def __init__(self, latency: float = 0.0, error: Exception = None):
+        self.latency = latency
+        self.error = error
+        self.messages = []
+
+    def topic_path(self, project_id: str, topic_id: str) -> str:
+        return f"projects/{project_id}/topics/{topic_id}"
+
+    def publish(self, topic_path: str, data: bytes, **attributes) -> Future:
+        future = Future()
+        message_id = str(len(self.messages))
+        self.messages.append((topic_path, data, attributes))
+
+        def deliver():
+            if self.error is not None:
+                future.set_exception(self.error)
+            else:
+                future.set_result(message_id)
+        if self.latency:
+            threading.Timer(self.latency, deliver).start()
+        else:
+            deliver()
+        return future
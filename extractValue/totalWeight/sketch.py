@@ -0,0 +1,134 @@
+"""
+A mergeable KLL quantile sketch (Karnin, Lang and Liberty, 2016) for the history of truck weights.
+
+The sketch keeps a stack of compactors. Items at level h stand for 2 ** h weights. When a level fills up, it is
+sorted and every other item is promoted to the next level, so memory stays O(k log(n / k)) however many weights are
+seen. Rank queries are accurate to roughly 1.7 / k of the total count. Sketches built by parallel workers can be
+merged, and serialise to JSON so they can be stored next to the weights CSV.
+
+Usage:
+    python sketch.py build weights.csv weights.sketch.json
+    python sketch.py merge a.sketch.json b.sketch.json ... merged.sketch.json
+"""
+import argparse
+import json
+import math
+import random
+
+import numpy as np
+
+
+class KLLSketch:
+    def __init__(self, k: int = 200, c: float = 2 / 3, seed: int = 0):
+        self.k = k
+        self.c = c
+        self.n = 0
+        self.compactors = [[]]
+        self._random = random.Random(seed)
+
+    def _capacity(self, level: int) -> int:
+        depth = len(self.compactors) - level - 1
+        return int(math.ceil(self.k * self.c ** depth)) + 1
+
+    def _size(self) -> int:
+        return sum(len(compactor) for compactor in self.compactors)
+
+    def _max_size(self) -> int:
+        return sum(self._capacity(level) for level in range(len(self.compactors)))
+
+    def _compress(self):
+        while self._size() >= self._max_size():
+            for level, compactor in enumerate(self.compactors):
+                if len(compactor) >= self._capacity(level):
+                    if level + 1 == len(self.compactors):
+                        self.compactors.append([])
+                    compactor.sort()
+                    # keep one item back if the count is odd, and promote every other item from a random offset
+                    leftover = [compactor.pop()] if len(compactor) % 2 else []
+                    self.compactors[level + 1].extend(compactor[self._random.randrange(2)::2])
+                    self.compactors[level] = leftover
+                    break
+
+    def update(self, value: float):
+        self.compactors[0].append(float(value))
+        self.n += 1
+        if len(self.compactors[0]) >= self._capacity(0):
+            self._compress()
+
+    def extend(self, values):
+        for value in values:
+            self.update(value)
+
+    def merge(self, other: "KLLSketch"):
+        while len(self.compactors) < len(other.compactors):
+            self.compactors.append([])
+        for level, compactor in enumerate(other.compactors):
+            self.compactors[level].extend(compactor)
+        self.n += other.n
+        self._compress()
+
+    def _cumulative_weights(self):
+        """The retained items in order, with the number of weights each item and those before it stand for."""
+        items = np.concatenate([np.asarray(compactor, dtype=float) for compactor in self.compactors])
+        weights = np.concatenate([np.full(len(compactor), 1 << level) for level, compactor in enumerate(self.compactors)])
+        order = np.argsort(items, kind="stable")
+        return items[order], np.concatenate([[0], np.cumsum(weights[order])])
+
+    def rank(self, value, inclusive: bool = True):
+        """Estimated number of weights <= value (or < value if not inclusive). value may also be an array of values."""
+        items, cumulative = self._cumulative_weights()
+        ranks = cumulative[np.searchsorted(items, value, side="right" if inclusive else "left")]
+        return ranks if np.ndim(value) else int(ranks)
+
+    def tail_probability(self, value):
+        """Estimate of min(Pr(W <= value), Pr(W >= value)), as WeightsIndex.tail_probability."""
+        if self.n == 0:
+            return np.ones_like(value, dtype=float) if np.ndim(value) else 1.0
+        at_most = self.rank(value) / self.n
+        at_least = (self.n - self.rank(value, inclusive=False)) / self.n
+        return np.minimum(at_most, at_least)
+
+    def to_json(self) -> str:
+        return json.dumps({"k": self.k, "c": self.c, "n": self.n, "compactors": self.compactors})
+
+    @classmethod
+    def from_json(cls, data) -> "KLLSketch":
+        state = json.loads(data)
+        sketch = cls(k=state["k"], c=state["c"])
+        sketch.n = state["n"]
+        sketch.compactors = [[float(item) for item in compactor] for compactor in state["compactors"]]
+        return sketch
+
+
+def main_cli(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build = subparsers.add_parser("build", help="build a sketch from the Weight column of a CSV")
+    build.add_argument("csv")
+    build.add_argument("output")
+    build.add_argument("--k", type=int, default=200)
+    merge = subparsers.add_parser("merge", help="merge sketches")
+    merge.add_argument("sketches", nargs="+")
+    merge.add_argument("output")
+    args = parser.parse_args(argv)
+
+    if args.command == "build":
+        import pandas as pd
+
+        sketch = KLLSketch(k=args.k)
+        sketch.extend(pd.read_csv(args.csv)["Weight"].dropna())
+    else:
+        sketch = None
+        for path in args.sketches:
+            with open(path) as f:
+                part = KLLSketch.from_json(f.read())
+            if sketch is None:
+                sketch = part
+            else:
+                sketch.merge(part)
+    with open(args.output, "w") as f:
+        f.write(sketch.to_json())
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -3,8 +3,10 @@ from unittest.mock import Mock
 from unittest.mock import patch
 from unittest import TestCase
 
+import contextlib
 import json
 import os
+import numpy as np
 import pandas as pd
 import sys
 
@@ -12,21 +14,74 @@ import sys
 sys.modules['google.cloud'] = Mock()
 
 import main
+import publisher
+from google.api_core.exceptions import PreconditionFailed
 
 
-PUBSUB_MOCK = Mock()
+# records every call while delivering through the local publisher, so results are tracked as in production
+PUBSUB_MOCK = Mock(wraps=publisher.LocalPublisherClient())
+STOCLIENT_MOCK = Mock()
+
+
+class FakeBucket:
+    """Objects held as name -> (data, generation), with generation preconditions enforced as Cloud Storage does."""
+    def __init__(self, objects, conflicts=0):
+        self.objects = objects
+        # number of writes by another instance that land between a read and this instance's write
+        self.conflicts = conflicts
+
+    def get_blob(self, name):
+        return FakeBlob(self, name) if name in self.objects else None
+
+    def blob(self, name):
+        return FakeBlob(self, name)
+
+
+class FakeBlob:
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.generation = bucket.objects[name][1] if name in bucket.objects else None
+        self.etag = str(self.generation)
+
+    def download_as_bytes(self, if_generation_match=None):
+        return self.bucket.objects[self.name][0]
+
+    def upload_from_string(self, data, content_type=None, if_generation_match=None):
+        if self.bucket.conflicts:
+            self.bucket.conflicts -= 1
+            other = main.KLLSketch.from_json(self.bucket.objects[self.name][0])
+            other.update(1500.0)
+            self.bucket.objects[self.name] = (other.to_json(), self.bucket.objects[self.name][1] + 1)
+        generation = self.bucket.objects[self.name][1] if self.name in self.bucket.objects else 0
+        if if_generation_match is not None and if_generation_match != generation:
+            raise PreconditionFailed("conditionNotMet")
+        self.bucket.objects[self.name] = (data, generation + 1)
+        self.generation = generation + 1
+        self.etag = str(self.generation)
 
 # mock environment variables
-@patch.dict(os.environ, {"PROJECT_ID":'id', "WEIGHTS_DATABASE":'al_weights.csv'})
-# replace access to weights file in cloud bucket with access to local file
-@patch('pandas.read_csv', Mock(return_value=pd.read_csv("extractValue/totalWeight/al_weights.csv")))
+@patch.dict(os.environ, {"PROJECT_ID":'id', "WEIGHTS_DATABASE":'gpr_weights_database/al_weights.csv'})
 @patch('main.PUB_CLIENT', PUBSUB_MOCK)
+@patch('main.PUBLISHER', None)
+@patch('main.STORAGE_CLIENT', STOCLIENT_MOCK)
+@patch('main.WEIGHTS_INDEX', None)
+@patch('main.WEIGHTS_SKETCH', None)
 class TestWeightExtraction(TestCase):
     
     def setUp(self, *args):
         # default request contains valid fields
         self.request = Mock(json={"valueString":"1200.123", "topic":"t"})
         PUBSUB_MOCK = Mock()
+        # replace access to weights file in cloud bucket with access to local file
+        STOCLIENT_MOCK.reset_mock()
+        STOCLIENT_MOCK.bucket.return_value = STOCLIENT_MOCK
+        STOCLIENT_MOCK.get_blob.return_value = STOCLIENT_MOCK
+        with open("extractValue/totalWeight/al_weights.csv", "rb") as f:
+            STOCLIENT_MOCK.download_as_bytes.return_value = f.read()
+        STOCLIENT_MOCK.generation = 1
+        STOCLIENT_MOCK.etag = "a"
+        main.PENDING_WEIGHTS = main.KLLSketch()
 
 
     def test_successCase(self, *args):
@@ -41,6 +96,223 @@ class TestWeightExtraction(TestCase):
         self.assertEqual(message["value"], "1200.123")
 
 
+    def test_edgeCase_weightsIndexReload(self, *args):
+        main.run_heuristic_checks("1200.123")
+        main.run_heuristic_checks("1300.123")
+        self.assertEqual(STOCLIENT_MOCK.download_as_bytes.call_count, 1)
+
+        STOCLIENT_MOCK.generation = 2
+        main.run_heuristic_checks("1200.123")
+        self.assertEqual(STOCLIENT_MOCK.download_as_bytes.call_count, 2)
+
+        STOCLIENT_MOCK.etag = "b"
+        main.run_heuristic_checks("1200.123")
+        self.assertEqual(STOCLIENT_MOCK.download_as_bytes.call_count, 3)
+
+
+    def test_edgeCase_tailProbability(self, *args):
+        weights = pd.read_csv("extractValue/totalWeight/al_weights.csv")["Weight"]
+        index = main.WeightsIndex(weights, "db", None)
+        testCases = [0.0, float(weights.min()), float(weights.median()), 1200.123, float(weights.max()), 1e9]
+
+        for test in testCases:
+            with self.subTest(test_data=test):
+                expected = min(np.mean(weights <= test), np.mean(weights >= test))
+                self.assertAlmostEqual(index.tail_probability(test), expected)
+
+
+    def test_edgeCase_sketchRankError(self, *args):
+        rng = np.random.default_rng(0)
+        weights = rng.lognormal(8, 1, 100000)
+        sketch = main.KLLSketch()
+        sketch.extend(weights)
+        # the two halves of the history sketched by separate workers, and merged
+        left, right = main.KLLSketch(seed=1), main.KLLSketch(seed=2)
+        left.extend(weights[:50000])
+        right.extend(weights[50000:])
+        left.merge(main.KLLSketch.from_json(right.to_json()))
+
+        self.assertEqual(left.n, len(weights))
+        self.assertLess(sum(len(compactor) for compactor in sketch.compactors), 1000)
+        for q in [0.01, 0.05, 0.5, 0.95, 0.99]:
+            value = np.quantile(weights, q)
+            with self.subTest(test_data=q):
+                self.assertLess(abs(sketch.rank(value) / sketch.n - q), 0.01)
+                self.assertLess(abs(left.rank(value) / left.n - q), 0.01)
+
+
+    def test_edgeCase_weightsSketch(self, *args):
+        with open("extractValue/totalWeight/al_weights.csv", "rb") as f:
+            bucket = FakeBucket({"al_weights.csv": (f.read(), 1)})
+        STOCLIENT_MOCK.bucket.return_value = bucket
+        n = len(pd.read_csv("extractValue/totalWeight/al_weights.csv")["Weight"].dropna())
+
+        with patch.dict(os.environ, {"WEIGHTS_SKETCH": "gpr_weights_database/al_weights.sketch.json",
+                                     "WEIGHTS_SKETCH_LEARN": "true", "WEIGHTS_SKETCH_FLUSH_SIZE": "1"}):
+            # the first accepted weight creates the sketch from the CSV
+            self.assertTrue(main.extract_total_weight_from_string("1200.123")["checks"]["extremeValueCheck"])
+            self.assertEqual(main.KLLSketch.from_json(bucket.objects["al_weights.sketch.json"][0]).n, n + 1)
+
+            # extreme and rejected values are not learnt from
+            self.assertFalse(main.extract_total_weight_from_string("500000.000")["checks"]["extremeValueCheck"])
+            self.assertEqual(main.WEIGHTS_SKETCH.sketch.n, n + 1)
+
+            # a write by another instance in between is merged rather than overwritten
+            bucket.conflicts = 1
+            main.extract_total_weight_from_string("1300.123")
+            self.assertEqual(main.KLLSketch.from_json(bucket.objects["al_weights.sketch.json"][0]).n, n + 3)
+            self.assertEqual(main.PENDING_WEIGHTS.n, 0)
+
+
+    @patch.dict(os.environ, {"WEIGHTS_SKETCH": "gpr_weights_database/al_weights.sketch.json"})
+    def test_edgeCase_weightsSketchBuiltOnce(self, *args):
+        testCases = [
+            # (upload error, sketch stored)
+            (None, True),
+            (RuntimeError("403 Forbidden"), False)]
+
+        for error, stored in testCases:
+            with open("extractValue/totalWeight/al_weights.csv", "rb") as f:
+                bucket = FakeBucket({"al_weights.csv": (f.read(), 1)})
+            STOCLIENT_MOCK.bucket.return_value = bucket
+            with self.subTest(test_data=error), patch("main.WEIGHTS_SKETCH", None), \
+                    patch.object(main.KLLSketch, "extend", autospec=True, side_effect=main.KLLSketch.extend) as extend, \
+                    patch.object(FakeBlob, "upload_from_string", autospec=True,
+                                 side_effect=error or FakeBlob.upload_from_string):
+                for call in range(2):
+                    # a failed upload is logged, and not retried by every later call
+                    with self.assertLogs(level="ERROR") if error and call == 0 else contextlib.nullcontext():
+                        self.assertTrue(main.extract_total_weight_from_string("1200.123")["checks"]["extremeValueCheck"])
+                # the sketch is built from the CSV once, whether or not it could be stored
+                self.assertEqual(extend.call_count, 1)
+                self.assertEqual("al_weights.sketch.json" in bucket.objects, stored)
+
+
+    @patch.dict(os.environ, {"WEIGHTS_SKETCH": "gpr_weights_database/al_weights.sketch.json",
+                             "WEIGHTS_SKETCH_LEARN": "true", "WEIGHTS_SKETCH_FLUSH_SIZE": "3"})
+    @patch("main.LAST_WEIGHTS_FLUSH", float("inf"))
+    def test_edgeCase_weightsSketchBuffered(self, *args):
+        with open("extractValue/totalWeight/al_weights.csv", "rb") as f:
+            bucket = FakeBucket({"al_weights.csv": (f.read(), 1)})
+        STOCLIENT_MOCK.bucket.return_value = bucket
+
+        # weights are only learnt once their result is published, and merged every WEIGHTS_SKETCH_FLUSH_SIZE weights
+        for value_string in ["1200.123", "1300.123"]:
+            self.request.json["valueString"] = value_string
+            main.extract_total_weight(self.request)
+        self.assertEqual(main.PENDING_WEIGHTS.n, 2)
+        # the sketch built from the CSV is stored without the pending weights
+        n = len(pd.read_csv("extractValue/totalWeight/al_weights.csv")["Weight"].dropna())
+        self.assertEqual(main.KLLSketch.from_json(bucket.objects["al_weights.sketch.json"][0]).n, n)
+        with patch('main.PUB_CLIENT', publisher.LocalPublisherClient(error=RuntimeError("topic not found"))), \
+                patch('main.PUBLISHER', None):
+            self.assertRaises(publisher.PublishException, main.extract_total_weight, self.request)
+        self.assertEqual(main.PENDING_WEIGHTS.n, 2)
+
+        # a storage error is logged and the weights kept, without failing the extraction
+        with patch.object(bucket, "blob", side_effect=RuntimeError("503 Service Unavailable")), \
+                self.assertLogs(level="ERROR"):
+            self.assertTrue(main.extract_total_weight_from_string("1400.123")["success"])
+        self.assertEqual(main.PENDING_WEIGHTS.n, 3)
+        main.extract_total_weight_from_string("1500.123")
+        self.assertEqual(main.PENDING_WEIGHTS.n, 0)
+        self.assertIn("al_weights.sketch.json", bucket.objects)
+
+        # nothing is learnt unless WEIGHTS_SKETCH_LEARN is true
+        with patch.dict(os.environ, {"WEIGHTS_SKETCH_LEARN": "false"}):
+            main.extract_total_weight(self.request)
+        self.assertEqual(main.PENDING_WEIGHTS.n, 0)
+
+
+    def test_edgeCase_correlationId(self, *args):
+        self.request.json["correlationId"] = "c"
+        self.request.json["expiresAt"] = 100.0
+        self.request.json["instanceId"] = "i"
+        main.extract_total_weight(self.request)
+        message = json.loads(PUBSUB_MOCK.publish.call_args.args[1])
+        self.assertEqual(PUBSUB_MOCK.publish.call_args.kwargs["instanceId"], "i")
+        self.assertEqual(message["correlationId"], "c")
+        self.assertEqual(message["expiresAt"], 100.0)
+        self.assertEqual(message["value"], "1200.123")
+
+
+    def test_edgeCase_batchMatchesSingleItem(self, *args):
+        value_strings = ["1200.123", "0967.123", "12345.534kgs", ": 12,345.534", "weight", "total.weight", "1.000",
+                         "500000.000", "01967.12", "12345.5555", "1345.", "1345"]
+        self.request.json = {"topic": "t", "correlationId": "c",
+                             "items": {f"ticket-{i}": value for i, value in enumerate(value_strings)}}
+
+        with patch.dict(os.environ, {"BATCH_MESSAGE_ITEMS": "5"}):
+            main.extract_total_weight(self.request)
+        messages = [json.loads(call.args[1]) for call in PUBSUB_MOCK.publish.call_args_list[-3:]]
+
+        self.assertEqual([len(message["results"]) for message in messages], [5, 5, 2])
+        self.assertTrue(all(message["correlationId"] == "c" for message in messages))
+        results = {key: result for message in messages for key, result in message["results"].items()}
+        for i, value in enumerate(value_strings):
+            with self.subTest(test_data=value):
+                self.assertEqual(results[f"ticket-{i}"], main.extract_total_weight_from_string(value))
+
+
+    def test_edgeCase_sketchTailProbabilities(self, *args):
+        weights = pd.read_csv("extractValue/totalWeight/al_weights.csv")["Weight"].dropna()
+        sketch = main.KLLSketch()
+        sketch.extend(weights)
+        values = np.array([0.0, weights.min(), weights.median(), 1200.123, weights.max(), 1e9])
+        self.assertEqual(sketch.tail_probability(values).tolist(),
+                         [sketch.tail_probability(value) for value in values])
+        self.assertEqual(main.WeightsIndex(weights, "db", None).tail_probability(values).tolist(),
+                         sketch.tail_probability(values).tolist())
+
+
+    def test_edgeCase_publishWaitsForDelivery(self, *args):
+        client = publisher.LocalPublisherClient(latency=0.05)
+        with patch('main.PUB_CLIENT', client):
+            main.extract_total_weight(self.request)
+            self.request.json = {"topic": "t", "items": {"a": "1200.123", "b": "1300.123"}}
+            with patch.dict(os.environ, {"BATCH_MESSAGE_ITEMS": "1"}):
+                main.extract_total_weight(self.request)
+
+            stats = main.get_publisher().stats()
+        self.assertEqual(len(client.messages), 3)
+        self.assertEqual(stats["published"], 3)
+        self.assertEqual(stats["outstanding"], 0)
+        self.assertGreaterEqual(stats["latencyP50"], 0.05)
+        self.assertEqual(stats["flushes"], 2)
+        self.assertEqual(stats["batchSizeMax"], 2)
+
+
+    def test_edgeCase_publisherFlushesOwnMessages(self, *args):
+        tracked = publisher.TrackedPublisher(publisher.LocalPublisherClient(), window=3)
+        for _ in range(5):
+            tracked.flush([tracked.publish("t", b"ok")])
+        stats = tracked.stats()
+        self.assertEqual((stats["published"], stats["flushes"]), (5, 5))
+        self.assertEqual(len(tracked.latencies), 3)
+        self.assertEqual(len(tracked.batch_sizes), 3)
+
+        # another request's failed or undelivered message does not fail this request's flush
+        tracked.client.error = RuntimeError("topic not found")
+        failed = tracked.publish("t", b"failed")
+        tracked.client.error, tracked.client.latency = None, 1
+        slow = tracked.publish("t", b"slow")
+        tracked.client.latency = 0
+        tracked.flush([tracked.publish("t", b"ok")], timeout=0.01)
+        self.assertRaises(publisher.PublishException, tracked.flush, [failed], timeout=0.01)
+        self.assertRaises(publisher.PublishException, tracked.flush, [slow], timeout=0.01)
+
+
+    def test_failureCase_publishError(self, *args):
+        testCases = [
+            (publisher.LocalPublisherClient(error=RuntimeError("topic not found")), {}),
+            (publisher.LocalPublisherClient(latency=1), {"PUBLISH_TIMEOUT": "0.01"})]
+
+        for client, env in testCases:
+            with self.subTest(test_data=env), patch('main.PUB_CLIENT', client), patch('main.PUBLISHER', None), \
+                    patch.dict(os.environ, env):
+                self.assertRaises(publisher.PublishException, main.extract_total_weight, self.request)
+
+
     def test_edgeCase_decimalPlaces(self, *args):
         testCases = [
             "0967.123", 
@@ -118,7 +390,10 @@ class TestWeightExtraction(TestCase):
             {"topic":"t"}, 
             {"valueString":"12345.123"}, 
             {"topic":None, "valueString":"12345.123"},
-            {"topic":"t", "valueString":None}]
+            {"topic":"t", "valueString":None},
+            {"topic":"t", "items":{}},
+            {"topic":"t", "items":["12345.123"]},
+            {"items":{"a":"12345.123"}}]
         
         for test in testCases:
             self.request.json = test
@@ -0,0 +1,163 @@
+"""
+Runs field matching and value extraction locally over a backlog of raw-data files.
+
+Each file is in a format written by processImage (a CSV such as sample_input.csv, or an Arrow or Parquet file), and
+produces the same `[fileName].json` that processExtractedData would save to `gpr_sanitised_data`. Documents are
+processed across a pool of worker processes, and the value extractors are called in-process rather than through
+Cloud Tasks.
+
+Usage:
+    python processExtractedData/batch.py INPUT_DIR OUTPUT_DIR
+    python processExtractedData/batch.py --manifest files.txt OUTPUT_DIR
+
+Environment variables not already set are read from processExtractedData/env.yaml and from the env.yaml of each
+extractor, so the thresholds and lambdas match the deployed functions. Accepted weights are only added to the
+totalWeight sketch with --learn-weights; each worker then merges its weights once, as it exits.
+"""
+import argparse
+import glob
+import importlib.util
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.util import Finalize
+
+import main
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+EXTRACT_VALUE = os.path.join(os.path.dirname(HERE), "extractValue")
+
+DEFAULT_FIELDS = {"total weight": "totalWeight"}
+DEFAULT_EXTRACTORS = [f"totalWeight={os.path.join(EXTRACT_VALUE, 'totalWeight', 'main.py')}:extract_total_weight_from_string",
+                      f"fieldValue/*={os.path.join(EXTRACT_VALUE, 'fieldValue', 'main.py')}:extract_field_value_from_string"]
+STAGES = ["read", "match", "extract", "write"]
+RAW_DATA_EXTENSIONS = ["csv", "arrow", "parquet"]
+
+
+def read_env_defaults(path: str):
+    if not os.path.exists(path):
+        return
+    with open(path) as f:
+        for line in f:
+            if ":" in line:
+                key, value = line.split(":", 1)
+                os.environ.setdefault(key.strip(), value.strip().strip('"'))
+
+
+def load_extractor(function_name: str, path: str, attribute: str):
+    # every extractor lives in a main.py, so each is loaded under its own function name, with its own directory
+    # importable for any modules deployed alongside it
+    sys.path.insert(0, os.path.dirname(path))
+    spec = importlib.util.spec_from_file_location(function_name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    read_env_defaults(os.path.join(os.path.dirname(path), "env.yaml"))
+    if hasattr(module, "flush_pending_weights"):
+        # weights learnt by this worker are merged into the sketch once, when the worker exits
+        Finalize(None, module.flush_pending_weights, exitpriority=10)
+    return getattr(module, attribute)
+
+
+def init_worker(extractors: list, learn_weights: bool = False):
+    # a backfill only writes to the deployed weights sketch when asked to, whatever the extractor's env.yaml says
+    os.environ["WEIGHTS_SKETCH_LEARN"] = "true" if learn_weights else "false"
+    read_env_defaults(os.path.join(HERE, "env.yaml"))
+    for entry in extractors:
+        function_name, target = entry.split("=", 1)
+        path, attribute = target.rsplit(":", 1)
+        main.register_value_extractor(function_name, load_extractor(function_name, path, attribute))
+
+
+def process_file(path: str, output_dir: str, fields: dict) -> dict:
+    import pandas as pd
+
+    timings = {}
+    start = time.perf_counter()
+    if path.endswith((".arrow", ".parquet")):
+        with open(path, "rb") as f:
+            raw_data = main.raw_data_from_bytes(f.read(), path, main.RAW_DATA_COLUMNS)
+    else:
+        raw_data = pd.read_csv(path, usecols=main.csv_columns(main.RAW_DATA_COLUMNS))
+    timings["read"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    matches = main.match_fields(raw_data, list(fields.keys()))
+    timings["match"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    return_object = {"extractedFields": list(fields.keys())}
+    for field_name, function_name in fields.items():
+        match = matches[field_name]
+        if isinstance(match, main.LikelihoodException):
+            return_object[field_name] = main.field_name_error(match)
+            continue
+        extractor = main.get_value_extractor(function_name)
+        if extractor is None:
+            raise ValueError(f"No extractor registered for {function_name}")
+        return_object[field_name] = main.run_value_extractor(extractor, match["value_string"], function_name)
+    timings["extract"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    output_filename = os.path.basename(path).split(".", 1)[0]
+    with open(os.path.join(output_dir, f"{output_filename}.json"), "w") as f:
+        json.dump(return_object, f)
+    timings["write"] = time.perf_counter() - start
+
+    return timings
+
+
+def list_inputs(input_path: str, manifest: bool) -> list:
+    if manifest:
+        base = os.path.dirname(os.path.abspath(input_path))
+        with open(input_path) as f:
+            return [os.path.join(base, line.strip()) for line in f if line.strip()]
+    return sorted(path for extension in RAW_DATA_EXTENSIONS for path in glob.glob(os.path.join(input_path, f"*.{extension}")))
+
+
+def main_cli(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("input", help="directory of raw-data files, or a manifest file with --manifest")
+    parser.add_argument("output_dir", help="directory to write the sanitised JSON files to")
+    parser.add_argument("--manifest", action="store_true", help="read the CSV paths from INPUT, one per line")
+    parser.add_argument("--fields", type=json.loads, default=DEFAULT_FIELDS,
+                        help='JSON object from field name to function name, default \'{"total weight": "totalWeight"}\'')
+    parser.add_argument("--extractor", action="append", dest="extractors",
+                        help="functionName=path/to/main.py:function, repeatable; defaults to totalWeight and fieldValue/*")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--learn-weights", action="store_true",
+                        help="add accepted weights to the totalWeight sketch at WEIGHTS_SKETCH")
+    args = parser.parse_args(argv)
+
+    paths = list_inputs(args.input, args.manifest)
+    os.makedirs(args.output_dir, exist_ok=True)
+    extractors = args.extractors or DEFAULT_EXTRACTORS
+
+    totals = dict.fromkeys(STAGES, 0.0)
+    failures = 0
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=init_worker,
+                             initargs=(extractors, args.learn_weights)) as pool:
+        futures = [(path, pool.submit(process_file, path, args.output_dir, args.fields)) for path in paths]
+        for path, future in futures:
+            try:
+                timings = future.result()
+            except Exception as e:
+                failures += 1
+                print(f"{path}: {e}", file=sys.stderr)
+                continue
+            for stage in STAGES:
+                totals[stage] += timings[stage]
+    elapsed = time.perf_counter() - start
+
+    processed = len(paths) - failures
+    print(f"{processed} documents in {elapsed:.2f}s ({processed / elapsed if elapsed > 0 else 0:.1f} documents/s), {failures} failed")
+    for stage in STAGES:
+        mean_ms = totals[stage] / processed * 1000 if processed else 0.0
+        print(f"  {stage:<8}{mean_ms:>10.2f} ms/document (summed over workers: {totals[stage]:.2f}s)")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
@@ -0,0 +1,63 @@
+"""
+A uniform grid index over the field value boxes of a document, for geometry-aware field matching.
+
+processImage records the normalized bounding box of every field name and value, with its page number. Coordinates are
+fractions of the page, so one grid of cells x cells cells fits every page. Each value box is listed in every cell it
+covers on its page. A query for the values right of (or below) a name box only visits the cells in the band to its
+right (or below it), so its cost grows with the band and the boxes in it rather than with the document.
+"""
+from collections import defaultdict
+
+import numpy as np
+
+BOX_SIDES = ["Left", "Top", "Right", "Bottom"]
+NAME_BOX_COLUMNS = [f"Field Name {side}" for side in BOX_SIDES]
+VALUE_BOX_COLUMNS = [f"Field Value {side}" for side in BOX_SIDES]
+LAYOUT_COLUMNS = ["Page Number"] + NAME_BOX_COLUMNS + VALUE_BOX_COLUMNS
+
+
+class LayoutIndex:
+    def __init__(self, pages, boxes, cells: int = 20):
+        """pages[i] and boxes[i] = (left, top, right, bottom) are the page and box of value i. NaN boxes are skipped."""
+        self.pages = np.asarray(pages)
+        self.boxes = np.asarray(boxes, dtype=float).reshape(-1, 4)
+        self.cells = cells
+        self.grid = defaultdict(list)
+        for i, (page, box) in enumerate(zip(self.pages, self.boxes)):
+            if np.isnan(box).any():
+                continue
+            left, top, right, bottom = (self._cell(coordinate) for coordinate in box)
+            for row in range(top, bottom + 1):
+                for column in range(left, right + 1):
+                    self.grid[(page, row, column)].append(i)
+
+    @classmethod
+    def from_raw_data(cls, raw_data, cells: int = 20) -> "LayoutIndex":
+        """The index of the value boxes of raw_data, or None if it was written without them."""
+        if not all(column in raw_data for column in LAYOUT_COLUMNS):
+            return None
+        return cls(raw_data["Page Number"].to_numpy(), raw_data[VALUE_BOX_COLUMNS].to_numpy(dtype=float), cells)
+
+    def _cell(self, coordinate: float) -> int:
+        return min(self.cells - 1, max(0, int(coordinate * self.cells)))
+
+    def _candidates(self, page, rows, columns) -> set:
+        return {i for row in rows for column in columns for i in self.grid.get((page, row, column), ())}
+
+    def right_of(self, page, box, tolerance: float = 0.0) -> list:
+        """The values on page that start right of box and overlap it vertically, nearest first."""
+        left, top, right, bottom = box
+        candidates = self._candidates(page, range(self._cell(top), self._cell(bottom) + 1),
+                                      range(self._cell(right - tolerance), self.cells))
+        hits = [i for i in candidates if self.boxes[i, 0] >= right - tolerance
+                and self.boxes[i, 1] <= bottom and self.boxes[i, 3] >= top]
+        return sorted(hits, key=lambda i: (self.boxes[i, 0] - right, i))
+
+    def below(self, page, box, tolerance: float = 0.0) -> list:
+        """The values on page that start below box and overlap it horizontally, nearest first."""
+        left, top, right, bottom = box
+        candidates = self._candidates(page, range(self._cell(bottom - tolerance), self.cells),
+                                      range(self._cell(left), self._cell(right) + 1))
+        hits = [i for i in candidates if self.boxes[i, 1] >= bottom - tolerance
+                and self.boxes[i, 0] <= right and self.boxes[i, 2] >= left]
+        return sorted(hits, key=lambda i: (self.boxes[i, 1] - bottom, i))
@@ -1,19 +1,58 @@
+import atexit
+import functools
+import importlib
 import json
+import logging
+import math
 
-import google.api_core.exceptions
+# imported eagerly, unlike pandas: every request that passes validation needs it for matching
 import numpy as np
-import pandas as pd
-import scipy.stats
 import os
-from google.cloud import storage
-from google.cloud import tasks_v2beta3 as tasks
-from google.cloud import pubsub_v1
-from concurrent.futures import TimeoutError
+import threading
+import time
+import uuid
+from concurrent.futures import Future, wait
+from typing import TYPE_CHECKING
 
-STORAGE_CLIENT = storage.Client()
-TASK_CLIENT = tasks.CloudTasksClient()
-SUB_CLIENT = pubsub_v1.SubscriberClient()
-PUB_CLIENT = pubsub_v1.PublisherClient()
+from layout import LAYOUT_COLUMNS, NAME_BOX_COLUMNS, LayoutIndex
+
+if TYPE_CHECKING:
+    from google.cloud import pubsub_v1
+
+STORAGE_CLIENT = None
+TASK_CLIENT = None
+SUB_CLIENT = None
+
+
+def get_storage_client():
+    global STORAGE_CLIENT
+    if STORAGE_CLIENT is None:
+        from google.cloud import storage
+        STORAGE_CLIENT = storage.Client()
+    return STORAGE_CLIENT
+
+
+def get_task_client():
+    global TASK_CLIENT
+    if TASK_CLIENT is None:
+        from google.cloud import tasks_v2beta3 as tasks
+        TASK_CLIENT = tasks.CloudTasksClient()
+    return TASK_CLIENT
+
+
+def get_subscriber_client():
+    global SUB_CLIENT
+    if SUB_CLIENT is None:
+        from google.cloud import pubsub_v1
+        SUB_CLIENT = pubsub_v1.SubscriberClient()
+    return SUB_CLIENT
+
+# identifies this instance: value extraction functions publish their replies with it as the instanceId attribute, and
+# only this instance's own subscription receives them
+INSTANCE_ID = uuid.uuid4().hex
+
+# running totals of the work skipped by the banded edit distance, per process
+PRUNING_STATS = {"pairs": 0, "lengthPruned": 0, "bandPruned": 0, "cellsComputed": 0, "cellsSkipped": 0}
 
 
 class LikelihoodException(Exception):
@@ -32,14 +71,18 @@ class PosteriorLikelihoodThresholdException(LikelihoodException):
         LikelihoodException.__init__(self, likelihood)
 
 
-def enqueue_value_extraction(value_str, value_extraction_function: str, topic: str):
+def enqueue_value_extraction(value_str, value_extraction_function: str, topic: str, correlation_id: str,
+                             expires_at: float):
+    from google.cloud import tasks_v2beta3 as tasks
+
     service_account_email = os.environ["SAE"] + "@appspot.gserviceaccount.com"
     project_id = os.environ["PROJECT_ID"]
     queue = os.environ["QUEUE"]
     location = os.environ["LOCATION"]
     url = "https://" + location + "-" + project_id + ".cloudfunctions.net/" + value_extraction_function
-    payload = {"valueString": value_str, "topic": topic}
-    formatted_parent = TASK_CLIENT.queue_path(project_id, location, queue)
+    payload = {"valueString": value_str, "topic": topic, "correlationId": correlation_id, "expiresAt": expires_at,
+               "instanceId": INSTANCE_ID}
+    formatted_parent = get_task_client().queue_path(project_id, location, queue)
 
     http_request = tasks.HttpRequest(url=url,
                                      oidc_token=tasks.OidcToken(service_account_email=service_account_email),
@@ -50,10 +93,57 @@ def enqueue_value_extraction(value_str, value_extraction_function: str, topic: s
 
     request = tasks.CreateTaskRequest(parent=formatted_parent, task=task)
 
-    response = TASK_CLIENT.create_task(request)
+    response = get_task_client().create_task(request)
     response.view = 2
 
 
+# function name -> extractor(value_string) returning the databaseUpload format, for extractors deployed with this function
+VALUE_EXTRACTORS = {}
+_LOCAL_EXTRACTORS_LOADED = False
+
+
+def register_value_extractor(function_name: str, extractor):
+    VALUE_EXTRACTORS[function_name] = extractor
+
+
+def get_value_extractor(function_name: str):
+    """
+    The in-process extractor registered under function_name, or None if it must be called through Cloud Tasks.
+
+    On first use, registers the extractors listed in LOCAL_VALUE_EXTRACTORS as comma-separated
+    functionName=module:function entries, e.g. "totalWeight=totalWeight:extract_total_weight_from_string" with
+    extractValue/totalWeight/main.py deployed as totalWeight.py.
+
+    A generic extractor registered as "fieldValue/*" also serves every function name "fieldValue/[fieldType]", called
+    with that field_type.
+    """
+    global _LOCAL_EXTRACTORS_LOADED
+    if not _LOCAL_EXTRACTORS_LOADED:
+        for entry in filter(None, os.environ.get("LOCAL_VALUE_EXTRACTORS", "").split(",")):
+            name, target = entry.strip().split("=", 1)
+            module_name, attribute = target.split(":", 1)
+            register_value_extractor(name, getattr(importlib.import_module(module_name), attribute))
+        _LOCAL_EXTRACTORS_LOADED = True
+    extractor = VALUE_EXTRACTORS.get(function_name)
+    if extractor is None and "/" in function_name:
+        generic_name, field_type = function_name.split("/", 1)
+        generic_extractor = VALUE_EXTRACTORS.get(generic_name + "/*")
+        if generic_extractor is not None:
+            extractor = functools.partial(generic_extractor, field_type=field_type)
+    return extractor
+
+
+def run_value_extractor(extractor, value_str, function_name: str) -> dict:
+    try:
+        return extractor(value_str)
+    except Exception as e:
+        return {"success": False,
+                "error": {"type": "field value",
+                          "description": f"Field value match function failed. Function Name: {function_name}. Error: {e}"},
+                "value": None,
+                "checks": None}
+
+
 def levenshtein_distance(str1, str2):
     n, m = len(str1), len(str2)
     dp = [[tuple((0, [0, 0, 0])) for i in range(m + 1)] for j in range(n + 1)]
@@ -89,6 +179,199 @@ def edit_distance(s1, s2):
     return np.array(l1)
 
 
+def encode_strings(strings):
+    """Packs strings into a zero-padded (len(strings), max_length) array of code points, plus their lengths."""
+    lengths = np.array([len(s) for s in strings], dtype=np.int64)
+    max_length = int(lengths.max()) if len(strings) > 0 else 0
+    codes = np.zeros((len(strings), max_length), dtype=np.int64)
+    for k, s in enumerate(strings):
+        codes[k, :len(s)] = [ord(c) for c in s]
+    return codes, lengths
+
+
+class NoiseModel:
+    """
+    The independent Poisson model for OCR noise, I ~ Po(ins_lambda), D ~ Po(del_lambda), R ~ Po(rep_lambda).
+
+    log Pr(k) is tabulated for each lambda up to max_count once, so scoring a batch of edit operations is a gather
+    from the table rather than a pmf evaluation. The table grows if a larger count is ever scored.
+    """
+    def __init__(self, ins_lambda: float, del_lambda: float, rep_lambda: float, max_count: int = 64):
+        self.lambdas = np.array([ins_lambda, del_lambda, rep_lambda], dtype=float)
+        self.log_pmf = self._tabulate(max_count)
+        self._max_edits = {}
+
+    def _tabulate(self, max_count: int):
+        counts = np.arange(max_count + 1)
+        log_factorials = np.array([math.lgamma(k + 1) for k in counts])
+        table = np.full((3, max_count + 2), -np.inf)
+        for row, lam in enumerate(self.lambdas):
+            if lam > 0:
+                table[row, :-1] = counts * math.log(lam) - lam - log_factorials
+            else:
+                table[row, 0] = 0.0
+        # the extra -inf column is what a count of -1 (a pruned candidate) indexes into
+        return table
+
+    @property
+    def max_count(self) -> int:
+        return self.log_pmf.shape[1] - 2
+
+    def log_likelihood(self, operations):
+        """log Pr_I(i) + log Pr_D(d) + log Pr_R(r) for an (..., 3) array of edit operations, -inf where pruned."""
+        operations = np.asarray(operations)
+        largest = int(operations.max()) if operations.size > 0 else 0
+        if largest > self.max_count:
+            self.log_pmf = self._tabulate(2 * largest)
+        return (self.log_pmf[0, operations[..., 0]]
+                + self.log_pmf[1, operations[..., 1]]
+                + self.log_pmf[2, operations[..., 2]])
+
+    def likelihood(self, operations):
+        return np.exp(self.log_likelihood(operations))
+
+    def max_relevant_edits(self, threshold: float):
+        """
+        Largest total number of edits I + D + R whose best-case likelihood, maximised over every split i + d + r of
+        that total, still reaches threshold. Field names needing more edits than this can never pass the field
+        likelihood threshold. Returns None if no such bound exists (threshold <= 0).
+        """
+        if threshold <= 0:
+            return None
+        if threshold in self._max_edits:
+            return self._max_edits[threshold]
+        log_threshold = math.log(threshold)
+        # past the sum of the modes, every extra edit multiplies the best-case likelihood by at most max(lambda) / mode < 1
+        modes = int(np.floor(self.lambdas).sum())
+        max_edits = -1
+        k = 0
+        while True:
+            splits = np.array([(i, d, k - i - d) for i in range(k + 1) for d in range(k + 1 - i)])
+            if self.log_likelihood(splits).max() >= log_threshold:
+                max_edits = k
+            elif k >= modes:
+                self._max_edits[threshold] = max_edits
+                return max_edits
+            k += 1
+
+
+@functools.lru_cache(maxsize=8)
+def noise_model(ins_lambda: float, del_lambda: float, rep_lambda: float) -> NoiseModel:
+    return NoiseModel(ins_lambda, del_lambda, rep_lambda)
+
+
+def pairwise_edit_operations(str1_codes, str1_lengths, str2_codes, str2_lengths, max_edits=None):
+    """
+    Runs the levenshtein_distance recurrence for a batch of (str1, str2) pairs at once.
+
+    Pair k is str1_codes[k, :str1_lengths[k]] against str2_codes[k, :str2_lengths[k]], as returned by encode_strings.
+    The DP table is swept row by row with every pair vectorised along the last axis, and the tie-breaking is
+    identical to levenshtein_distance (insertion, then deletion, then replacement).
+
+    If max_edits is given, only the diagonal band |i - j| <= max_edits is computed (Ukkonen's cut-off), pairs whose
+    lengths differ by more than max_edits are skipped outright, and a pair is dropped as soon as every cell of its
+    current row exceeds max_edits. Pairs with a distance within max_edits get exactly the counts of the full table,
+    since every path of that cost stays inside the band. Pruned pairs are returned as [-1, -1, -1], and the work
+    skipped is added to PRUNING_STATS.
+
+    Returns an (n_pairs, 3) integer array of [insertions, deletions, replacements].
+    """
+    n_pairs = len(str1_lengths)
+    operations = np.zeros((n_pairs, 3), dtype=np.int64)
+    if n_pairs == 0:
+        return operations
+
+    m = str2_codes.shape[1]
+    band = m + str1_codes.shape[1] if max_edits is None else max_edits
+    unpruned = band + 1
+    unit = np.eye(3, dtype=np.int64)
+    full_cells = int((str1_lengths * str2_lengths).sum())
+    cells = 0
+
+    active = np.flatnonzero(np.abs(str1_lengths - str2_lengths) <= band)
+    length_pruned = n_pairs - len(active)
+    operations[:] = -1
+    str1_codes, str1_lengths = str1_codes[active], str1_lengths[active]
+    str2_codes, str2_lengths = str2_codes[active], str2_lengths[active]
+    # mask for the columns beyond the end of each str2, which no path to dp[n][m] goes through
+    beyond = np.arange(m + 1)[:, None] > str2_lengths[None, :]
+
+    # row 0 of the table: dp[0][j] = (j, [j, 0, 0])
+    prev_dist = np.repeat(np.arange(m + 1, dtype=np.int64)[:, None], len(active), axis=1)
+    prev_counts = np.zeros((m + 1, len(active), 3), dtype=np.int64)
+    prev_counts[:, :, 0] = prev_dist
+
+    done = str1_lengths == 0
+    operations[active[done]] = prev_counts[str2_lengths[done], np.flatnonzero(done)]
+    band_pruned = 0
+
+    for i in range(1, str1_codes.shape[1] + 1):
+        keep = ~done
+        if not keep.all():
+            active, str1_codes, str1_lengths = active[keep], str1_codes[keep], str1_lengths[keep]
+            str2_codes, str2_lengths, beyond = str2_codes[keep], str2_lengths[keep], beyond[:, keep]
+            prev_dist, prev_counts = prev_dist[:, keep], prev_counts[:, keep]
+        if len(active) == 0:
+            break
+
+        # cells outside the band keep a distance that can never be the minimum of a surviving path
+        dist = np.full_like(prev_dist, unpruned)
+        counts = np.zeros_like(prev_counts)
+        # column 0 of the table: dp[i][0] = (i, [0, i, 0])
+        dist[0] = i
+        counts[0] = [0, i, 0]
+
+        chars = str1_codes[:, i - 1]
+        first, last = max(1, i - band), min(m, i + band)
+        for j in range(first, last + 1):
+            inse, dele, repl = prev_dist[j], dist[j - 1], prev_dist[j - 1]
+            best = np.minimum(np.minimum(inse, dele), repl)
+            use_ins = inse == best
+            use_del = ~use_ins & (dele == best)
+            op = np.where(use_ins, 0, np.where(use_del, 1, 2))
+            edited = np.where(use_ins[:, None], prev_counts[j],
+                              np.where(use_del[:, None], counts[j - 1], prev_counts[j - 1])) + unit[op]
+
+            same = chars == str2_codes[:, j - 1]
+            dist[j] = np.where(same, repl, best + 1)
+            counts[j] = np.where(same[:, None], prev_counts[j - 1], edited)
+        cells += max(0, last - first + 1) * len(active)
+
+        finished = str1_lengths == i
+        rows = np.flatnonzero(finished)
+        final_dist = dist[str2_lengths[rows], rows]
+        matched = rows[final_dist <= band]
+        operations[active[matched]] = counts[str2_lengths[matched], matched]
+
+        # distances never decrease along a path, so once a whole row is over budget the pair cannot recover
+        over_budget = np.where(beyond, unpruned, dist).min(axis=0) > band
+        band_pruned += len(rows) - len(matched) + int((over_budget & ~finished).sum())
+        done = finished | over_budget
+        prev_dist, prev_counts = dist, counts
+
+    if max_edits is not None:
+        PRUNING_STATS["pairs"] += n_pairs
+        PRUNING_STATS["lengthPruned"] += length_pruned
+        PRUNING_STATS["bandPruned"] += band_pruned
+        PRUNING_STATS["cellsComputed"] += cells
+        PRUNING_STATS["cellsSkipped"] += max(0, full_cells - cells)
+    return operations
+
+
+def batch_edit_operations(candidates, target, max_edits=None):
+    """
+    Counts the insertions, deletions and replacements between every candidate and the target in one pass.
+
+    Equivalent to np.array([edit_distance(c, target) for c in candidates]), with shape (len(candidates), 3), except
+    that with max_edits set, candidates needing more than max_edits edits are returned as [-1, -1, -1].
+    """
+    str1_codes, str1_lengths = encode_strings(candidates)
+    str2_codes, str2_lengths = encode_strings([target])
+    n = len(candidates)
+    return pairwise_edit_operations(str1_codes, str1_lengths,
+                                    np.repeat(str2_codes, n, axis=0), np.repeat(str2_lengths, n), max_edits)
+
+
 def validate_payload(payload, param):
     var = payload.get(param)
     if not var:
@@ -101,49 +384,272 @@ def validate_payload(payload, param):
     return var
 
 
-def maximum_likelihood_field_name(bucket, file_name, field_name):
-    threshold_field_likelihood = float(os.environ["THRESHOLD_FIELD_LIKELIHOOD"])
-    threshold_posterior_field_likelihood = float(os.environ["THRESHOLD_POSTERIOR_FIELD_LIKELIHOOD"])
+# the raw-data columns field matching needs. The layout columns are optional, since raw data written before
+# processImage recorded them does not have them; matching then falls back to names and values alone.
+RAW_DATA_COLUMNS = ["Field Name", "Field Value"] + LAYOUT_COLUMNS
 
-    url = f"gs://{bucket}/{file_name}"
-    df = pd.read_csv(url)
-    raw_data = pd.DataFrame.copy(df)
 
-    field_names = raw_data["Field Name"]
-    field_names = field_names.apply(lambda x: x.lower())
+def csv_columns(columns: list = None):
+    """The usecols of pandas.read_csv that reads those of columns the file has, or every column if columns is None."""
+    return None if columns is None else (lambda column: column in columns)
+
 
+def raw_data_from_bytes(data: bytes, file_name: str, columns: list = None):
+    """
+    Reads raw data written by processImage as `arrow` or `parquet`. Only those of columns the file has are read: from
+    an Arrow IPC file without copying until the conversion to pandas, and from a Parquet file without decoding the
+    other columns.
+    """
+    import pyarrow as pa
+
+    if file_name.endswith(".arrow"):
+        table = pa.ipc.open_file(pa.py_buffer(data)).read_all()
+        if columns is not None:
+            table = table.select([column for column in columns if column in table.column_names])
+    elif file_name.endswith(".parquet"):
+        import pyarrow.parquet as pq
+        parquet_file = pq.ParquetFile(pa.BufferReader(data))
+        if columns is not None:
+            columns = [column for column in columns if column in parquet_file.schema_arrow.names]
+        table = parquet_file.read(columns=columns)
+    else:
+        raise ValueError(f"Unknown raw data format: {file_name}")
+    return table.to_pandas()
+
+
+def load_raw_data(bucket, file_name, columns: list = None):
+    """The raw data of bucket/file_name as written by processImage: `arrow`, `parquet`, or otherwise `csv`."""
+    import pandas as pd
+
+    if file_name.endswith((".arrow", ".parquet")):
+        data = get_storage_client().bucket(bucket).blob(file_name).download_as_bytes()
+        return raw_data_from_bytes(data, file_name, columns)
+    url = f"gs://{bucket}/{file_name}"
+    return pd.read_csv(url, usecols=csv_columns(columns))
+
+
+def is_empty_value(value) -> bool:
+    return value is None or (isinstance(value, float) and math.isnan(value)) or not str(value).strip()
+
+
+def nearest_value(raw_data, layout: LayoutIndex, row: int):
+    """
+    The row of the nearest non-empty value right of, or else below, the field name on row, or None. Used when Document
+    AI pairs a field name with an empty value because the value was laid out as a separate field.
+    """
+    name_box = raw_data[NAME_BOX_COLUMNS].iloc[row].to_numpy(dtype=float)
+    if np.isnan(name_box).any():
+        return None
+    page = raw_data["Page Number"].iloc[row]
+    values = raw_data["Field Value"]
+    for candidates in (layout.right_of(page, name_box), layout.below(page, name_box)):
+        for candidate in candidates:
+            if candidate != row and not is_empty_value(values.iloc[candidate]):
+                return candidate
+    return None
+
+
+def match_fields(raw_data, field_names):
+    """
+    Matches every requested field name against the extracted field names of one document.
+
+    All (requested, extracted) pairs are scored as a single matrix, so the document is read and lower-cased once
+    however many fields are requested. Returns a dict from each requested field name to either
+    {"value_string", "fieldNameLikelihood"} or the LikelihoodException explaining why it could not be matched.
+    """
+    threshold_field_likelihood = float(os.environ["THRESHOLD_FIELD_LIKELIHOOD"])
+    threshold_posterior_field_likelihood = float(os.environ["THRESHOLD_POSTERIOR_FIELD_LIKELIHOOD"])
     ins_lambda = float(os.environ["INS_LAMBDA"])
     del_lambda = float(os.environ["DEL_LAMBDA"])
     rep_lambda = float(os.environ["REP_LAMBDA"])
-    distances = np.array([(edit_distance(fn, field_name)) for fn in field_names])
+    model = noise_model(ins_lambda, del_lambda, rep_lambda)
+    max_edits = model.max_relevant_edits(threshold_field_likelihood)
+
+    extracted_names = list(raw_data["Field Name"].fillna("").str.lower())
+    n_extracted = len(extracted_names)
+    # built on the first empty matched value, if the raw data has the layout columns
+    layout = None
+    str1_codes, str1_lengths = encode_strings(extracted_names)
+    str2_codes, str2_lengths = encode_strings(list(field_names))
+    # row t of the matrix is field_names[t] against every extracted field name;
+    # field names needing more than max_edits edits are returned as -1, which has likelihood 0
+    distances = pairwise_edit_operations(
+        np.tile(str1_codes, (len(field_names), 1)), np.tile(str1_lengths, len(field_names)),
+        np.repeat(str2_codes, n_extracted, axis=0), np.repeat(str2_lengths, n_extracted),
+        max_edits
+    ).reshape(len(field_names), n_extracted, 3)
+    log_likelihood_matrix = model.log_likelihood(distances)
+
+    matches = {}
+    for field_name, log_likelihoods in zip(field_names, log_likelihood_matrix):
+        likelihoods = np.exp(log_likelihoods)
+
+        # Check if sufficiently high likelihood - parameter can be tuned
+        if np.max(likelihoods) < threshold_field_likelihood:
+            matches[field_name] = FieldLikelihoodThresholdException(float(np.max(likelihoods)))
+            continue
+
+        # normalise relative to the best candidate, so the sum cannot underflow to 0 for long field names
+        likelihoods = np.exp(log_likelihoods - log_likelihoods.max())
+        likelihoods /= np.sum(likelihoods)
+        # Check if maximum a posteriori likelihood reaches threshold
+        if np.max(likelihoods) < threshold_posterior_field_likelihood:
+            matches[field_name] = PosteriorLikelihoodThresholdException(float(np.max(likelihoods)))
+            continue
+
+        best = int(likelihoods.argmax())
+        value_row = best
+        if is_empty_value(raw_data["Field Value"].iloc[best]):
+            layout = LayoutIndex.from_raw_data(raw_data) if layout is None else layout
+            if layout is not None:
+                nearest = nearest_value(raw_data, layout, best)
+                value_row = best if nearest is None else nearest
+        matches[field_name] = {"value_string": raw_data["Field Value"].iloc[value_row],
+                               "fieldNameLikelihood": likelihoods[best]}
+
+    return matches
 
-    likelihoods_ins = scipy.stats.poisson.pmf(distances[:, 0], ins_lambda)
-    likelihoods_del = scipy.stats.poisson.pmf(distances[:, 1], del_lambda)
-    likelihoods_rep = scipy.stats.poisson.pmf(distances[:, 2], rep_lambda)
-    likelihoods = likelihoods_ins * likelihoods_del * likelihoods_rep
 
-    # Check if sufficiently high likelihood - parameter can be tuned
-    if np.max(likelihoods) < threshold_field_likelihood:
-        raise FieldLikelihoodThresholdException(float(np.max(likelihoods)))
+def maximum_likelihood_field_name(bucket, file_name, field_name):
+    match = match_fields(load_raw_data(bucket, file_name, RAW_DATA_COLUMNS), [field_name])[field_name]
+    if isinstance(match, LikelihoodException):
+        raise match
+    return match
+
+
+def field_name_error(e: LikelihoodException) -> dict:
+    if isinstance(e, FieldLikelihoodThresholdException):
+        threshold = os.environ["THRESHOLD_FIELD_LIKELIHOOD"]
+        description = f"No extracted field name with sufficiently high likelihood. Threshold: {threshold}. Actual: {e.likelihood}"
+    else:
+        posterior = os.environ['THRESHOLD_POSTERIOR_FIELD_LIKELIHOOD']
+        description = f"Maximum a posteriori field name does not meet likelihood threshold. Threshold: {posterior}. Actual: {e.likelihood}"
+    return {"success": False,
+            "error": {"type": "field name", "description": description},
+            "value": None,
+            "checks": None}
+
+
+class ResponseChannel:
+    """
+    Routes the replies of the value extraction functions to the request waiting for them.
+
+    Every extraction is tagged with a correlation ID, which the extraction function copies into the payload it
+    publishes back, together with the time after which nobody is waiting for it any more. This base class keeps the
+    futures of the pending extractions and resolves them as replies are delivered.
+    """
+    def __init__(self):
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def expect(self, correlation_id: str) -> Future:
+        future = Future()
+        with self._lock:
+            self._pending[correlation_id] = future
+        return future
+
+    def discard(self, correlation_id: str):
+        with self._lock:
+            self._pending.pop(correlation_id, None)
+
+    def deliver(self, payload: dict) -> bool:
+        """Resolves the future waiting on payload["correlationId"], returning whether there was one."""
+        reply = dict(payload)
+        correlation_id = reply.pop("correlationId", None)
+        reply.pop("expiresAt", None)
+        with self._lock:
+            future = self._pending.pop(correlation_id, None)
+        if future is None:
+            return False
+        future.set_result(reply)
+        return True
+
+
+class InMemoryResponseChannel(ResponseChannel):
+    """Stand-in for the result topic, for running without Pub/Sub: publishing a reply delivers it directly."""
+    def publish(self, payload: dict) -> bool:
+        return self.deliver(payload)
+
+
+class PubSubResponseChannel(ResponseChannel):
+    """
+    Receives replies through a subscription to the result topic of this instance alone, created and opened on first
+    use and kept open.
+
+    The subscription filters on the instanceId attribute the value extraction functions copy from the task, so it
+    only ever holds replies to this instance, and an idle instance holds nobody else's. Replies nobody is waiting for
+    any more are acked and dropped. The subscription is deleted by close() when the instance shuts down cleanly, and
+    by Pub/Sub after RESULT_SUBSCRIPTION_TTL seconds (default 86400, the minimum) without a subscriber otherwise. Given
+    only subscription_path, that existing subscription is used and never deleted. Setting PUBSUB_EMULATOR_HOST points
+    the client at the Pub/Sub emulator.
+    """
+    def __init__(self, subscription_path: str, topic_path: str = None, instance_id: str = None):
+        ResponseChannel.__init__(self)
+        self.subscription_path = subscription_path
+        self.topic_path = topic_path
+        self.instance_id = instance_id
+        self._subscription_created = topic_path is None
+        self._streaming_pull_future = None
+
+    def _create_subscription(self):
+        from google.api_core.exceptions import AlreadyExists
 
-    likelihoods /= np.sum(likelihoods)
-    # Check if maximum a posteriori likelihood reaches threshold
-    if np.max(likelihoods) < threshold_posterior_field_likelihood:
-        raise PosteriorLikelihoodThresholdException(float(np.max(likelihoods)))
+        try:
+            get_subscriber_client().create_subscription(request={
+                "name": self.subscription_path,
+                "topic": self.topic_path,
+                "filter": 'attributes.instanceId = "{}"'.format(self.instance_id),
+                "ack_deadline_seconds": 10,
+                "message_retention_duration": {"seconds": 600},
+                "expiration_policy": {"ttl": {"seconds": int(os.environ.get("RESULT_SUBSCRIPTION_TTL", "86400"))}},
+            })
+        except AlreadyExists:
+            pass
+        self._subscription_created = True
+
+    def expect(self, correlation_id: str) -> Future:
+        future = ResponseChannel.expect(self, correlation_id)
+        with self._lock:
+            if not self._subscription_created:
+                self._create_subscription()
+            if self._streaming_pull_future is None or self._streaming_pull_future.done():
+                self._streaming_pull_future = get_subscriber_client().subscribe(self.subscription_path,
+                                                                                callback=self._callback)
+        return future
+
+    def _callback(self, message: "pubsub_v1.subscriber.message.Message") -> None:
+        self.deliver(json.loads(message.data.decode('utf-8')))
+        message.ack()
+
+    def close(self):
+        """Stops receiving replies, and deletes the subscription if this channel created it."""
+        with self._lock:
+            if self._streaming_pull_future is not None:
+                self._streaming_pull_future.cancel()
+                self._streaming_pull_future = None
+            if self.topic_path is not None and self._subscription_created:
+                self._subscription_created = False
+                try:
+                    get_subscriber_client().delete_subscription(request={"subscription": self.subscription_path})
+                except Exception:
+                    logging.exception("Could not delete %s, which expires unused instead", self.subscription_path)
 
-    df["Field Name Posterior Likelihood"] = likelihoods
-    value_object = df.loc[df["Field Name Posterior Likelihood"].idxmax()]
-    value_str = value_object["Field Value"]
-    field_name_likelihood = value_object["Field Name Posterior Likelihood"]
 
-    return {"value_string": value_str, "fieldNameLikelihood": field_name_likelihood}
+RESPONSE_CHANNEL = None
 
 
-def cleanup(topic_paths, subscription_paths):
-    for topic_path in topic_paths:
-        PUB_CLIENT.delete_topic(request={"topic": topic_path})
-    for subscription_path in subscription_paths:
-        SUB_CLIENT.delete_subscription(request={"subscription": subscription_path})
+def get_response_channel() -> ResponseChannel:
+    """The channel of this instance, subscribed to RESULT_TOPIC as `{RESULT_SUBSCRIPTION}-{INSTANCE_ID}`."""
+    global RESPONSE_CHANNEL
+    if RESPONSE_CHANNEL is None:
+        project_id = os.environ["PROJECT_ID"]
+        subscription_path = get_subscriber_client().subscription_path(
+            project_id, "{}-{}".format(os.environ["RESULT_SUBSCRIPTION"], INSTANCE_ID))
+        topic_path = get_subscriber_client().topic_path(project_id, os.environ["RESULT_TOPIC"])
+        RESPONSE_CHANNEL = PubSubResponseChannel(subscription_path, topic_path, INSTANCE_ID)
+        # so the subscriptions of instances scaled in do not pile up towards the topic's limit
+        atexit.register(RESPONSE_CHANNEL.close)
+    return RESPONSE_CHANNEL
 
 
 def process_extracted_data(request):
@@ -158,7 +664,9 @@ def process_extracted_data(request):
             "QUEUE",
             "LOCATION",
             "PROJECT_ID",
-            "TIMEOUT"]
+            "TIMEOUT",
+            "RESULT_TOPIC",
+            "RESULT_SUBSCRIPTION"]
     for key in keys:
         assert os.environ[key]
 
@@ -168,85 +676,65 @@ def process_extracted_data(request):
     fields = validate_payload(payload, "fields")
     output_bucket = os.environ["OUTPUT_BUCKET"]
     output_filename = name.split(".", 1)[0]
+    # the name of the image in the image bucket, if processImage passed it on
+    image = payload.get("image")
 
     return_object = {"extractedFields": list(fields.keys())}
 
-    fs = []
-    subscription_paths = []
-    topic_paths = []
+    # field name -> (reply future, correlation ID, function name) of every extraction in flight
+    pending = {}
+    # field name -> (extractor, value string, function name) of every extraction run in-process
+    local = {}
+    result_topic = os.environ["RESULT_TOPIC"]
+    timeout = float(os.environ["TIMEOUT"])
+    # one deadline for the whole document, so its latency is that of the slowest extraction rather than their sum
+    deadline = time.time() + timeout
+
+    matches = match_fields(load_raw_data(bucket, name, RAW_DATA_COLUMNS), list(fields.keys()))
 
     for (field_name, function_name) in fields.items():
         return_object[field_name] = {}
         response = return_object[field_name]
-        project_id = os.environ["PROJECT_ID"]
-        topic_id = function_name + "_" + output_filename
-        topic_name = "projects/" + os.environ["PROJECT_ID"] + "/topics/" + topic_id
-        topic_path = PUB_CLIENT.topic_path(project_id, topic_id)
-        sub_name = "projects/" + os.environ["PROJECT_ID"] + "/subscriptions/" + topic_id
-        try:
-            topic = PUB_CLIENT.create_topic(request={"name": topic_name})
-            subscription = SUB_CLIENT.create_subscription(request={"name": sub_name, "topic": topic_name})
-            sub_path = SUB_CLIENT.subscription_path(project_id, topic_id)
-        except google.api_core.exceptions.AlreadyExists:
-            try:
-                subscription = SUB_CLIENT.create_subscription(request={"name": sub_name, "topic": topic_name})
-            except google.api_core.exceptions.AlreadyExists:
-                pass
-            sub_path = SUB_CLIENT.subscription_path(project_id, topic_id)
-
-        def callback_with_key(response_key: str):
-            def callback(message: pubsub_v1.subscriber.message.Message) -> None:
-                return_object[response_key] = json.loads(message.data.decode('utf-8'))
-                message.ack()
-                return
-            return callback
 
         try:
-            value = maximum_likelihood_field_name(bucket, name, field_name)
-            enqueue_value_extraction(value["value_string"], function_name, topic_id)
-            streaming_pull_future = SUB_CLIENT.subscribe(sub_path, callback=callback_with_key(field_name))
-            fs.append(streaming_pull_future)
-            topic_paths.append(topic_path)
-            subscription_paths.append(sub_path)
-
-        except FieldLikelihoodThresholdException as e:
-            likelihood = e.likelihood
-            threshold = os.environ["THRESHOLD_FIELD_LIKELIHOOD"]
-            response["success"] = False
-            response["error"] = {"type": "field name",
-                                 "description": f"No extracted field name with sufficiently high likelihood. Threshold: {threshold}. Actual: {likelihood}",
-                                 }
-            response["value"] = None
-            response["checks"] = None
-        except PosteriorLikelihoodThresholdException as e:
-            likelihood = e.likelihood
-            posterior = os.environ['THRESHOLD_POSTERIOR_FIELD_LIKELIHOOD']
-            response["success"] = False
-            response["error"] = {"type": "field name",
-                                 "description": f"Maximum a posteriori field name does not meet likelihood threshold. Threshold: {posterior}. Actual: {likelihood}",
-                                 }
-            response["value"] = None
-            response["checks"] = None
-
-        timeout = float(os.environ["TIMEOUT"])
-        with SUB_CLIENT:
-            for f in fs:
-                try:
-                    # When `timeout` is not set, result() will block indefinitely,
-                    # unless an exception is encountered first.
-                    f.result(timeout=timeout)
-                except TimeoutError:
-                    response["success"] = False
-                    response["error"] = {"type": "timeout",
-                                         "description": f"Field value match function did not terminate within specified timeout. Timeout: {timeout}. Function Name: {function_name}",
-                                         }
-                    response["value"] = None
-                    response["checks"] = None
-                    f.cancel()  # Trigger the shutdown.
-                    f.result()
-            cleanup(topic_paths, subscription_paths)
+            value = matches[field_name]
+            if isinstance(value, LikelihoodException):
+                raise value
+            extractor = get_value_extractor(function_name)
+            if extractor is not None:
+                local[field_name] = (extractor, value["value_string"], function_name)
+                continue
+            correlation_id = uuid.uuid4().hex
+            pending[field_name] = (get_response_channel().expect(correlation_id), correlation_id, function_name)
+            enqueue_value_extraction(value["value_string"], function_name, result_topic, correlation_id, deadline)
+
+        except LikelihoodException as e:
+            response.update(field_name_error(e))
+
+    # in-process extractions run while the remote ones are in flight
+    for field_name, (extractor, value_str, function_name) in local.items():
+        return_object[field_name] = run_value_extractor(extractor, value_str, function_name)
+
+    wait([f for f, _, _ in pending.values()], timeout=max(0.0, deadline - time.time()))
+
+    for field_name, (f, correlation_id, function_name) in pending.items():
+        if f.done():
+            return_object[field_name] = f.result()
+            continue
+        response = return_object[field_name]
+        response["success"] = False
+        response["error"] = {"type": "timeout",
+                             "description": f"Field value match function did not terminate within specified timeout. Timeout: {timeout}. Function Name: {function_name}",
+                             }
+        response["value"] = None
+        response["checks"] = None
+        # a late reply is dropped rather than written into return_object
+        get_response_channel().discard(correlation_id)
 
     filename = "{}.json".format(output_filename)
-    bucket = STORAGE_CLIENT.get_bucket(output_bucket)
+    bucket = get_storage_client().get_bucket(output_bucket)
     blob = bucket.blob(filename)
+    if image is not None:
+        # databaseUpload reads the image name from the metadata in its storage event
+        blob.metadata = {"image": image}
     blob.upload_from_string(json.dumps(return_object))
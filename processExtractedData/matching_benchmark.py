@@ -0,0 +1,167 @@
+"""
+Benchmarks field-name matching on synthetic OCR output.
+
+Synthetic raw-data CSVs are generated from the field names in sample_input.csv and ../dataAnalysis, each corrupted
+with the Poisson insertion/deletion/replacement noise model of the readme, using the lambdas fitted in
+./dataAnalysis. Each document hides one corrupted copy of the target field name among the distractors. For each
+document size, the benchmark records the latency and peak memory of maximum_likelihood_field_name and of the
+per-pair levenshtein_distance loop it replaced, and how often the hidden field is recovered.
+
+Usage: python processExtractedData/matching_benchmark.py [--sizes 10 100 1000 5000] [--trials 5] [--json results.json]
+"""
+import argparse
+import glob
+import json
+import math
+import os
+import random
+import string
+import tempfile
+import time
+import tracemalloc
+from unittest.mock import patch
+
+import main
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+FIELD_NAME_SOURCES = [os.path.join(HERE, "sample_input.csv")] + glob.glob(os.path.join(HERE, "..", "dataAnalysis", "*.csv"))
+
+# fitted in ./dataAnalysis, as in processExtractedData_tests.py and env.yaml
+ENV = {"INS_LAMBDA": "0.81489784",
+       "DEL_LAMBDA": "0.63088535",
+       "REP_LAMBDA": "0.60458837",
+       "THRESHOLD_FIELD_LIKELIHOOD": "0.1",
+       "THRESHOLD_POSTERIOR_FIELD_LIKELIHOOD": "0.7"}
+
+TARGET = "total weight"
+TARGET_VALUE = "1964.688Kgs"
+ALPHABET = string.ascii_letters + string.digits + " :.,"
+
+
+def poisson(lam: float, rng: random.Random) -> int:
+    # Knuth's method, which is fine for the small lambdas of the noise model
+    threshold, k, p = math.exp(-lam), 0, 1.0
+    while True:
+        p *= rng.random()
+        if p <= threshold:
+            return k
+        k += 1
+
+
+def corrupt(name: str, rng: random.Random, ins_lambda: float, del_lambda: float, rep_lambda: float) -> str:
+    """Applies I ~ Po(ins_lambda) insertions, D ~ Po(del_lambda) deletions and R ~ Po(rep_lambda) replacements."""
+    chars = list(name)
+    for _ in range(poisson(del_lambda, rng)):
+        if chars:
+            del chars[rng.randrange(len(chars))]
+    for _ in range(poisson(rep_lambda, rng)):
+        if chars:
+            chars[rng.randrange(len(chars))] = rng.choice(ALPHABET)
+    for _ in range(poisson(ins_lambda, rng)):
+        chars.insert(rng.randrange(len(chars) + 1), rng.choice(ALPHABET))
+    return "".join(chars)
+
+
+def real_field_names() -> list:
+    import pandas as pd
+
+    names = set()
+    for path in FIELD_NAME_SOURCES:
+        raw_data = pd.read_csv(path)
+        if "Field Name" in raw_data:
+            names.update(str(name) for name in raw_data["Field Name"].dropna())
+    return sorted(name for name in names if "weight" not in name.lower())
+
+
+def synthetic_document(n_fields: int, rng: random.Random, distractors: list):
+    """A raw-data DataFrame with n_fields rows, one of which is a corrupted copy of the target field name."""
+    import pandas as pd
+
+    lambdas = (float(ENV["INS_LAMBDA"]), float(ENV["DEL_LAMBDA"]), float(ENV["REP_LAMBDA"]))
+    names = [corrupt(rng.choice(distractors), rng, *lambdas) for _ in range(n_fields - 1)]
+    values = [f"value {i}" for i in range(n_fields - 1)]
+    position = rng.randrange(n_fields)
+    names.insert(position, corrupt("Total Weight", rng, *lambdas))
+    values.insert(position, TARGET_VALUE)
+    confidences = [rng.random() for _ in range(n_fields)]
+    return pd.DataFrame({"Field Name": names,
+                         "Field Name Confidence": confidences,
+                         "Field Value": values,
+                         "Field Value Confidence": confidences})
+
+
+def measure(function):
+    """Runs function twice: once timed, and once under tracemalloc for its peak memory, which slows it down."""
+    start = time.perf_counter()
+    result = function()
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def run(sizes: list, trials: int, seed: int, reference_limit: int) -> list:
+    import pandas as pd
+
+    rng = random.Random(seed)
+    distractors = real_field_names()
+    results = []
+    with tempfile.TemporaryDirectory() as directory, patch.dict(os.environ, ENV), \
+            patch("main.load_raw_data", lambda bucket, file_name, columns=None:
+                  pd.read_csv(os.path.join(bucket, file_name), usecols=main.csv_columns(columns))):
+        for n_fields in sizes:
+            row = {"fields": n_fields, "matchSeconds": 0.0, "matchPeakBytes": 0, "correct": 0, "rejected": 0,
+                   "referenceSeconds": None, "referencePeakBytes": None}
+            for trial in range(trials):
+                document = synthetic_document(n_fields, rng, distractors)
+                file_name = f"{n_fields}_{trial}.csv"
+                document.to_csv(os.path.join(directory, file_name))
+
+                def match():
+                    try:
+                        return main.maximum_likelihood_field_name(directory, file_name, TARGET)
+                    except main.LikelihoodException:
+                        return None
+                value, elapsed, peak = measure(match)
+                row["matchSeconds"] += elapsed / trials
+                row["matchPeakBytes"] = max(row["matchPeakBytes"], peak)
+                row["correct"] += value is not None and value["value_string"] == TARGET_VALUE
+                row["rejected"] += value is None
+
+                if n_fields <= reference_limit:
+                    names = [name.lower() for name in document["Field Name"]]
+                    _, elapsed, peak = measure(lambda: [main.levenshtein_distance(fn, TARGET) for fn in names])
+                    row["referenceSeconds"] = (row["referenceSeconds"] or 0.0) + elapsed / trials
+                    row["referencePeakBytes"] = max(row["referencePeakBytes"] or 0, peak)
+            row["accuracy"] = row["correct"] / trials
+            results.append(row)
+    return results
+
+
+def main_cli(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 50, 100, 500, 1000, 5000])
+    parser.add_argument("--trials", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--reference-limit", type=int, default=1000,
+                        help="largest document size to also time the per-pair levenshtein_distance loop on")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args(argv)
+
+    results = run(args.sizes, args.trials, args.seed, args.reference_limit)
+    print(f"{'fields':>8}{'match (ms)':>12}{'peak (KiB)':>12}{'levenshtein (ms)':>18}{'peak (KiB)':>12}"
+          f"{'accuracy':>10}{'rejected':>10}")
+    for row in results:
+        reference_ms = "-" if row["referenceSeconds"] is None else f"{row['referenceSeconds'] * 1000:.1f}"
+        reference_kib = "-" if row["referencePeakBytes"] is None else f"{row['referencePeakBytes'] / 1024:.0f}"
+        print(f"{row['fields']:>8}{row['matchSeconds'] * 1000:>12.1f}{row['matchPeakBytes'] / 1024:>12.0f}"
+              f"{reference_ms:>18}{reference_kib:>12}{row['accuracy']:>10.2f}{row['rejected']:>10}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -3,25 +3,32 @@ from unittest.mock import Mock
 from unittest.mock import patch
 from unittest import TestCase
 
+import math
 import os
 import sys
+import tempfile
+import time
 import pandas as pd
 import json
 
 sys.modules['google.cloud'] = Mock()
+import layout
 import main
 
 INPUTFILE_MOCK = Mock()
+STOCLIENT_MOCK = Mock()
+# replies published by the value extraction functions are delivered straight to the waiting request
+CHANNEL = main.InMemoryResponseChannel()
 
-# need to make mock for SUB_CLIENT compatible with 'with'
-class SubMock(Mock):
-    def __enter__(self, *args):
-        pass
-    def __exit__(self, *args):
-        pass
+REPLY = {"success": True, "error": None, "value": "1964.688", "checks": {"decimalPlaceCheck": True}}
+
+
+def reply_with(reply):
+    # stands in for enqueue_value_extraction, with the extraction function replying immediately
+    def enqueue(value_str, function_name, topic, correlation_id, expires_at):
+        CHANNEL.publish(dict(reply, correlationId=correlation_id, expiresAt=expires_at))
+    return enqueue
 
-SUBCLIENT_MOCK = SubMock()
-STOCLIENT_MOCK = Mock()
 
 @patch.dict(os.environ, {
             "PROJECT_ID":"id",
@@ -34,9 +41,11 @@ STOCLIENT_MOCK = Mock()
             "DEL_LAMBDA":"0.63088535",
             "INS_LAMBDA":"0.81489784",
             "THRESHOLD_FIELD_LIKELIHOOD":"0.1",
-            "THRESHOLD_POSTERIOR_FIELD_LIKELIHOOD":"0.7"})
+            "THRESHOLD_POSTERIOR_FIELD_LIKELIHOOD":"0.7",
+            "RESULT_TOPIC":"results",
+            "RESULT_SUBSCRIPTION":"results-sub"})
 @patch('pandas.read_csv', INPUTFILE_MOCK)
-@patch('main.SUB_CLIENT', SUBCLIENT_MOCK)
+@patch('main.RESPONSE_CHANNEL', CHANNEL)
 @patch('main.STORAGE_CLIENT', STOCLIENT_MOCK)
 @patch('main.enqueue_value_extraction')
 class TestExtractedDataProcessing(TestCase):
@@ -60,10 +69,152 @@ class TestExtractedDataProcessing(TestCase):
         STOCLIENT_MOCK.upload_from_string.side_effect = lambda x: assignReturn(json.loads(x))
 
 
-    def test_successCase(self, *args):
+    def test_successCase(self, enqueue_mock):
+        enqueue_mock.side_effect = reply_with(REPLY)
         main.process_extracted_data(self.request)
         self.assertEqual(self.message["extractedFields"], ["total weight"])
-        self.assertEqual(self.message["total weight"], {})
+        self.assertEqual(self.message["total weight"], REPLY)
+        self.assertEqual(enqueue_mock.call_args.args[:3], ("1964.688Kgs", "totalWeight", "results"))
+
+
+    def test_edgeCase_imageNameCarried(self, enqueue_mock):
+        enqueue_mock.side_effect = reply_with(REPLY)
+        STOCLIENT_MOCK.metadata = None
+        main.process_extracted_data(self.request)
+        self.assertIsNone(STOCLIENT_MOCK.metadata)
+
+        self.request.json["image"] = "file.jpg"
+        main.process_extracted_data(self.request)
+        self.assertEqual(STOCLIENT_MOCK.metadata, {"image": "file.jpg"})
+
+
+    @patch.dict(os.environ, {"TIMEOUT":"0.01"})
+    def test_failureCase_timeout(self, *args):
+        main.process_extracted_data(self.request)
+        self.assertFalse(self.message["total weight"]["success"])
+        self.assertEqual(self.message["total weight"]["error"]["type"], "timeout")
+        # a reply arriving after the timeout is not routed anywhere
+        correlation_id = args[0].call_args.args[3]
+        self.assertFalse(CHANNEL.publish(dict(REPLY, correlationId=correlation_id)))
+
+
+    @patch.dict(os.environ, {"TIMEOUT":"0.2"})
+    def test_edgeCase_sharedDeadline(self, enqueue_mock):
+        # only the total weight extraction replies; the other two share one deadline rather than waiting in turn
+        def enqueue(value_str, function_name, topic, correlation_id, expires_at):
+            if function_name == "totalWeight":
+                reply_with(REPLY)(value_str, function_name, topic, correlation_id, expires_at)
+        enqueue_mock.side_effect = enqueue
+        self.request.json["fields"] = {"total weight": "totalWeight", "vat no": "vatNumber", "printed": "printDate"}
+
+        start = time.time()
+        main.process_extracted_data(self.request)
+        self.assertLess(time.time() - start, 0.35)
+
+        self.assertEqual(self.message["total weight"], REPLY)
+        for field_name, function_name in [("vat no", "vatNumber"), ("printed", "printDate")]:
+            with self.subTest(test_data=field_name):
+                errormessage = self.message[field_name]["error"]
+                self.assertEqual(errormessage["type"], "timeout")
+                self.assertTrue(errormessage["description"].endswith(f"Function Name: {function_name}"))
+
+
+    def test_edgeCase_localValueExtractor(self, enqueue_mock):
+        extractor = Mock(return_value=REPLY)
+        module = Mock(extract_total_weight_from_string=extractor)
+        with patch.dict(sys.modules, {"totalWeight": module}), \
+                patch.dict(os.environ, {"LOCAL_VALUE_EXTRACTORS": "totalWeight=totalWeight:extract_total_weight_from_string"}), \
+                patch.dict(main.VALUE_EXTRACTORS, clear=True), \
+                patch("main._LOCAL_EXTRACTORS_LOADED", False):
+            main.process_extracted_data(self.request)
+
+        extractor.assert_called_once_with("1964.688Kgs")
+        enqueue_mock.assert_not_called()
+        self.assertEqual(self.message["total weight"], REPLY)
+
+
+    def test_edgeCase_genericValueExtractor(self, enqueue_mock):
+        extractor = Mock(return_value=REPLY)
+        self.request.json["fields"] = {"total weight": "fieldValue/weight", "vat no": "fieldValue/vatNumber"}
+        with patch.dict(main.VALUE_EXTRACTORS, {"fieldValue/*": extractor}):
+            main.process_extracted_data(self.request)
+
+        enqueue_mock.assert_not_called()
+        extractor.assert_any_call("1964.688Kgs", field_type="weight")
+        extractor.assert_any_call("263 3466 02", field_type="vatNumber")
+        self.assertEqual(self.message["vat no"], REPLY)
+
+
+    def test_failureCase_localValueExtractorError(self, enqueue_mock):
+        with patch.dict(main.VALUE_EXTRACTORS, {"totalWeight": Mock(side_effect=ValueError("bad value"))}):
+            main.process_extracted_data(self.request)
+
+        enqueue_mock.assert_not_called()
+        self.assertFalse(self.message["total weight"]["success"])
+        self.assertEqual(self.message["total weight"]["error"]["description"],
+                         "Field value match function failed. Function Name: totalWeight. Error: bad value")
+
+
+    def test_edgeCase_batchProcessFile(self, *args):
+        import batch
+        with tempfile.TemporaryDirectory() as output_dir, \
+                patch.dict(main.VALUE_EXTRACTORS, {"totalWeight": Mock(return_value=REPLY)}):
+            timings = batch.process_file("processExtractedData/sample_input.csv", output_dir,
+                                         {"total weight": "totalWeight", "delivery date": "totalWeight"})
+            with open(os.path.join(output_dir, "sample_input.json")) as f:
+                output = json.load(f)
+
+        self.assertEqual(set(timings.keys()), set(batch.STAGES))
+        self.assertEqual(output["extractedFields"], ["total weight", "delivery date"])
+        self.assertEqual(output["total weight"], REPLY)
+        self.assertEqual(output["delivery date"]["error"]["type"], "field name")
+
+
+    def test_edgeCase_pubSubReplyRouting(self, *args):
+        channel = main.PubSubResponseChannel("subscription")
+        future = channel.expect("waiting")
+        testCases = [
+            {"correlationId": "waiting", "expiresAt": 2e9},
+            {"correlationId": "timed out", "expiresAt": 0}]
+
+        # the subscription only holds this instance's replies, so every one is acked, awaited or not
+        for payload in testCases:
+            with self.subTest(test_data=payload):
+                message = Mock(data=json.dumps(dict(REPLY, **payload)).encode('utf-8'))
+                channel._callback(message)
+                message.ack.assert_called_once()
+                message.nack.assert_not_called()
+        self.assertEqual(future.result(timeout=0), REPLY)
+
+
+    @patch.dict(os.environ, {"RESULT_SUBSCRIPTION_TTL":"90000"})
+    def test_edgeCase_instanceSubscription(self, *args):
+        subscriber = Mock()
+        subscriber.subscription_path.side_effect = lambda project, name: f"projects/{project}/subscriptions/{name}"
+        subscriber.topic_path.side_effect = lambda project, name: f"projects/{project}/topics/{name}"
+        subscriber.subscribe.return_value.done.return_value = False
+        with patch("main.SUB_CLIENT", subscriber), patch("main.RESPONSE_CHANNEL", None), \
+                patch("main.atexit.register") as register:
+            channel = main.get_response_channel()
+            register.assert_called_once_with(channel.close)
+            for correlation_id in ["a", "b", "c"]:
+                channel.expect(correlation_id)
+
+        # one subscription per instance, not per field, receiving only the replies tagged with its instance ID
+        subscriber.create_subscription.assert_called_once()
+        request = subscriber.create_subscription.call_args.kwargs["request"]
+        self.assertEqual(request["name"], f"projects/id/subscriptions/results-sub-{main.INSTANCE_ID}")
+        self.assertEqual(request["topic"], "projects/id/topics/results")
+        self.assertEqual(request["filter"], f'attributes.instanceId = "{main.INSTANCE_ID}"')
+        self.assertEqual(request["expiration_policy"], {"ttl": {"seconds": 90000}})
+        subscriber.subscribe.assert_called_once_with(request["name"], callback=channel._callback)
+
+        # a clean shutdown deletes it, once
+        with patch("main.SUB_CLIENT", subscriber):
+            channel.close()
+            channel.close()
+        subscriber.delete_subscription.assert_called_once_with(request={"subscription": request["name"]})
+        subscriber.subscribe.return_value.cancel.assert_called_once()
 
 
     def test_failureCase_lowFieldLikelihood(self, *args):
@@ -85,6 +236,132 @@ class TestExtractedDataProcessing(TestCase):
                 self.assertEqual(errormessage["description"], "Maximum a posteriori field name does not meet likelihood threshold. Threshold: 0.7. Actual: 0.2")
 
 
+    def test_edgeCase_batchEditOperations(self, *args):
+        field_names = [name.lower() for name in INPUTFILE_MOCK.return_value["Field Name"]] + ["", "total  weight"]
+        testCases = ["total weight", "vat no", "t", ""]
+
+        for test in testCases:
+            with self.subTest(test_data=test):
+                expected = [list(main.edit_distance(fn, test)) for fn in field_names]
+                self.assertEqual(main.batch_edit_operations(field_names, test).tolist(), expected)
+
+
+    def test_edgeCase_bandedEditOperations(self, *args):
+        field_names = [name.lower() for name in INPUTFILE_MOCK.return_value["Field Name"]]
+        expected = [list(main.edit_distance(fn, "total weight")) for fn in field_names]
+        pruned_before = main.PRUNING_STATS["lengthPruned"] + main.PRUNING_STATS["bandPruned"]
+
+        operations = main.batch_edit_operations(field_names, "total weight", max_edits=1).tolist()
+        for fn, ops, exp in zip(field_names, operations, expected):
+            with self.subTest(test_data=fn):
+                if sum(exp) <= 1:
+                    self.assertEqual(ops, exp)
+                else:
+                    self.assertEqual(ops, [-1, -1, -1])
+        pruned = main.PRUNING_STATS["lengthPruned"] + main.PRUNING_STATS["bandPruned"] - pruned_before
+        self.assertEqual(pruned, len(field_names) - 1)
+
+
+    def test_edgeCase_maxRelevantEdits(self, *args):
+        # with the fitted lambdas, Po(0) * Po(0) * Po(0) = 0.129 and the best single edit gives 0.105
+        model = main.NoiseModel(0.81489784, 0.63088535, 0.60458837)
+        self.assertEqual(model.max_relevant_edits(0.1), 1)
+        self.assertEqual(model.max_relevant_edits(0.2), -1)
+        self.assertIsNone(model.max_relevant_edits(0))
+
+
+    def test_edgeCase_noiseModelLikelihood(self, *args):
+        model = main.NoiseModel(0.81489784, 0.63088535, 0.60458837, max_count=4)
+        operations = [[0, 0, 0], [1, 2, 0], [0, 0, 9], [-1, -1, -1]]
+        lambdas = [0.81489784, 0.63088535, 0.60458837]
+        expected = [math.prod(lam ** k * math.exp(-lam) / math.factorial(k) for lam, k in zip(lambdas, ops))
+                    for ops in operations[:3]] + [0.0]
+
+        for ops, likelihood, exp in zip(operations, model.likelihood(operations), expected):
+            with self.subTest(test_data=ops):
+                self.assertAlmostEqual(likelihood, exp)
+
+
+    def test_edgeCase_matchAllFields(self, *args):
+        INPUTFILE_MOCK.reset_mock()
+        raw_data = main.load_raw_data("b", "file")
+        matches = main.match_fields(raw_data, ["total weight", "vat no", "delivery date"])
+
+        self.assertEqual(INPUTFILE_MOCK.call_count, 1)
+        self.assertEqual(matches["total weight"]["value_string"], "1964.688Kgs")
+        self.assertEqual(matches["vat no"]["value_string"], "263 3466 02")
+        self.assertIsInstance(matches["delivery date"], main.FieldLikelihoodThresholdException)
+        for field_name in ["total weight", "vat no"]:
+            with self.subTest(test_data=field_name):
+                self.assertEqual(matches[field_name], main.maximum_likelihood_field_name("b", "file", field_name))
+
+
+    def test_edgeCase_binaryRawData(self, *args):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        raw_data = pd.read_csv("processExtractedData/sample_input.csv", index_col=0)
+        table = pa.Table.from_pandas(raw_data, preserve_index=False)
+        arrow, parquet = pa.BufferOutputStream(), pa.BufferOutputStream()
+        with pa.ipc.new_file(arrow, table.schema) as writer:
+            writer.write_table(table)
+        pq.write_table(table, parquet)
+        expected = main.match_fields(raw_data, ["total weight", "vat no"])
+
+        INPUTFILE_MOCK.reset_mock()
+        for file_name, data in [("file.arrow", arrow.getvalue().to_pybytes()), ("file.parquet", parquet.getvalue().to_pybytes())]:
+            STOCLIENT_MOCK.bucket.return_value.blob.return_value.download_as_bytes.return_value = data
+            with self.subTest(test_data=file_name):
+                loaded = main.load_raw_data("b", file_name, main.RAW_DATA_COLUMNS)
+                # the sample predates the layout columns, which are skipped rather than failing the read
+                self.assertEqual(list(loaded.columns), ["Field Name", "Field Value"])
+                self.assertEqual(main.match_fields(loaded, ["total weight", "vat no"]), expected)
+        INPUTFILE_MOCK.assert_not_called()
+
+
+    def test_edgeCase_layoutIndex(self, *args):
+        import numpy as np
+        rng = np.random.default_rng(0)
+        corners = rng.random((500, 2)) * 0.9
+        boxes = np.hstack([corners, corners + rng.random((500, 2)) * 0.1])
+        boxes[::50] = np.nan
+        pages = rng.integers(1, 3, 500)
+        index = main.LayoutIndex(pages, boxes)
+
+        def scan(page, box, start, overlap_low, overlap_high):
+            # brute force over every box, as the index should answer
+            hits = [i for i in range(len(boxes)) if pages[i] == page and not np.isnan(boxes[i]).any()
+                    and boxes[i, start] >= box[start + 2] and boxes[i, overlap_low] <= box[overlap_high]
+                    and boxes[i, overlap_high] >= box[overlap_low]]
+            return sorted(hits, key=lambda i: (boxes[i, start] - box[start + 2], i))
+
+        for page, box in zip(pages[:40], boxes[1:41]):
+            with self.subTest(test_data=(page, list(box))):
+                self.assertEqual(index.right_of(page, box), scan(page, box, 0, 1, 3))
+                self.assertEqual(index.below(page, box), scan(page, box, 1, 0, 2))
+
+
+    def test_edgeCase_layoutValueFallback(self, *args):
+        raw_data = pd.DataFrame({
+            "Field Name": ["Total Weight", "", "Vat No", ""],
+            "Field Value": ["", "1964.688Kgs", None, "263 3466 02"],
+            "Page Number": [1, 1, 1, 2]})
+        name_boxes = [[0.1, 0.50, 0.3, 0.52], [float("nan")] * 4, [0.1, 0.1, 0.2, 0.12], [float("nan")] * 4]
+        value_boxes = [[float("nan")] * 4, [0.4, 0.49, 0.6, 0.53], [float("nan")] * 4, [0.1, 0.15, 0.3, 0.17]]
+        for side, name_side, value_side in zip(layout.BOX_SIDES, zip(*name_boxes), zip(*value_boxes)):
+            raw_data[f"Field Name {side}"] = name_side
+            raw_data[f"Field Value {side}"] = value_side
+
+        matches = main.match_fields(raw_data, ["total weight", "vat no"])
+        self.assertEqual(matches["total weight"]["value_string"], "1964.688Kgs")
+        # the only value below the VAT number name is on another page
+        self.assertTrue(main.is_empty_value(matches["vat no"]["value_string"]))
+
+        raw_data.loc[3, "Page Number"] = 1
+        self.assertEqual(main.match_fields(raw_data, ["vat no"])["vat no"]["value_string"], "263 3466 02")
+        # without the layout columns the matched, empty value is returned as before
+        self.assertEqual(main.match_fields(raw_data[["Field Name", "Field Value"]], ["total weight"])["total weight"]["value_string"], "")
+
+
     def test_failureCase_malformedRequest(self, *args):
         testCases = [
             {"bucket":"b", "name":"n"},
@@ -0,0 +1,97 @@
+"""
+Compares the raw-data formats processImage can write to `gpr_raw_data`: bytes on the wire, and the time
+processExtractedData takes to parse them.
+
+Synthetic documents are generated as in matching_benchmark.py, with page numbers, and encoded with
+processImage's encode_raw_data. For each document size and format, the benchmark records the encoded size and the
+median time to read the columns field matching needs (load_raw_data's path after the download). For CSV it also
+times reading every column, as processExtractedData did before.
+
+Usage: python processExtractedData/raw_data_benchmark.py [--sizes 10 100 1000 10000] [--repeats 20] [--json results.json]
+"""
+import argparse
+import importlib.util
+import io
+import json
+import os
+import random
+import statistics
+import sys
+import time
+
+import main
+from matching_benchmark import real_field_names, synthetic_document
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+PROCESS_IMAGE = os.path.join(os.path.dirname(HERE), "processImage")
+FORMATS = ["csv", "arrow", "parquet"]
+
+
+def load_process_image():
+    # processImage is deployed separately and also has a main.py, so it is loaded under its own name
+    sys.path.insert(0, PROCESS_IMAGE)
+    spec = importlib.util.spec_from_file_location("processImage", os.path.join(PROCESS_IMAGE, "main.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def median_seconds(function, repeats: int) -> float:
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def run(sizes: list, repeats: int, seed: int) -> list:
+    import pandas as pd
+
+    process_image = load_process_image()
+    rng = random.Random(seed)
+    distractors = real_field_names()
+    results = []
+    for n_fields in sizes:
+        document = synthetic_document(n_fields, rng, distractors)
+        document["Page Number"] = sorted(rng.randrange(1, max(2, n_fields // 30) + 1) for _ in range(n_fields))
+        for raw_data_format in FORMATS:
+            data = process_image.encode_raw_data(document, raw_data_format)
+            data = data.encode("utf-8") if isinstance(data, str) else data
+            if raw_data_format == "csv":
+                def read():
+                    return pd.read_csv(io.BytesIO(data), usecols=main.csv_columns(main.RAW_DATA_COLUMNS))
+            else:
+                def read():
+                    return main.raw_data_from_bytes(data, f"document.{raw_data_format}", main.RAW_DATA_COLUMNS)
+            # CSV loses the distinction between empty and missing names, which field matching treats alike
+            assert read()["Field Name"].fillna("").tolist() == document["Field Name"].tolist()
+            row = {"fields": n_fields, "format": raw_data_format, "bytes": len(data),
+                   "readSeconds": median_seconds(read, repeats)}
+            if raw_data_format == "csv":
+                row["readAllColumnsSeconds"] = median_seconds(lambda: pd.read_csv(io.BytesIO(data)), repeats)
+            results.append(row)
+    return results
+
+
+def main_cli(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000, 10000])
+    parser.add_argument("--repeats", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args(argv)
+
+    results = run(args.sizes, args.repeats, args.seed)
+    print(f"{'fields':>8}{'format':>10}{'KiB':>10}{'read (ms)':>12}{'read all columns (ms)':>24}")
+    for row in results:
+        read_all = f"{row['readAllColumnsSeconds'] * 1000:.2f}" if "readAllColumnsSeconds" in row else "-"
+        print(f"{row['fields']:>8}{row['format']:>10}{row['bytes'] / 1024:>10.1f}{row['readSeconds'] * 1000:>12.2f}"
+              f"{read_all:>24}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,65 @@
+"""
+Stand-in for the batch interface of Document AI's DocumentProcessorServiceClient, for tests and for running without
+Document AI.
+
+LocalDocumentProcessorClient.batch_process_documents "processes" each input document with ocr, a function from the
+document's gs:// URI to the Document JSON, writes the result through storage_client where Document AI would, and
+returns an operation that reports one more document processed on every poll. get_operation looks an operation up by
+name, as main.get_batch_operation does for Document AI's.
+"""
+from types import SimpleNamespace
+
+
+class LocalBatchOperation:
+    def __init__(self, name: str, statuses: list):
+        self.operation = SimpleNamespace(name=name)
+        self.metadata = SimpleNamespace(individual_process_statuses=[])
+        self._statuses = statuses
+
+    def done(self) -> bool:
+        reported = self.metadata.individual_process_statuses
+        if len(reported) < len(self._statuses):
+            reported.append(self._statuses[len(reported)])
+        return len(reported) == len(self._statuses)
+
+    def exception(self):
+        return None
+
+
+class LocalDocumentProcessorClient:
+    def __init__(self, ocr, storage_client):
+        self.ocr = ocr
+        self.storage_client = storage_client
+        self.operations = []
+
+    def processor_path(self, project_id: str, location: str, processor_id: str) -> str:
+        return f"projects/{project_id}/locations/{location}/processors/{processor_id}"
+
+    def processor_version_path(self, project_id: str, location: str, processor_id: str, processor_version: str) -> str:
+        return f"{self.processor_path(project_id, location, processor_id)}/processorVersions/{processor_version}"
+
+    def batch_process_documents(self, request) -> LocalBatchOperation:
+        name = f"{request.name}/operations/{len(self.operations)}"
+        output_uri = request.document_output_config.gcs_output_config.gcs_uri.rstrip("/")
+        bucket, _, prefix = output_uri[len("gs://"):].partition("/")
+        statuses = []
+        for index, document in enumerate(request.input_documents.gcs_documents.documents):
+            try:
+                data = self.ocr(document.gcs_uri)
+            except Exception as e:
+                statuses.append(SimpleNamespace(input_gcs_source=document.gcs_uri, output_gcs_destination="",
+                                                status=SimpleNamespace(code=13, message=str(e))))
+                continue
+            # Document AI writes each document's shards under [output_uri]/[operation id]/[index]/
+            destination = f"{prefix}/{len(self.operations)}/{index}"
+            document_name = document.gcs_uri.rsplit("/", 1)[-1].split(".", 1)[0]
+            self.storage_client.bucket(bucket).blob(f"{destination}/{document_name}-0.json").upload_from_string(data)
+            statuses.append(SimpleNamespace(input_gcs_source=document.gcs_uri,
+                                            output_gcs_destination=f"gs://{bucket}/{destination}",
+                                            status=SimpleNamespace(code=0, message="")))
+        operation = LocalBatchOperation(name, statuses)
+        self.operations.append(operation)
+        return operation
+
+    def get_operation(self, name: str) -> LocalBatchOperation:
+        return next(operation for operation in self.operations if operation.operation.name == name)
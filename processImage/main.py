@@ -1,15 +1,88 @@
-import pandas
-from google.api_core.client_options import ClientOptions
-from google.cloud import documentai_v1 as documentai
-from google.cloud import storage
-import pandas as pd
-import gcsfs
+import math
 import os
 import json
-from google.cloud import tasks_v2beta3 as tasks
+import hashlib
+import logging
+import re
+import threading
+import time
+from datetime import datetime, timezone
+from typing import TYPE_CHECKING
+from google.api_core.client_options import ClientOptions
+
+from ocr_cache import OcrCache, cache_key
+from preprocess import preprocess_image, preprocessing_enabled
+
+if TYPE_CHECKING:
+    import pandas
+    from google.cloud import documentai_v1 as documentai
+
+STORAGE_CLIENT = None
+TASK_CLIENT = None
+# Document AI API endpoint -> client, each keeping its gRPC channel open for the life of the instance
+DOCUMENT_AI_CLIENTS = {}
+# endpoint -> the lock held while its client is created and connected, which only holds up requests for that endpoint
+DOCUMENT_AI_CLIENT_LOCKS = {}
+DOCUMENT_AI_CLIENTS_LOCK = threading.Lock()
+OCR_CACHE = None
+
+
+def get_storage_client():
+    global STORAGE_CLIENT
+    if STORAGE_CLIENT is None:
+        from google.cloud import storage
+        STORAGE_CLIENT = storage.Client()
+    return STORAGE_CLIENT
+
+
+def get_task_client():
+    global TASK_CLIENT
+    if TASK_CLIENT is None:
+        from google.cloud import tasks_v2beta3 as tasks
+        TASK_CLIENT = tasks.CloudTasksClient()
+    return TASK_CLIENT
+
+
+def connect_channel(client, timeout: float):
+    """Connects client's gRPC channel, which would otherwise only connect on the first call, and waits until it is ready."""
+    import grpc
+
+    grpc.channel_ready_future(client.transport.grpc_channel).result(timeout=timeout)
+
 
-STORAGE_CLIENT = storage.Client()
-TASK_CLIENT = tasks.CloudTasksClient()
+def get_document_ai_client(location: str) -> "documentai.DocumentProcessorServiceClient":
+    """
+    The client of location's endpoint. A new client is connected before it is returned, so the first request for an
+    endpoint pays for the connection here rather than in its first call.
+    """
+    api_endpoint = f"{location}-documentai.googleapis.com"
+    client = DOCUMENT_AI_CLIENTS.get(api_endpoint)
+    if client is not None:
+        return client
+    with DOCUMENT_AI_CLIENTS_LOCK:
+        endpoint_lock = DOCUMENT_AI_CLIENT_LOCKS.setdefault(api_endpoint, threading.Lock())
+    with endpoint_lock:
+        if api_endpoint not in DOCUMENT_AI_CLIENTS:
+            from google.cloud import documentai_v1 as documentai
+            opts = ClientOptions(api_endpoint=api_endpoint)
+            client = documentai.DocumentProcessorServiceClient(client_options=opts)
+            # a client that failed to connect is not kept, so the next request tries again
+            connect_channel(client, float(os.environ.get("DOCUMENT_AI_CONNECT_TIMEOUT", "10")))
+            DOCUMENT_AI_CLIENTS[api_endpoint] = client
+        return DOCUMENT_AI_CLIENTS[api_endpoint]
+
+
+def get_ocr_cache() -> OcrCache:
+    global OCR_CACHE
+    if OCR_CACHE is None:
+        OCR_CACHE = OcrCache(int(os.environ.get("OCR_CACHE_SIZE", "128")), get_storage_client(),
+                             os.environ.get("OCR_CACHE_BUCKET"))
+    return OCR_CACHE
+
+
+def server_timing(timings: dict) -> str:
+    """Per-request timings as a Server-Timing header value, in milliseconds."""
+    return ", ".join(f"{name};dur={seconds * 1000:.1f}" for name, seconds in timings.items())
 
 
 def validate_payload(payload, param):
@@ -24,24 +97,54 @@ def validate_payload(payload, param):
     return var
 
 
-def enqueue_field_match(output_bucket: str, output_file_name: str, fields: dict):
+def enqueue_task(url: str, payload: dict, task_id: str = None, delay: float = 0):
+    """
+    Enqueues a POST of payload to url. A task_id names the task, so enqueueing it again, as a retried request would,
+    is ignored. Returns False if a task named task_id was enqueued before.
+    """
+    from google.api_core.exceptions import AlreadyExists
+    from google.cloud import tasks_v2beta3 as tasks
+
     service_account_email = os.environ["SAE"]+"@appspot.gserviceaccount.com"
     project_id = os.environ["PROJECT_ID"]
     queue = os.environ["QUEUE"]
     location = os.environ["LOCATION"]
-    url = os.environ["URL"]
-    payload = {"bucket": output_bucket, "name": output_file_name, "fields": fields}
-    formatted_parent = TASK_CLIENT.queue_path(project_id, location, queue)
+    formatted_parent = get_task_client().queue_path(project_id, location, queue)
 
     http_request = tasks.HttpRequest(url=url,
                                      oidc_token=tasks.OidcToken(service_account_email=service_account_email),
                                      headers={"Content-Type": "application/json"},
                                      body=json.dumps(payload).encode('utf-8')
                                      )
-    task = tasks.Task(http_request=http_request)
+    options = {}
+    if task_id is not None:
+        options["name"] = f"{formatted_parent}/tasks/{task_id}"
+    if delay:
+        options["schedule_time"] = datetime.fromtimestamp(time.time() + delay, tz=timezone.utc)
+    task = tasks.Task(http_request=http_request, **options)
     request = tasks.CreateTaskRequest(parent=formatted_parent, task=task)
 
-    response = TASK_CLIENT.create_task(request)
+    try:
+        get_task_client().create_task(request)
+    except AlreadyExists:
+        return False
+    return True
+
+
+def enqueue_field_match(output_bucket: str, output_file_name: str, fields: dict, image: str = None):
+    payload = {"bucket": output_bucket, "name": output_file_name, "fields": fields}
+    if image is not None:
+        # carried through to the sanitised data, so databaseUpload need not look the image up
+        payload["image"] = image
+    enqueue_task(os.environ["URL"], payload)
+
+
+def processor_name(client, project_id: str, location: str, processor_id: str) -> str:
+    """The processor's PROCESSOR_VERSION if it is set, else the processor itself, which runs its default version."""
+    processor_version = os.environ.get("PROCESSOR_VERSION")
+    if processor_version:
+        return client.processor_version_path(project_id, location, processor_id, processor_version)
+    return client.processor_path(project_id, location, processor_id)
 
 
 def parse_document(
@@ -52,16 +155,37 @@ def parse_document(
         file_name: str,
         mime_type: str,
         field_mask: str = None,
-) -> documentai.Document:
-    opts = ClientOptions(api_endpoint=f"{location}-documentai.googleapis.com")
+        timings: dict = None,
+        image_bytes: dict = None,
+        image_content: bytes = None,
+) -> "documentai.Document":
+    """
+    OCRs the image at bucket/file_name, or image_content if it has already been downloaded. If timings is given, the
+    seconds spent getting a client (`connect`, which only includes creating and connecting it on the first request for
+    an endpoint), downloading the image (`download`), pre-processing it if enabled (`preprocess`) and in the Document
+    AI call (`ocr`) are recorded in it. If image_bytes is given, the size of the image as downloaded (`original`) and
+    as sent to Document AI (`sent`) are recorded in it.
+    """
+    from google.cloud import documentai_v1 as documentai
 
-    client = documentai.DocumentProcessorServiceClient(client_options=opts)
+    timings = {} if timings is None else timings
+    start = time.perf_counter()
+    client = get_document_ai_client(location)
+    name = processor_name(client, project_id, location, processor_id)
+    timings["connect"] = time.perf_counter() - start
 
-    name = client.processor_path(project_id, location, processor_id)
+    if image_content is None:
+        start = time.perf_counter()
+        image_content = get_storage_client().bucket(bucket).blob(file_name).download_as_bytes()
+        timings["download"] = time.perf_counter() - start
 
-    fs = gcsfs.GCSFileSystem(project=project_id)
-    with fs.open(f"{bucket}/{file_name}") as image:
-        image_content = image.read()
+    image_bytes = {} if image_bytes is None else image_bytes
+    image_bytes["original"] = len(image_content)
+    if preprocessing_enabled():
+        start = time.perf_counter()
+        image_content, mime_type = preprocess_image(image_content, mime_type)
+        timings["preprocess"] = time.perf_counter() - start
+    image_bytes["sent"] = len(image_content)
 
     raw_document = documentai.RawDocument(content=image_content, mime_type=mime_type)
 
@@ -69,50 +193,102 @@ def parse_document(
         name=name, raw_document=raw_document, field_mask=field_mask
     )
 
+    start = time.perf_counter()
     result = client.process_document(request=request)
+    timings["ocr"] = time.perf_counter() - start
 
     return result.document
 
 
-def save_data(output_bucket: str, output_file_name: str, dataframe: pandas.DataFrame, fields: dict):
-    csv = dataframe.to_csv()
-    filename = "{}.csv".format(output_file_name)
-    bucket = STORAGE_CLIENT.get_bucket(output_bucket)
+# the raw-data columns and their types in the binary formats
+BOX_SIDES = ["Left", "Top", "Right", "Bottom"]
+RAW_DATA_COLUMNS = [("Field Name", "string"), ("Field Name Confidence", "float32"), ("Field Value", "string"),
+                    ("Field Value Confidence", "float32"), ("Page Number", "int32")] + \
+                   [(f"Field {part} {side}", "float32") for part in ["Name", "Value"] for side in BOX_SIDES]
+RAW_DATA_CONTENT_TYPES = {"csv": "text/csv",
+                          "arrow": "application/vnd.apache.arrow.file",
+                          "parquet": "application/vnd.apache.parquet"}
+
+
+def encode_raw_data(dataframe: "pandas.DataFrame", raw_data_format: str):
+    """
+    The field table as `csv` (with the pandas index, as the existing tools expect), or as typed columns in an
+    uncompressed Arrow IPC file (`arrow`), which can be read without copying, or in a zstd-compressed Parquet file
+    (`parquet`), which is smallest on the wire.
+    """
+    if raw_data_format == "csv":
+        return dataframe.to_csv()
+    if raw_data_format not in RAW_DATA_CONTENT_TYPES:
+        raise ValueError(f"Unknown RAW_DATA_FORMAT {raw_data_format}. Expected one of {', '.join(RAW_DATA_CONTENT_TYPES)}")
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    # field tables cached before a column was added are written without it
+    schema = pa.schema([(name, getattr(pa, type_name)()) for name, type_name in RAW_DATA_COLUMNS
+                        if name in dataframe.columns])
+    table = pa.Table.from_pandas(dataframe[schema.names], schema=schema, preserve_index=False)
+    sink = pa.BufferOutputStream()
+    if raw_data_format == "arrow":
+        with pa.ipc.new_file(sink, schema) as writer:
+            writer.write_table(table)
+    else:
+        pq.write_table(table, sink, compression="zstd")
+    return sink.getvalue().to_pybytes()
+
+
+def save_data(output_bucket: str, output_file_name: str, dataframe: "pandas.DataFrame", fields: dict,
+              image: str = None):
+    raw_data_format = os.environ.get("RAW_DATA_FORMAT", "csv")
+    data = encode_raw_data(dataframe, raw_data_format)
+    filename = "{}.{}".format(output_file_name, raw_data_format)
+    bucket = get_storage_client().get_bucket(output_bucket)
     blob = bucket.blob(filename)
-    blob.upload_from_string(csv)
-    enqueue_field_match(output_bucket, filename, fields)
+    blob.upload_from_string(data, content_type=RAW_DATA_CONTENT_TYPES[raw_data_format])
+    enqueue_field_match(output_bucket, filename, fields, image)
 
 
-def extract_fields(bucket: str, file_name: str, mime_type: str, fields: dict):
-    def trim_text(text: str):
-        return text.strip().replace("\n", " ")
+def normalized_box(layout) -> tuple:
+    """
+    The (left, top, right, bottom) extent of layout's normalized bounding polygon, as fractions of the page's width
+    and height, or NaNs if it has none.
+    """
+    try:
+        vertices = list(layout.bounding_poly.normalized_vertices)
+    except (AttributeError, TypeError):
+        vertices = []
+    if not vertices:
+        return (math.nan,) * 4
+    xs = [vertex.x for vertex in vertices]
+    ys = [vertex.y for vertex in vertices]
+    return min(xs), min(ys), max(xs), max(ys)
 
-    project_id = os.environ["PROJECT_ID"]
-    location = os.environ["LOCATION_SHORT"]
-    processor_id = os.environ["PROCESSOR_ID"]
-    output_bucket = os.environ["OUTPUT_BUCKET"]
-    output_filename = file_name.split(".", 1)[0]
 
-    document = parse_document(
-        project_id=project_id,
-        location=location,
-        processor_id=processor_id,
-        bucket=bucket,
-        file_name=file_name,
-        mime_type=mime_type
-    )
+def form_fields_dataframe(documents: list) -> "pandas.DataFrame":
+    """The form fields of every page of documents, which are the shards of one document for batch results."""
+    import pandas as pd
+
+    def trim_text(text: str):
+        return text.strip().replace("\n", " ")
 
     names = []
     name_confidence = []
     values = []
     value_confidence = []
+    page_numbers = []
+    name_boxes = []
+    value_boxes = []
 
-    for page in document.pages:
+    # the shards of a batch result continue each other's page numbering
+    pages = [page for document in documents for page in document.pages]
+    for page_number, page in enumerate(pages, start=1):
         for field in page.form_fields:
             names.append(trim_text(field.field_name.text_anchor.content))
             name_confidence.append(field.field_name.confidence)
             values.append(trim_text(field.field_value.text_anchor.content))
             value_confidence.append(field.field_value.confidence)
+            page_numbers.append(page_number)
+            name_boxes.append(normalized_box(field.field_name))
+            value_boxes.append(normalized_box(field.field_value))
 
     df = pd.DataFrame(
         {
@@ -120,10 +296,191 @@ def extract_fields(bucket: str, file_name: str, mime_type: str, fields: dict):
             "Field Name Confidence": name_confidence,
             "Field Value": values,
             "Field Value Confidence": value_confidence,
+            "Page Number": page_numbers,
         }
     )
+    for part, boxes in [("Name", name_boxes), ("Value", value_boxes)]:
+        for side, coordinates in zip(BOX_SIDES, zip(*boxes) if boxes else [[]] * 4):
+            df[f"Field {part} {side}"] = list(coordinates)
+    return df
+
+
+def extract_fields(bucket: str, file_name: str, mime_type: str, fields: dict) -> tuple:
+    """
+    The field table of an image already OCR'd with the same processor is taken from the OCR cache instead of Document
+    AI. Returns the timings of the request, as recorded by parse_document, with the time taken to download the image,
+    look it up in the cache and save the data, the image sizes recorded by parse_document, and the cache tier the
+    field table was found in ("local", "bucket" or "miss").
+    """
+    project_id = os.environ["PROJECT_ID"]
+    location = os.environ["LOCATION_SHORT"]
+    processor_id = os.environ["PROCESSOR_ID"]
+    output_bucket = os.environ["OUTPUT_BUCKET"]
+    output_filename = file_name.split(".", 1)[0]
+    timings = {}
+    image_bytes = {}
+
+    start = time.perf_counter()
+    image_content = get_storage_client().bucket(bucket).blob(file_name).download_as_bytes()
+    timings["download"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    key = cache_key(image_content, processor_id, os.environ.get("PROCESSOR_VERSION"))
+    df, cache_tier = get_ocr_cache().get(key)
+    timings["cache"] = time.perf_counter() - start
+
+    if df is None:
+        document = parse_document(
+            project_id=project_id,
+            location=location,
+            processor_id=processor_id,
+            bucket=bucket,
+            file_name=file_name,
+            mime_type=mime_type,
+            timings=timings,
+            image_bytes=image_bytes,
+            image_content=image_content
+        )
+        df = form_fields_dataframe([document])
+        get_ocr_cache().put(key, df)
+
+    start = time.perf_counter()
+    save_data(output_bucket, output_filename, df, fields, file_name)
+    timings["save"] = time.perf_counter() - start
+    return timings, image_bytes, cache_tier
+
+
+def mime_type_of(name: str) -> str:
+    extension = name.split(".", 1)[-1]
+    if extension == "png":
+        return "image/png"
+    else:
+        return "image/jpeg"
+
+
+def split_gcs_uri(uri: str) -> tuple:
+    bucket, _, path = uri[len("gs://"):].partition("/")
+    return bucket, path
+
+
+def submit_batch(project_id: str, location: str, processor_id: str, bucket: str, file_names: list, output_uri: str):
+    """Submits file_names to Document AI's batch processing, returning the long-running operation."""
+    from google.cloud import documentai_v1 as documentai
+
+    client = get_document_ai_client(location)
+    documents = [documentai.GcsDocument(gcs_uri=f"gs://{bucket}/{file_name}", mime_type=mime_type_of(file_name))
+                 for file_name in file_names]
+    request = documentai.BatchProcessRequest(
+        name=processor_name(client, project_id, location, processor_id),
+        input_documents=documentai.BatchDocumentsInputConfig(gcs_documents=documentai.GcsDocuments(documents=documents)),
+        document_output_config=documentai.DocumentOutputConfig(
+            gcs_output_config=documentai.DocumentOutputConfig.GcsOutputConfig(gcs_uri=output_uri))
+    )
+    return client.batch_process_documents(request=request)
+
+
+def shard_index(blob_name: str) -> int:
+    """The index of the shard Document AI wrote as [name]-[index].json, so shard 10 sorts after shard 2."""
+    match = re.search(r"-(\d+)\.json$", blob_name)
+    return int(match.group(1)) if match else 0
+
+
+def read_batch_output(output_gcs_destination: str) -> list:
+    """The shards of the document Document AI wrote under output_gcs_destination, in page order."""
+    from google.cloud import documentai_v1 as documentai
+
+    bucket, prefix = split_gcs_uri(output_gcs_destination)
+    blobs = [blob for blob in get_storage_client().list_blobs(bucket, prefix=prefix.rstrip("/") + "/")
+             if blob.name.endswith(".json")]
+    return [documentai.Document.from_json(blob.download_as_bytes(), ignore_unknown_fields=True)
+            for blob in sorted(blobs, key=lambda blob: (shard_index(blob.name), blob.name))]
+
+
+def get_batch_operation(location: str, operation_name: str):
+    """
+    The batch operation operation_name, submitted by an earlier request, with the done(), metadata and exception() of
+    the operation submit_batch returns. Looking it up does not wait for it.
+    """
+    from google.api_core import operation
+    from google.cloud import documentai_v1 as documentai
+
+    operations_client = get_document_ai_client(location).transport.operations_client
+    return operation.from_gapic(operations_client.get_operation(operation_name), operations_client,
+                                documentai.BatchProcessResponse, metadata_type=documentai.BatchProcessMetadata)
+
+
+def collect_batches(operations: dict, handled: dict, fields: dict, output_bucket: str) -> dict:
+    """
+    Polls each of operations, operation name -> operation, once. Each document an operation reports processed, and
+    not among its handled sources yet, is saved and its field matching enqueued. A document that cannot be read or
+    saved is reported as failed rather than failing the poll. Returns the sources saved and those that failed, the
+    names of the operations still running and the sources handled so far of each of them.
+    """
+    saved, failed, pending = [], [], []
+    for name, operation in operations.items():
+        done = operation.done()
+        sources = handled.setdefault(name, [])
+        for status in operation.metadata.individual_process_statuses:
+            source = status.input_gcs_source
+            if source in sources:
+                continue
+            if status.status.code != 0:
+                sources.append(source)
+                failed.append({"name": source, "error": status.status.message})
+            elif status.output_gcs_destination:
+                # handled whether or not it is saved, so a retried poll never saves, and enqueues, a document twice
+                sources.append(source)
+                output_filename = split_gcs_uri(source)[1].split(".", 1)[0]
+                try:
+                    df = form_fields_dataframe(read_batch_output(status.output_gcs_destination))
+                    save_data(output_bucket, output_filename, df, fields, split_gcs_uri(source)[1])
+                except Exception as e:
+                    failed.append({"name": source, "error": str(e)})
+                    continue
+                saved.append(source)
+        if not done:
+            pending.append(name)
+        elif operation.exception() is not None:
+            failed.append({"name": name, "error": str(operation.exception())})
+    return {"saved": saved, "failed": failed, "pending": pending,
+            "handled": {name: handled[name] for name in pending}}
+
+
+def enqueue_collection(batch_id: str, operations: list, handled: dict, fields: dict, expires_at: float, poll: int):
+    """Enqueues the poll-th collection of the results of batch_id, BATCH_POLL_INTERVAL seconds from now."""
+    payload = {"batchId": batch_id, "operations": operations, "handled": handled, "fields": fields,
+               "expiresAt": expires_at, "poll": poll}
+    enqueue_task(os.environ["BATCH_COLLECT_URL"], payload, task_id=f"batch-{batch_id}-{poll}",
+                 delay=float(os.environ.get("BATCH_POLL_INTERVAL", "60")) if poll else 0)
+
 
-    save_data(output_bucket, output_filename, df, fields)
+def batch_extract_fields(bucket: str, file_names: list, fields: dict, batch_id: str = None) -> dict:
+    """
+    Submits many images to Document AI's batch processing, in batches of at most BATCH_SIZE images submitted together,
+    and enqueues the collection of their results. The processed documents are written under
+    BATCH_OUTPUT_URI/[batch_id], with the names of the operations, so a repeated request for the same batch_id returns
+    them rather than paying for the OCR again. batch_id defaults to a hash of bucket and file_names.
+    """
+    project_id = os.environ["PROJECT_ID"]
+    location = os.environ["LOCATION_SHORT"]
+    processor_id = os.environ["PROCESSOR_ID"]
+    if batch_id is None:
+        batch_id = hashlib.sha256(json.dumps([bucket, file_names]).encode("utf-8")).hexdigest()[:32]
+    output_uri = f"{os.environ['BATCH_OUTPUT_URI'].rstrip('/')}/{batch_id}"
+    batch_size = int(os.environ.get("BATCH_SIZE", "100"))
+
+    output_bucket, output_prefix = split_gcs_uri(output_uri)
+    record = get_storage_client().bucket(output_bucket).blob(f"{output_prefix}/operations.json")
+    if record.exists():
+        operations = json.loads(record.download_as_bytes())
+    else:
+        operations = [submit_batch(project_id, location, processor_id, bucket, file_names[start:start + batch_size],
+                                   f"{output_uri}/{start // batch_size}/").operation.name
+                      for start in range(0, len(file_names), batch_size)]
+        record.upload_from_string(json.dumps(operations), content_type="application/json")
+    # a no-op if this batch's first collection was enqueued before
+    enqueue_collection(batch_id, operations, {}, fields, time.time() + float(os.environ.get("BATCH_TIMEOUT", "86400")), 0)
+    return {"batchId": batch_id, "operations": operations}
 
 
 def process_image(request):
@@ -136,13 +493,67 @@ def process_image(request):
         bucket = validate_payload(payload, "bucket")
         name = validate_payload(payload, "name")
         fields = validate_payload(payload, "fields")
-        extension = name.split(".", 1)[-1]
-        if extension == "png":
-            mime_type = "image/png"
+        timings, image_bytes, cache_tier = extract_fields(bucket, name, mime_type_of(name), fields)
+        headers = [("Server-Timing", server_timing(timings)), ("X-OCR-Cache", cache_tier)]
+        if image_bytes:
+            headers.append(("X-Image-Bytes", ", ".join(f"{key}={value}" for key, value in image_bytes.items())))
+        return "Ok", 204, headers
+    except Exception as e:
+        return str(e), 400, []
+
+
+def process_image_batch(request):
+    """
+    Submits a backlog of images, given as a list of `names` in `bucket`, or as every image under `prefix`, for their
+    fields to be extracted. Responds with the batch ID and the names of the operations, without waiting for them;
+    collect_image_batch saves the results.
+    """
+    keys = ["PROJECT_ID", "LOCATION", "PROCESSOR_ID", "OUTPUT_BUCKET",
+            "SAE", "URL", "QUEUE", "LOCATION_SHORT", "BATCH_OUTPUT_URI", "BATCH_COLLECT_URL"]
+    for key in keys:
+        assert key in os.environ
+    payload = request.json
+    try:
+        bucket = validate_payload(payload, "bucket")
+        fields = validate_payload(payload, "fields")
+        if "prefix" in payload:
+            names = [blob.name for blob in get_storage_client().list_blobs(bucket, prefix=payload["prefix"])
+                     if blob.name.rsplit(".", 1)[-1] in ("png", "jpg", "jpeg")]
         else:
-            mime_type = "image/jpeg"
-        extract_fields(bucket, name, mime_type, fields)
-        return "Ok", 204, []
+            names = validate_payload(payload, "names")
+        result = batch_extract_fields(bucket, names, fields, payload.get("batchId"))
+        return json.dumps(result), 202, [("Content-Type", "application/json")]
+    except Exception as e:
+        return str(e), 400, []
+
+
+def collect_image_batch(request):
+    """
+    Polls the operations of a batch once, as enqueued by process_image_batch, saving the documents processed since the
+    last poll, and enqueues the next poll while any is still running, until the batch's `expiresAt`. Responds with the
+    images saved and those that failed in this poll.
+    """
+    keys = ["PROJECT_ID", "LOCATION", "OUTPUT_BUCKET", "SAE", "URL", "QUEUE", "LOCATION_SHORT", "BATCH_COLLECT_URL"]
+    for key in keys:
+        assert key in os.environ
+    payload = request.json
+    try:
+        batch_id = validate_payload(payload, "batchId")
+        operation_names = validate_payload(payload, "operations")
+        fields = validate_payload(payload, "fields")
+        expires_at = float(validate_payload(payload, "expiresAt"))
+        location = os.environ["LOCATION_SHORT"]
+        operations = {name: get_batch_operation(location, name) for name in operation_names}
+        result = collect_batches(operations, payload.get("handled") or {}, fields, os.environ["OUTPUT_BUCKET"])
     except Exception as e:
         return str(e), 400, []
 
+    for failure in result["failed"]:
+        logging.error("Batch %s: %s failed: %s", batch_id, failure["name"], failure["error"])
+    if result["pending"]:
+        if time.time() < expires_at:
+            enqueue_collection(batch_id, result["pending"], result["handled"], fields, expires_at,
+                               payload.get("poll", 0) + 1)
+        else:
+            logging.error("Batch %s: gave up on %s after its timeout", batch_id, ", ".join(result["pending"]))
+    return json.dumps(result), 200, [("Content-Type", "application/json")]
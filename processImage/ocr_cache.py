@@ -0,0 +1,78 @@
+"""
+A cache of OCR results keyed by the content of the image, so a re-uploaded ticket is not OCR'd again.
+
+Entries are the field table extract_fields builds from a document. They are kept in a local LRU tier of
+OCR_CACHE_SIZE entries (default 128), and, if OCR_CACHE_BUCKET is set, in that bucket under `ocr-cache/`, shared by
+every instance, as Parquet files, which keep the column types. The key is the processor ID and version, OCR_CACHE_VERSION, the pre-processing settings and the
+SHA-256 of the image bytes, so results from an old processor or processor version, or from differently pre-processed
+images, are never reused. An unpinned processor runs whichever version is its default, so bump OCR_CACHE_VERSION when
+the default changes.
+"""
+import hashlib
+import io
+import os
+import threading
+from collections import OrderedDict
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import pandas
+
+# hits in each tier, and misses, over the life of the instance
+OCR_CACHE_STATS = {"localHits": 0, "bucketHits": 0, "misses": 0}
+
+PREPROCESS_SETTINGS = ["PREPROCESS_IMAGES", "PREPROCESS_TARGET_DPI", "PREPROCESS_PAGE_INCHES", "PREPROCESS_GRAYSCALE",
+                       "PREPROCESS_FORMAT", "PREPROCESS_QUALITY"]
+
+
+def cache_key(image_content: bytes, processor_id: str, processor_version: str = None) -> str:
+    settings = ",".join(f"{name}={os.environ.get(name, '')}" for name in PREPROCESS_SETTINGS)
+    settings_digest = hashlib.sha256(settings.encode("utf-8")).hexdigest()[:16]
+    version = f"{processor_version or 'default'}-{os.environ.get('OCR_CACHE_VERSION', '0')}"
+    return f"{processor_id}/{version}/{settings_digest}/{hashlib.sha256(image_content).hexdigest()}"
+
+
+class OcrCache:
+    def __init__(self, max_entries: int, storage_client=None, bucket_name: str = None):
+        self.max_entries = max_entries
+        self.storage_client = storage_client
+        self.bucket_name = bucket_name
+        self.entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _blob(self, key: str):
+        return self.storage_client.bucket(self.bucket_name).blob(f"ocr-cache/{key}.parquet")
+
+    def _put_local(self, key: str, dataframe: "pandas.DataFrame"):
+        with self._lock:
+            self.entries[key] = dataframe
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def get(self, key: str) -> tuple:
+        """The cached field table for key, or None, and the tier it was found in: "local", "bucket" or "miss"."""
+        import pandas as pd
+
+        with self._lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                OCR_CACHE_STATS["localHits"] += 1
+                return self.entries[key].copy(), "local"
+        if self.bucket_name:
+            blob = self._blob(key)
+            if blob.exists():
+                dataframe = pd.read_parquet(io.BytesIO(blob.download_as_bytes()))
+                self._put_local(key, dataframe)
+                OCR_CACHE_STATS["bucketHits"] += 1
+                return dataframe.copy(), "bucket"
+        OCR_CACHE_STATS["misses"] += 1
+        return None, "miss"
+
+    def put(self, key: str, dataframe: "pandas.DataFrame"):
+        self._put_local(key, dataframe.copy())
+        if self.bucket_name:
+            # typed columns, so field values such as "007891" or "1964.680" come back as the strings they were
+            data = io.BytesIO()
+            dataframe.to_parquet(data, index=False)
+            self._blob(key).upload_from_string(data.getvalue(), content_type="application/vnd.apache.parquet")
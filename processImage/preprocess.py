@@ -0,0 +1,55 @@
+"""
+Optional pre-processing of ticket photos before OCR, to cut the bytes uploaded to Document AI.
+
+Phone photos arrive at full camera resolution. Tickets are at most PREPROCESS_PAGE_INCHES (default 11.69, the long
+side of A4) long, so anything above PREPROCESS_TARGET_DPI (default 200) on that side is only upload time. Images are
+rotated upright from their EXIF orientation, converted to grayscale (PREPROCESS_GRAYSCALE, default true), downscaled
+and re-encoded as PREPROCESS_FORMAT (JPEG or PNG, default JPEG) at PREPROCESS_QUALITY (default 85).
+
+Enabled with PREPROCESS_IMAGES=true. Pillow is only imported when it is.
+"""
+import io
+import os
+import threading
+
+# totals over the life of the instance: images pre-processed, and bytes before and after
+PREPROCESS_STATS = {"images": 0, "bytesIn": 0, "bytesOut": 0}
+PREPROCESS_STATS_LOCK = threading.Lock()
+
+MIME_TYPES = {"JPEG": "image/jpeg", "PNG": "image/png"}
+
+
+def preprocessing_enabled() -> bool:
+    return os.environ.get("PREPROCESS_IMAGES", "false").lower() == "true"
+
+
+def preprocess_image(image_content: bytes, mime_type: str) -> tuple:
+    """
+    The image as (bytes, mime type), pre-processed as above. The original is returned if re-encoding would not make
+    it smaller.
+    """
+    from PIL import Image, ImageOps
+
+    target_dpi = int(os.environ.get("PREPROCESS_TARGET_DPI", "200"))
+    page_inches = float(os.environ.get("PREPROCESS_PAGE_INCHES", "11.69"))
+    grayscale = os.environ.get("PREPROCESS_GRAYSCALE", "true").lower() == "true"
+    image_format = os.environ.get("PREPROCESS_FORMAT", "JPEG").upper()
+    quality = int(os.environ.get("PREPROCESS_QUALITY", "85"))
+
+    with Image.open(io.BytesIO(image_content)) as image:
+        image = ImageOps.exif_transpose(image)
+        image = image.convert("L") if grayscale else image.convert("RGB")
+        max_side = int(target_dpi * page_inches)
+        if max(image.size) > max_side:
+            image.thumbnail((max_side, max_side), Image.LANCZOS)
+        output = io.BytesIO()
+        image.save(output, format=image_format, quality=quality, optimize=True, dpi=(target_dpi, target_dpi))
+    processed = output.getvalue()
+
+    with PREPROCESS_STATS_LOCK:
+        PREPROCESS_STATS["images"] += 1
+        PREPROCESS_STATS["bytesIn"] += len(image_content)
+        PREPROCESS_STATS["bytesOut"] += min(len(processed), len(image_content))
+    if len(processed) >= len(image_content):
+        return image_content, mime_type
+    return processed, MIME_TYPES[image_format]
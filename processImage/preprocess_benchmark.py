@@ -0,0 +1,92 @@
+"""
+Benchmarks image pre-processing on a directory of ticket photos.
+
+For each image, records the bytes before and after preprocess.preprocess_image and the time it takes. With --ocr, also
+sends both versions to the Document AI processor given by PROJECT_ID, LOCATION_SHORT and PROCESSOR_ID (as in
+env.yaml, with application default credentials), and records the OCR time of each and how many of the (field name,
+field value) pairs extracted from the original are extracted identically from the pre-processed image.
+
+Usage: python processImage/preprocess_benchmark.py IMAGE_DIR [--ocr] [--json results.json]
+
+The PREPROCESS_* environment variables described in preprocess.py apply.
+"""
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+
+import main
+from preprocess import preprocess_image
+
+
+def ocr_fields(image_content: bytes, mime_type: str) -> tuple:
+    """The (field name, field value) pairs Document AI extracts from image_content, and the seconds it took."""
+    from google.cloud import documentai_v1 as documentai
+
+    client = main.get_document_ai_client(os.environ["LOCATION_SHORT"])
+    name = client.processor_path(os.environ["PROJECT_ID"], os.environ["LOCATION_SHORT"], os.environ["PROCESSOR_ID"])
+    request = documentai.ProcessRequest(name=name,
+                                        raw_document=documentai.RawDocument(content=image_content, mime_type=mime_type))
+    start = time.perf_counter()
+    document = client.process_document(request=request).document
+    elapsed = time.perf_counter() - start
+    df = main.form_fields_dataframe([document])
+    return set(zip(df["Field Name"], df["Field Value"])), elapsed
+
+
+def run(paths: list, ocr: bool) -> list:
+    results = []
+    for path in paths:
+        with open(path, "rb") as f:
+            original = f.read()
+        mime_type = main.mime_type_of(os.path.basename(path))
+        start = time.perf_counter()
+        processed, processed_mime_type = preprocess_image(original, mime_type)
+        row = {"image": os.path.basename(path),
+               "originalBytes": len(original),
+               "processedBytes": len(processed),
+               "preprocessSeconds": time.perf_counter() - start}
+        if ocr:
+            original_fields, row["originalOcrSeconds"] = ocr_fields(original, mime_type)
+            processed_fields, row["processedOcrSeconds"] = ocr_fields(processed, processed_mime_type)
+            row["originalFields"] = len(original_fields)
+            row["matchingFields"] = len(original_fields & processed_fields)
+        results.append(row)
+    return results
+
+
+def main_cli(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("image_dir")
+    parser.add_argument("--ocr", action="store_true", help="also compare the OCR time and output of both versions")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args(argv)
+
+    paths = sorted(path for pattern in ("*.png", "*.jpg", "*.jpeg")
+                   for path in glob.glob(os.path.join(args.image_dir, pattern)))
+    results = run(paths, args.ocr)
+
+    print(f"{'image':<30}{'original (KiB)':>16}{'processed (KiB)':>17}{'preprocess (ms)':>17}"
+          + (f"{'OCR saved (ms)':>16}{'fields kept':>13}" if args.ocr else ""))
+    for row in results:
+        line = (f"{row['image']:<30}{row['originalBytes'] / 1024:>16.0f}{row['processedBytes'] / 1024:>17.0f}"
+                f"{row['preprocessSeconds'] * 1000:>17.1f}")
+        if args.ocr:
+            saved_ms = (row["originalOcrSeconds"] - row["processedOcrSeconds"]) * 1000
+            line += f"{saved_ms:>16.0f}{row['matchingFields']:>7}/{row['originalFields']:<5}"
+        print(line)
+    if results:
+        original = sum(row["originalBytes"] for row in results)
+        processed = sum(row["processedBytes"] for row in results)
+        print(f"{len(results)} images, {original / 1024:.0f} KiB -> {processed / 1024:.0f} KiB "
+              f"({1 - processed / original:.0%} saved)")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
@@ -3,15 +3,69 @@ from unittest.mock import Mock
 from unittest.mock import patch
 from unittest import TestCase
 
+import io
 import os
+import re
 import sys
 import json
+import threading
+from types import SimpleNamespace
 
 GOOGLE_MOCK = Mock()
 sys.modules['google.cloud'] = GOOGLE_MOCK
-sys.modules['gcsfs'] = Mock()
 
 import main
+import local_documentai
+import ocr_cache
+import preprocess
+
+STOCLIENT_MOCK = Mock()
+
+
+class FakeStorageClient:
+    """Objects held in memory as (bucket, name) -> bytes."""
+    def __init__(self):
+        self.objects = {}
+
+    def bucket(self, bucket_name):
+        return SimpleNamespace(blob=lambda name: FakeBlob(self, bucket_name, name))
+
+    get_bucket = bucket
+
+    def list_blobs(self, bucket_name, prefix=""):
+        return [FakeBlob(self, b, name) for b, name in sorted(self.objects) if b == bucket_name and name.startswith(prefix)]
+
+
+class FakeBlob:
+    def __init__(self, client, bucket_name, name):
+        self.client, self.bucket_name, self.name = client, bucket_name, name
+
+    def exists(self):
+        return (self.bucket_name, self.name) in self.client.objects
+
+    def upload_from_string(self, data, content_type=None):
+        self.client.objects[(self.bucket_name, self.name)] = data.encode("utf-8") if isinstance(data, str) else data
+
+    def download_as_bytes(self):
+        return self.client.objects[(self.bucket_name, self.name)]
+
+
+def document_json(fields: dict) -> str:
+    """Document JSON, as written by Document AI batch processing, with one page holding fields."""
+    form_fields = [{"fieldName": {"textAnchor": {"content": name}, "confidence": 0.9},
+                    "fieldValue": {"textAnchor": {"content": value}, "confidence": 0.8}} for name, value in fields.items()]
+    return json.dumps({"pages": [{"formFields": form_fields}]})
+
+
+def from_json(data, ignore_unknown_fields=False):
+    # stands in for documentai.Document.from_json, with camelCase keys as snake_case attributes
+    def to_namespace(value):
+        if isinstance(value, dict):
+            return SimpleNamespace(**{re.sub(r"([A-Z])", r"_\1", k).lower(): to_namespace(v) for k, v in value.items()})
+        if isinstance(value, list):
+            return [to_namespace(v) for v in value]
+        return value
+    return to_namespace(json.loads(data))
 
 @patch.dict(os.environ, {
     "PROJECT_ID":"id",
@@ -23,6 +77,9 @@ import main
     "QUEUE":"q",
     "SAE":"servAcc"})
 @patch("main.ClientOptions")
+@patch("main.connect_channel")
+@patch("main.STORAGE_CLIENT", STOCLIENT_MOCK)
+@patch("main.OCR_CACHE", None)
 class TestImageProcessing(TestCase):
 
     def setUp(self, *args):
@@ -35,6 +92,8 @@ class TestImageProcessing(TestCase):
             lambda url, oidc_token, headers, body: \
                 assignReturn(json.loads(body))
         
+        STOCLIENT_MOCK.bucket.return_value.blob.return_value.download_as_bytes.return_value = b"image"
+
         self.request = Mock(json={
             "bucket":"bucket",
             "name":"name",
@@ -61,8 +120,273 @@ class TestImageProcessing(TestCase):
             self.assertEqual(self.return_message["bucket"], "output")
             self.assertEqual(self.return_message["name"],"name.csv")
             self.assertEqual(self.return_message["fields"], ["fields"])
+            self.assertEqual(self.return_message["image"], "name")
+            self.assertEqual(l[0][0], "Server-Timing")
+
+
+    def test_edgeCase_clientReuse(self, *args):
+        STOCLIENT_MOCK.reset_mock()
+        GOOGLE_MOCK.documentai_v1.DocumentProcessorServiceClient.reset_mock()
+        STOCLIENT_MOCK.bucket.return_value.blob.return_value.download_as_bytes.return_value = b"image"
+        with patch.dict(main.DOCUMENT_AI_CLIENTS, clear=True):
+            for location in ["eu", "eu", "us"]:
+                timings = {}
+                main.parse_document("id", location, "processor", "bucket", "name.png", "image/png", timings=timings)
+                self.assertEqual(set(timings.keys()), {"connect", "download", "ocr"})
+            # a pinned processor version is requested by its own resource name
+            with patch.dict(os.environ, {"PROCESSOR_VERSION": "v2"}):
+                main.parse_document("id", "eu", "processor", "bucket", "name.png", "image/png")
+            client = GOOGLE_MOCK.documentai_v1.DocumentProcessorServiceClient.return_value
+            client.processor_version_path.assert_called_with("id", "eu", "processor", "v2")
+            self.assertEqual(GOOGLE_MOCK.documentai_v1.ProcessRequest.call_args.kwargs["name"],
+                             client.processor_version_path.return_value)
+
+        # one client per endpoint, connected when it is created, and the image read through the storage client
+        self.assertEqual(GOOGLE_MOCK.documentai_v1.DocumentProcessorServiceClient.call_count, 2)
+        self.assertEqual(main.connect_channel.call_count, 2)
+        STOCLIENT_MOCK.bucket.assert_called_with("bucket")
+        STOCLIENT_MOCK.bucket.return_value.blob.assert_called_with("name.png")
+        GOOGLE_MOCK.documentai_v1.RawDocument.assert_called_with(content=b"image", mime_type="image/png")
 
     
+    def test_edgeCase_slowConnectHoldsUpOneEndpoint(self, *args):
+        connecting, connected = threading.Event(), threading.Event()
+
+        def connect_channel(client, timeout):
+            connecting.set()
+            connected.wait(5)
+        eu_client = Mock()
+        with patch.dict(main.DOCUMENT_AI_CLIENTS, {"eu-documentai.googleapis.com": eu_client}), \
+                patch("main.connect_channel", connect_channel):
+            us = threading.Thread(target=main.get_document_ai_client, args=["us"])
+            us.start()
+            self.assertTrue(connecting.wait(5))
+            # while the us client connects, other endpoints' clients are still handed out
+            self.assertIs(main.get_document_ai_client("eu"), eu_client)
+            self.assertTrue(us.is_alive())
+            connected.set()
+            us.join(5)
+            self.assertIn("us-documentai.googleapis.com", main.DOCUMENT_AI_CLIENTS)
+
+
+    @patch("main.enqueue_field_match")
+    def test_edgeCase_rawDataFormats(self, enqueue_mock, *args):
+        import pandas as pd
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        df = pd.DataFrame({"Field Name": ["Total Weight:", "VAT No:"], "Field Name Confidence": [0.9, 0.5],
+                           "Field Value": ["1964.688Kgs", "263 3466 02"], "Field Value Confidence": [0.8, 0.4],
+                           "Page Number": [1, 2]})
+        storage = FakeStorageClient()
+        readers = {"arrow": lambda data: pa.ipc.open_file(pa.py_buffer(data)).read_all(),
+                   "parquet": lambda data: pq.read_table(pa.BufferReader(data))}
+
+        for raw_data_format, read in readers.items():
+            with self.subTest(test_data=raw_data_format), patch("main.STORAGE_CLIENT", storage), \
+                    patch.dict(os.environ, {"RAW_DATA_FORMAT": raw_data_format}):
+                main.save_data("output", "ticket", df, {"total weight": "totalWeight"})
+                table = read(storage.objects[("output", f"ticket.{raw_data_format}")])
+                self.assertEqual(enqueue_mock.call_args.args[1], f"ticket.{raw_data_format}")
+                self.assertEqual(str(table.schema.field("Field Name Confidence").type), "float")
+                self.assertEqual(str(table.schema.field("Page Number").type), "int32")
+                self.assertEqual(table.column("Field Value").to_pylist(), ["1964.688Kgs", "263 3466 02"])
+
+        with patch.dict(os.environ, {"RAW_DATA_FORMAT": "xlsx"}):
+            self.assertRaises(ValueError, main.save_data, "output", "ticket", df, {})
+
+
+    def test_edgeCase_fieldBoxes(self, *args):
+        document = json.loads(document_json({"Total Weight:": "1964.688Kgs", "VAT No:": "263 3466 02"}))
+        document["pages"][0]["formFields"][0]["fieldName"]["boundingPoly"] = {"normalizedVertices": [
+            {"x": 0.1, "y": 0.5}, {"x": 0.3, "y": 0.5}, {"x": 0.3, "y": 0.52}, {"x": 0.1, "y": 0.52}]}
+        document["pages"][0]["formFields"][0]["fieldValue"]["boundingPoly"] = {"normalizedVertices": []}
+        df = main.form_fields_dataframe([from_json(json.dumps(document))])
+
+        self.assertEqual(df.loc[0, ["Field Name Left", "Field Name Top", "Field Name Right", "Field Name Bottom"]].tolist(),
+                         [0.1, 0.5, 0.3, 0.52])
+        # fields without a polygon, or with an empty one, have no box
+        self.assertTrue(df.loc[0, ["Field Value Left", "Field Value Bottom"]].isna().all())
+        self.assertTrue(df.loc[1, ["Field Name Left", "Field Value Right"]].isna().all())
+        self.assertEqual(df["Page Number"].tolist(), [1, 1])
+
+
+    @patch.dict(os.environ, {"OCR_CACHE_BUCKET":"cache"})
+    @patch("main.enqueue_field_match")
+    def test_edgeCase_ocrCache(self, enqueue_mock, *args):
+        storage = FakeStorageClient()
+        storage.bucket("bucket").blob("ticket.png").upload_from_string(b"ticket")
+        storage.bucket("bucket").blob("reupload.png").upload_from_string(b"ticket")
+        storage.bucket("bucket").blob("other.png").upload_from_string(b"other ticket")
+        document = SimpleNamespace(pages=[SimpleNamespace(form_fields=[SimpleNamespace(
+            field_name=SimpleNamespace(text_anchor=SimpleNamespace(content="Total Weight:"), confidence=0.9),
+            field_value=SimpleNamespace(text_anchor=SimpleNamespace(content="1964.688Kgs"), confidence=0.8))])])
+
+        testCases = [
+            # (image, processor settings, fresh instance, cache tier)
+            ("ticket.png", {}, False, "miss"),
+            ("reupload.png", {}, False, "local"),
+            ("reupload.png", {}, True, "bucket"),
+            ("other.png", {}, False, "miss"),
+            ("ticket.png", {"PROCESSOR_ID": "new processor"}, False, "miss"),
+            ("ticket.png", {"PROCESSOR_VERSION": "pretrained-form-parser-v2.0"}, False, "miss"),
+            ("ticket.png", {"PROCESSOR_VERSION": "pretrained-form-parser-v2.0"}, False, "local"),
+            ("ticket.png", {"OCR_CACHE_VERSION": "1"}, False, "miss")]
+        stats_before = dict(ocr_cache.OCR_CACHE_STATS)
+
+        with patch("main.STORAGE_CLIENT", storage), patch("main.parse_document", return_value=document) as parse_mock:
+            for name, env, fresh_instance, tier in testCases:
+                if fresh_instance:
+                    main.OCR_CACHE = None
+                self.request.json["name"] = name
+                with self.subTest(test_data=(name, env)), patch.dict(os.environ, env):
+                    st, num, headers = main.process_image(self.request)
+                    self.assertEqual(dict(headers)["X-OCR-Cache"], tier)
+                    csv = storage.objects[("output", name.replace(".png", ".csv"))].decode("utf-8")
+                    self.assertIn("Total Weight:,0.9,1964.688Kgs,0.8", csv)
+
+        self.assertEqual(parse_mock.call_count, 5)
+        self.assertEqual(enqueue_mock.call_count, 8)
+        self.assertEqual({key: ocr_cache.OCR_CACHE_STATS[key] - stats_before[key] for key in stats_before},
+                         {"localHits": 2, "bucketHits": 1, "misses": 5})
+
+
+    def test_edgeCase_ocrCacheKeepsTypes(self, *args):
+        storage = FakeStorageClient()
+        fields = [SimpleNamespace(field_name=SimpleNamespace(text_anchor=SimpleNamespace(content=name), confidence=0.9),
+                                  field_value=SimpleNamespace(text_anchor=SimpleNamespace(content=value), confidence=0.8))
+                  for name, value in [("12", "007891"), ("Total Weight:", "1964.680")]]
+        df = main.form_fields_dataframe([SimpleNamespace(pages=[SimpleNamespace(form_fields=fields)])])
+        ocr_cache.OcrCache(8, storage, "cache").put("key", df)
+
+        # a fresh instance finds the field table in the bucket exactly as it was put
+        cached, tier = ocr_cache.OcrCache(8, storage, "cache").get("key")
+        self.assertEqual(tier, "bucket")
+        self.assertEqual(list(cached["Field Name"]), ["12", "Total Weight:"])
+        self.assertEqual(list(cached["Field Value"]), ["007891", "1964.680"])
+        for raw_data_format in ["csv", "arrow", "parquet"]:
+            with self.subTest(test_data=raw_data_format):
+                self.assertTrue(main.encode_raw_data(cached, raw_data_format))
+
+
+    @patch.dict(os.environ, {"PREPROCESS_IMAGES":"true", "PREPROCESS_TARGET_DPI":"100", "PREPROCESS_PAGE_INCHES":"5"})
+    def test_edgeCase_preprocessImage(self, *args):
+        from PIL import Image
+        # a landscape photo taken with the phone rotated, and so tagged with EXIF orientation 6 (rotate 90 clockwise)
+        photo = Image.effect_noise((1500, 1000), 64).convert("RGB")
+        exif = Image.Exif()
+        exif[0x0112] = 6
+        original = io.BytesIO()
+        photo.save(original, format="PNG", exif=exif)
+
+        processed, mime_type = preprocess.preprocess_image(original.getvalue(), "image/png")
+        with Image.open(io.BytesIO(processed)) as image:
+            self.assertEqual(image.mode, "L")
+            self.assertEqual(image.size, (333, 500))
+        self.assertEqual(mime_type, "image/jpeg")
+        self.assertLess(len(processed), len(original.getvalue()))
+
+        # an image that re-encoding would not shrink is sent as it is
+        small = io.BytesIO()
+        Image.new("L", (10, 10)).save(small, format="PNG")
+        self.assertEqual(preprocess.preprocess_image(small.getvalue(), "image/png"), (small.getvalue(), "image/png"))
+
+
+    @patch.dict(os.environ, {"PREPROCESS_IMAGES":"true"})
+    def test_edgeCase_preprocessBeforeOcr(self, *args):
+        STOCLIENT_MOCK.bucket.return_value.blob.return_value.download_as_bytes.return_value = b"original image"
+        timings, image_bytes = {}, {}
+        with patch("main.preprocess_image", return_value=(b"image", "image/jpeg")):
+            main.parse_document("id", "eu", "processor", "bucket", "name.png", "image/png", timings=timings,
+                                image_bytes=image_bytes)
+
+        GOOGLE_MOCK.documentai_v1.RawDocument.assert_called_with(content=b"image", mime_type="image/jpeg")
+        self.assertIn("preprocess", timings)
+        self.assertEqual(image_bytes, {"original": 14, "sent": 5})
+
+
+    @patch.dict(os.environ, {"BATCH_OUTPUT_URI":"gs://documentai/batch", "BATCH_SIZE":"2", "BATCH_COLLECT_URL":"collect"})
+    @patch("main.enqueue_field_match")
+    def test_edgeCase_batchProcessing(self, enqueue_mock, *args):
+        storage = FakeStorageClient()
+        images = {f"gs://bucket/ticket{i}.png": {"Total Weight:": f"{1000 + i}.123Kgs"} for i in range(5)}
+
+        def ocr(gcs_uri):
+            if gcs_uri == "gs://bucket/ticket3.png":
+                raise RuntimeError("unsupported image")
+            return document_json(images[gcs_uri])
+        client = local_documentai.LocalDocumentProcessorClient(ocr, storage)
+        # the collection tasks enqueued, by task name, which Cloud Tasks keeps unique
+        collections = {}
+
+        def enqueue_field_match(output_bucket, output_file_name, fields, image=None):
+            if output_file_name == "ticket1.csv":
+                raise RuntimeError("queue unavailable")
+        enqueue_mock.side_effect = enqueue_field_match
+
+        def enqueue_task(url, payload, task_id=None, delay=0):
+            if task_id in collections:
+                return False
+            collections[task_id] = payload
+            return True
+
+        documentai = GOOGLE_MOCK.documentai_v1
+        with patch("main.STORAGE_CLIENT", storage), \
+                patch("main.enqueue_task", enqueue_task), \
+                patch("main.get_batch_operation", lambda location, name: client.get_operation(name)), \
+                patch.dict(main.DOCUMENT_AI_CLIENTS, {"eu-documentai.googleapis.com": client}), \
+                patch.multiple(documentai, GcsDocument=SimpleNamespace, GcsDocuments=SimpleNamespace,
+                               BatchDocumentsInputConfig=SimpleNamespace, BatchProcessRequest=SimpleNamespace,
+                               DocumentOutputConfig=Mock(side_effect=SimpleNamespace, GcsOutputConfig=SimpleNamespace),
+                               Document=Mock(from_json=from_json)):
+            self.request.json = {"bucket": "bucket", "fields": {"total weight": "totalWeight"},
+                                 "names": [uri.rsplit("/", 1)[-1] for uri in images]}
+            body, status, headers = main.process_image_batch(self.request)
+            submitted = json.loads(body)
+            self.assertEqual(status, 202)
+            self.assertEqual(len(submitted["operations"]), 3)
+            # the batch is submitted without waiting for it
+            enqueue_mock.assert_not_called()
+
+            # a retried request returns the operations already submitted, and enqueues no second collection
+            self.assertEqual(json.loads(main.process_image_batch(self.request)[0]), submitted)
+            self.assertEqual(len(client.operations), 3)
+            self.assertEqual(len(collections), 1)
+
+            # each collection task polls once and enqueues the next while any operation is running
+            saved, failed = [], []
+            collected = set()
+            while len(collected) < len(collections):
+                task_id = next(task_id for task_id in collections if task_id not in collected)
+                collected.add(task_id)
+                body, status, headers = main.collect_image_batch(Mock(json=collections[task_id]))
+                self.assertEqual(status, 200)
+                saved.extend(json.loads(body)["saved"])
+                failed.extend(json.loads(body)["failed"])
+
+        # a document that fails to save fails alone, and the poll that reported it still completes
+        self.assertEqual(len(saved), 3)
+        self.assertCountEqual(failed, [{"name": "gs://bucket/ticket3.png", "error": "unsupported image"},
+                                       {"name": "gs://bucket/ticket1.png", "error": "queue unavailable"}])
+        # the first poll reports a document of each operation, which finishes the last, and the second the rest
+        self.assertEqual(len(collections), 2)
+        # documents are saved as each operation reports them, once each
+        self.assertEqual(sorted(call.args[1] for call in enqueue_mock.call_args_list),
+                         ["ticket0.csv", "ticket1.csv", "ticket2.csv", "ticket4.csv"])
+        csv = storage.objects[("output", "ticket4.csv")].decode("utf-8")
+        self.assertIn("Total Weight:,0.9,1004.123Kgs,0.8", csv)
+
+
+    def test_edgeCase_batchShardOrder(self, *args):
+        storage = FakeStorageClient()
+        for index in [10, 2, 0, 1]:
+            storage.bucket("documentai").blob(f"batch/0/0/ticket-{index}.json").upload_from_string(
+                json.dumps({"pages": [{"formFields": [], "index": index}]}))
+        with patch("main.STORAGE_CLIENT", storage), \
+                patch.object(GOOGLE_MOCK.documentai_v1, "Document", Mock(from_json=from_json)):
+            shards = main.read_batch_output("gs://documentai/batch/0/0")
+        self.assertEqual([shard.pages[0].index for shard in shards], [0, 1, 2, 10])
+
+
     def test_failureCase_malformedRequest(self, *args):
         testCases = [
             {"bucket":"b", "name":"n"},
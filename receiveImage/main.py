@@ -1,13 +1,42 @@
 import os
 
-from google.cloud import storage
 import json
+import threading
+import time
 import uuid
-from google.cloud import tasks_v2beta3 as tasks
+from concurrent.futures import ThreadPoolExecutor
 
+from mapping_store import mapping_store_from_env
 
-STORAGE_CLIENT = storage.Client()
-TASK_CLIENT = tasks.CloudTasksClient()
+STORAGE_CLIENT = None
+TASK_CLIENT = None
+MAPPING_STORE = None
+MAPPING_STORE_LOCK = threading.Lock()
+
+
+def get_storage_client():
+    global STORAGE_CLIENT
+    if STORAGE_CLIENT is None:
+        from google.cloud import storage
+        STORAGE_CLIENT = storage.Client()
+    return STORAGE_CLIENT
+
+
+def get_task_client():
+    global TASK_CLIENT
+    if TASK_CLIENT is None:
+        from google.cloud import tasks_v2beta3 as tasks
+        TASK_CLIENT = tasks.CloudTasksClient()
+    return TASK_CLIENT
+
+
+def get_mapping_store():
+    # one store per instance, so its cache of mappings outlives the request
+    global MAPPING_STORE
+    with MAPPING_STORE_LOCK:
+        if MAPPING_STORE is None:
+            MAPPING_STORE = mapping_store_from_env(get_storage_client())
+    return MAPPING_STORE
 
 
 class FileFormatNotSupportedException(Exception):
@@ -26,14 +55,14 @@ def validate_message(message, param):
     return var
 
 
-def enqueue_processing(output_bucket: str, output_file_name: str, fields: dict):
+def create_processing_task(url: str, payload: dict):
+    from google.cloud import tasks_v2beta3 as tasks
+
     service_account_email = os.environ["SAE"]+"@appspot.gserviceaccount.com"
     project_id = os.environ["PROJECT_ID"]
     queue = os.environ["QUEUE"]
     location = os.environ["LOCATION"]
-    url = os.environ["URL"]
-    payload = {"bucket": output_bucket, "name": output_file_name, "fields": fields}
-    formatted_parent = TASK_CLIENT.queue_path(project_id, location, queue)
+    formatted_parent = get_task_client().queue_path(project_id, location, queue)
 
     http_request = tasks.HttpRequest(url=url,
                                      oidc_token=tasks.OidcToken(service_account_email=service_account_email),
@@ -43,40 +72,64 @@ def enqueue_processing(output_bucket: str, output_file_name: str, fields: dict):
     task = tasks.Task(http_request=http_request)
     request = tasks.CreateTaskRequest(parent=formatted_parent, task=task)
 
-    response = TASK_CLIENT.create_task(request)
+    response = get_task_client().create_task(request)
+
+
+def enqueue_processing(output_bucket: str, output_file_name: str, fields: dict):
+    create_processing_task(os.environ["URL"], {"bucket": output_bucket, "name": output_file_name, "fields": fields})
+
+
+class UniqueNameException(Exception):
+    pass
+
+
+def copy_image(input_bucket_name: str, input_file_name: str, output_bucket_name: str, output_file_name: str,
+               if_generation_match: int = None):
+    # bucket() makes no request, so a copy is the one call to Cloud Storage
+    input_bucket = get_storage_client().bucket(input_bucket_name)
+    output_bucket = get_storage_client().bucket(output_bucket_name)
+    output_bucket.copy_blob(input_bucket.blob(input_file_name), output_bucket, new_name=output_file_name,
+                            if_generation_match=if_generation_match)
 
 
 def save_data(input_bucket_name: str, input_file_name: str, output_bucket_name: str, output_file_name: str, fields: dict):
-    input_bucket = STORAGE_CLIENT.get_bucket(input_bucket_name)
-    output_bucket = STORAGE_CLIENT.get_bucket(output_bucket_name)
-    output_bucket.copy_blob(input_bucket.blob(input_file_name), output_bucket, new_name=output_file_name)
+    copy_image(input_bucket_name, input_file_name, output_bucket_name, output_file_name)
     enqueue_processing(output_bucket_name, output_file_name, fields)
 
 
+def copy_to_unique_name(input_bucket: str, input_file_name: str, output_bucket: str) -> str:
+    """
+    Copies the image to a new UUID name in output_bucket, and returns the name. The copy is conditional on no object
+    having that name (generation 0), so Cloud Storage allocates the name atomically in the same request, whatever the
+    size of the bucket. A name that is taken is retried with a new UUID, up to UNIQUE_NAME_ATTEMPTS (default 5) times.
+    """
+    from google.api_core.exceptions import PreconditionFailed
+
+    extension = str(input_file_name.split('.', 1)[-1])
+    for _ in range(int(os.environ.get("UNIQUE_NAME_ATTEMPTS", "5"))):
+        output_file_name = str(uuid.uuid4()) + "." + extension
+        try:
+            copy_image(input_bucket, input_file_name, output_bucket, output_file_name, if_generation_match=0)
+        except PreconditionFailed:
+            continue
+        return output_file_name
+    raise UniqueNameException("Could not allocate a unique name for {}".format(input_file_name))
+
+
 def generate_unique_file_name(input_bucket: str, input_file_name: str, output_bucket: str, fields: dict):
-    auxiliary_bucket = STORAGE_CLIENT.get_bucket("gpr_auxiliary")
-    mapping_blob = auxiliary_bucket.get_blob("mapping.json")
-    mapping = json.loads(mapping_blob.download_as_string())
     # TODO: Refactor mapping based on user?
-    if input_file_name in mapping:
-        output_file_name = mapping[input_file_name]
-    else:
-        output_file_name = str(uuid.uuid4())
-        output_file_name += "." + str(input_file_name.split('.', 1)[-1])
-        is_unique = len(list(filter(lambda y: y == output_file_name, STORAGE_CLIENT.list_blobs(output_bucket)))) == 0
-        while True:
-            if is_unique:
-                break
-            output_file_name = str(uuid.uuid4())
-            output_file_name += "." + str(input_file_name.split('.', 1)[-1])
-            is_unique = len(
-                list(filter(lambda y: y == output_file_name, STORAGE_CLIENT.list_blobs(output_bucket)))) == 0
-        mapping[input_file_name] = output_file_name
-        mapping_blob.upload_from_string(
-            data=json.dumps(mapping),
-            content_type='application/json'
-        )
-    save_data(input_bucket, input_file_name, output_bucket, output_file_name, fields)
+    mapped_file_name = get_mapping_store().unique_name(input_file_name)
+    if mapped_file_name is not None:
+        save_data(input_bucket, input_file_name, output_bucket, mapped_file_name, fields)
+        return
+    output_file_name = copy_to_unique_name(input_bucket, input_file_name, output_bucket)
+    mapped_file_name = get_mapping_store().put(input_file_name, output_file_name)
+    if mapped_file_name != output_file_name:
+        # the same file was mapped concurrently by another upload, so its name is used and this copy dropped
+        get_storage_client().bucket(output_bucket).delete_blob(output_file_name)
+        save_data(input_bucket, input_file_name, output_bucket, mapped_file_name, fields)
+        return
+    enqueue_processing(output_bucket, output_file_name, fields)
 
 
 def receive_image(file, context):
@@ -101,3 +154,126 @@ def receive_image(file, context):
         return "Ok", 204, []
     except Exception as e:
         return str(e), 400, []
+
+
+SUPPORTED_EXTENSIONS = ("png", "jpeg", "jpg")
+
+
+def list_images(input_bucket: str, prefix: str = None, manifest: str = None) -> list:
+    """The supported images of input_bucket named in the manifest object (one name per line), or under prefix."""
+    if manifest is not None:
+        lines = get_storage_client().bucket(input_bucket).blob(manifest).download_as_text().splitlines()
+        names = [line.strip() for line in lines if line.strip()]
+    else:
+        names = [blob.name for blob in get_storage_client().list_blobs(input_bucket, prefix=prefix)]
+    return [name for name in names if name.split(".", 1)[-1] in SUPPORTED_EXTENSIONS]
+
+
+def enqueue_processing_batches(output_bucket: str, output_file_names: list, fields: dict, executor) -> int:
+    """
+    Enqueues the processing of output_file_names, creating the tasks concurrently on executor, and returns the number
+    of tasks. With BATCH_URL set, each task sends BULK_TASK_SIZE (default 100) images to processImage's batch entry
+    point; otherwise each image gets its own task to URL, as uploads do.
+    """
+    batch_url = os.environ.get("BATCH_URL")
+    if batch_url:
+        size = int(os.environ.get("BULK_TASK_SIZE", "100"))
+        payloads = [{"bucket": output_bucket, "names": output_file_names[i:i + size], "fields": fields}
+                    for i in range(0, len(output_file_names), size)]
+        url = batch_url
+    else:
+        payloads = [{"bucket": output_bucket, "name": name, "fields": fields} for name in output_file_names]
+        url = os.environ["URL"]
+    for future in [executor.submit(create_processing_task, url, payload) for payload in payloads]:
+        future.result()
+    return len(payloads)
+
+
+def bulk_ingest(input_bucket: str, names: list, output_bucket: str, fields: dict) -> dict:
+    """
+    Stores and enqueues the processing of every image in names, as generate_unique_file_name does one by one.
+
+    The mapping of every image is looked up with one read per shard. Images not mapped yet are copied to new unique
+    names on a pool of BULK_COPY_WORKERS (default 16) threads, with server-side copies, and their names recorded with
+    one write per shard. Returns the report of the images stored, those that failed, and the throughput.
+    """
+    start = time.perf_counter()
+    timings = {}
+    failed = {}
+    store = get_mapping_store()
+
+    mapped = store.unique_names(names)
+    timings["lookup"] = time.perf_counter() - start
+
+    with ThreadPoolExecutor(max_workers=int(os.environ.get("BULK_COPY_WORKERS", "16"))) as executor:
+        step_start = time.perf_counter()
+        futures = {}
+        for name in names:
+            if mapped[name] is None:
+                futures[name] = executor.submit(copy_to_unique_name, input_bucket, name, output_bucket)
+            else:
+                futures[name] = executor.submit(copy_image, input_bucket, name, output_bucket, mapped[name])
+        copied = {}
+        for name, future in futures.items():
+            try:
+                result = future.result()
+            except Exception as e:
+                failed[name] = str(e)
+                continue
+            if mapped[name] is None:
+                copied[name] = result
+        timings["copy"] = time.perf_counter() - step_start
+
+        step_start = time.perf_counter()
+        stored = store.put_many(copied) if copied else {}
+        # images mapped concurrently by uploads keep their name, and the copy to a new one is dropped
+        for name, unique_name in stored.items():
+            if unique_name != copied[name]:
+                get_storage_client().bucket(output_bucket).delete_blob(copied[name])
+                copy_image(input_bucket, name, output_bucket, unique_name)
+        mapped.update(stored)
+        timings["map"] = time.perf_counter() - step_start
+
+        step_start = time.perf_counter()
+        output_file_names = [mapped[name] for name in names if name not in failed]
+        tasks = enqueue_processing_batches(output_bucket, output_file_names, fields, executor) if output_file_names else 0
+        timings["enqueue"] = time.perf_counter() - step_start
+
+    seconds = time.perf_counter() - start
+    return {"images": len(output_file_names),
+            "newlyMapped": len(copied),
+            "failed": failed,
+            "tasks": tasks,
+            "seconds": seconds,
+            "imagesPerSecond": len(output_file_names) / seconds,
+            "timings": timings}
+
+
+def receive_images_bulk(request):
+    """
+    Ingests a backlog of images from INPUT_BUCKET (or `bucket`): every image under `prefix`, or named in the
+    `manifest` object, one name per line. Responds with the report of bulk_ingest.
+    """
+    keys = ["INPUT_BUCKET",
+            "OUTPUT_BUCKET",
+            "URL",
+            "LOCATION",
+            "QUEUE",
+            "SAE",
+            "PROJECT_ID"
+            ]
+    for key in keys:
+        assert os.environ[key]
+    payload = request.json
+    try:
+        input_bucket = payload.get("bucket", os.environ["INPUT_BUCKET"])
+        # the fields uploads are processed with, unless others are given
+        fields = {k.lower(): v for k, v in payload.get("fields", {"Total Weight": "totalWeight"}).items()}
+        if "manifest" in payload:
+            names = list_images(input_bucket, manifest=validate_message(payload, "manifest"))
+        else:
+            names = list_images(input_bucket, prefix=validate_message(payload, "prefix"))
+        report = bulk_ingest(input_bucket, names, os.environ["OUTPUT_BUCKET"], fields)
+        return json.dumps(report), 200, [("Content-Type", "application/json")]
+    except Exception as e:
+        return str(e), 400, []
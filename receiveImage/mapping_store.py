@@ -0,0 +1,228 @@
+"""
+The mapping between the names images are uploaded under and the unique names they are stored under in gpr_images.
+
+The mapping is split over MAPPING_SHARDS (default 256) JSON objects in MAPPING_BUCKET (default gpr_auxiliary), by a
+hash of the key, so a lookup or update reads and writes one shard of 1/MAPPING_SHARDS of the history rather than the
+whole of it. Each mapping is kept in both directions:
+- `{MAPPING_PREFIX}/original/{shard}.json`: original name -> unique name
+- `{MAPPING_PREFIX}/unique/{shard}.json`: unique name without its extension -> {"image": unique name, "original": name}
+
+Shards are written conditionally on the generation that was read (0 if the shard does not exist yet), so concurrent
+uploads never overwrite each other's entries: on a conflict the shard is read again and the update retried, up to
+MAPPING_RETRIES (default 10) times. Mappings are never changed once written, so the entries found are kept in an
+in-process LRU cache of MAPPING_CACHE_SIZE (default 4096) entries, and the last generation read of each shard is kept
+so most writes need no read.
+
+`python mapping_store.py compact` is the compaction job: it folds the old single mapping.json into the shards,
+repairs reverse entries missing after an interrupted write, and with --shards rewrites every entry at a new shard
+count under --prefix, for when shards have grown too large. Point MAPPING_PREFIX and MAPPING_SHARDS at the new
+shards once it has finished.
+
+receiveImage and databaseUpload are deployed separately, so each has its own copy of this module.
+"""
+import argparse
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+ORIGINAL = "original"
+UNIQUE = "unique"
+
+
+class MappingConflictException(Exception):
+    pass
+
+
+def unique_stem(unique_name: str) -> str:
+    return unique_name.split(".", 1)[0]
+
+
+class MappingStore:
+    def __init__(self, bucket, prefix: str = "mapping", shards: int = 256, cache_size: int = 4096, retries: int = 10):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.shards = shards
+        self.cache_size = cache_size
+        self.retries = retries
+        self.entries = OrderedDict()
+        # shard blob name -> (entries, generation) as last read or written by this process
+        self.shard_cache = {}
+        self._lock = threading.Lock()
+
+    def shard_name(self, direction: str, key: str) -> str:
+        shard = int(hashlib.sha256(key.encode("utf-8")).hexdigest()[:8], 16) % self.shards
+        return f"{self.prefix}/{direction}/{shard:04d}.json"
+
+    def _remember(self, direction: str, key: str, value):
+        with self._lock:
+            self.entries[(direction, key)] = value
+            self.entries.move_to_end((direction, key))
+            while len(self.entries) > self.cache_size:
+                self.entries.popitem(last=False)
+
+    def _cached(self, direction: str, key: str):
+        with self._lock:
+            if (direction, key) in self.entries:
+                self.entries.move_to_end((direction, key))
+                return self.entries[(direction, key)]
+        return None
+
+    def read_shard(self, shard_name: str) -> tuple:
+        """The entries of shard_name and the generation they were read at, 0 if it does not exist."""
+        blob = self.bucket.get_blob(shard_name)
+        if blob is None:
+            entries, generation = {}, 0
+        else:
+            entries = json.loads(blob.download_as_bytes(if_generation_match=blob.generation))
+            generation = blob.generation
+        with self._lock:
+            self.shard_cache[shard_name] = (entries, generation)
+        return entries, generation
+
+    def _get(self, direction: str, key: str):
+        value = self._cached(direction, key)
+        if value is None:
+            value = self.read_shard(self.shard_name(direction, key))[0].get(key)
+            if value is not None:
+                self._remember(direction, key, value)
+        return value
+
+    def unique_name(self, original_name: str) -> str:
+        """The unique name original_name is stored under, or None."""
+        return self._get(ORIGINAL, original_name)
+
+    def unique_names(self, original_names: list) -> dict:
+        """The unique name of each of original_names, or None, reading each shard needed at most once."""
+        found = {name: self._cached(ORIGINAL, name) for name in original_names}
+        missing = {name: None for name, unique in found.items() if unique is None}
+        for shard_name, shard_entries in self._by_shard(ORIGINAL, missing).items():
+            entries = self.read_shard(shard_name)[0]
+            for name in shard_entries:
+                found[name] = entries.get(name)
+                if found[name] is not None:
+                    self._remember(ORIGINAL, name, found[name])
+        return found
+
+    def original_name(self, unique_name: str) -> str:
+        """The name the image stored as unique_name, with or without its extension, was uploaded as, or None."""
+        entry = self._get(UNIQUE, unique_stem(unique_name))
+        return None if entry is None else entry["original"]
+
+    def image_name(self, unique_name: str) -> str:
+        """The full name, with its extension, of the image stored as unique_name, or None."""
+        entry = self._get(UNIQUE, unique_stem(unique_name))
+        return None if entry is None else entry["image"]
+
+    def update_shard(self, shard_name: str, new_entries: dict) -> dict:
+        """
+        Adds those of new_entries whose keys are not in shard_name yet, with a conditional write retried on conflict.
+        Returns the shard's entry for every key of new_entries, which is the existing one for keys already present.
+        """
+        from google.api_core.exceptions import PreconditionFailed
+
+        with self._lock:
+            cached = self.shard_cache.get(shard_name)
+        for attempt in range(self.retries):
+            # the first attempt trusts the last generation seen; a conflict means it was stale
+            entries, generation = cached if cached is not None and attempt == 0 else self.read_shard(shard_name)
+            missing = {k: v for k, v in new_entries.items() if k not in entries}
+            if not missing:
+                return {k: entries[k] for k in new_entries}
+            entries = dict(entries, **missing)
+            blob = self.bucket.blob(shard_name)
+            try:
+                blob.upload_from_string(json.dumps(entries), content_type="application/json",
+                                        if_generation_match=generation)
+            except PreconditionFailed:
+                continue
+            with self._lock:
+                self.shard_cache[shard_name] = (entries, blob.generation)
+            return {k: entries[k] for k in new_entries}
+        raise MappingConflictException("Could not update {} in {} attempts".format(shard_name, self.retries))
+
+    def put_many(self, mappings: dict) -> dict:
+        """
+        Records original name -> unique name for every item of mappings whose original name is not mapped yet, one
+        write per shard. Returns the unique name each original name is mapped to, which is the existing one for names
+        mapped before, possibly concurrently by another instance.
+        """
+        stored = {}
+        for shard_name, shard_entries in self._by_shard(ORIGINAL, mappings).items():
+            stored.update(self.update_shard(shard_name, shard_entries))
+        reverse = {unique_stem(unique): {"image": unique, "original": original}
+                   for original, unique in mappings.items() if stored[original] == unique}
+        for shard_name, shard_entries in self._by_shard(UNIQUE, reverse).items():
+            self.update_shard(shard_name, shard_entries)
+        for original, unique in stored.items():
+            self._remember(ORIGINAL, original, unique)
+        for stem, entry in reverse.items():
+            self._remember(UNIQUE, stem, entry)
+        return stored
+
+    def put(self, original_name: str, unique_name: str) -> str:
+        """Records original_name -> unique_name unless original_name is mapped already. Returns its unique name."""
+        return self.put_many({original_name: unique_name})[original_name]
+
+    def _by_shard(self, direction: str, entries: dict) -> dict:
+        shards = {}
+        for key, value in entries.items():
+            shards.setdefault(self.shard_name(direction, key), {})[key] = value
+        return shards
+
+    def all_mappings(self) -> dict:
+        """Every original name -> unique name, read shard by shard."""
+        mappings = {}
+        for shard in range(self.shards):
+            mappings.update(self.read_shard(f"{self.prefix}/{ORIGINAL}/{shard:04d}.json")[0])
+        return mappings
+
+
+def mapping_store_from_env(storage_client) -> MappingStore:
+    return MappingStore(storage_client.bucket(os.environ.get("MAPPING_BUCKET", "gpr_auxiliary")),
+                        prefix=os.environ.get("MAPPING_PREFIX", "mapping"),
+                        shards=int(os.environ.get("MAPPING_SHARDS", "256")),
+                        cache_size=int(os.environ.get("MAPPING_CACHE_SIZE", "4096")),
+                        retries=int(os.environ.get("MAPPING_RETRIES", "10")))
+
+
+def compact(source: MappingStore, target: MappingStore = None, legacy_blob=None) -> dict:
+    """
+    Folds the legacy mapping.json blob, if given, and every entry of source into target (source itself by default),
+    which rebuilds every reverse entry. Entries already in target are kept, so the job can be re-run safely.
+    """
+    target = source if target is None else target
+    mappings = {}
+    if legacy_blob is not None and legacy_blob.exists():
+        mappings.update(json.loads(legacy_blob.download_as_bytes()))
+    mappings.update(source.all_mappings())
+    stored = target.put_many(mappings)
+    # reverse entries of names mapped before, and missed when their writer was interrupted
+    reverse = {unique_stem(unique): {"image": unique, "original": original} for original, unique in stored.items()}
+    for shard_name, shard_entries in target._by_shard(UNIQUE, reverse).items():
+        target.update_shard(shard_name, shard_entries)
+    return {"mappings": len(stored), "conflicts": sum(mappings[k] != v for k, v in stored.items())}
+
+
+def main_cli(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["compact"])
+    parser.add_argument("--legacy", default="mapping.json", help="the single mapping file to fold in, if it exists")
+    parser.add_argument("--prefix", help="write the shards under this prefix instead of MAPPING_PREFIX")
+    parser.add_argument("--shards", type=int, help="the shard count under --prefix")
+    args = parser.parse_args(argv)
+
+    from google.cloud import storage
+
+    source = mapping_store_from_env(storage.Client())
+    target = None
+    if args.prefix or args.shards:
+        target = MappingStore(source.bucket, prefix=args.prefix or source.prefix, shards=args.shards or source.shards)
+        if target.prefix == source.prefix and target.shards != source.shards:
+            parser.error("re-sharding needs a new --prefix")
+    print(json.dumps(compact(source, target, source.bucket.blob(args.legacy) if args.legacy else None)))
+
+
+if __name__ == "__main__":
+    main_cli()
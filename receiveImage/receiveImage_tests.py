@@ -4,16 +4,102 @@ from unittest.mock import patch
 from unittest import TestCase
 
 import os
+import statistics
 import sys
 import json
+import threading
+import time
+from types import SimpleNamespace
+
+from google.api_core.exceptions import PreconditionFailed
 
 GOOGLE_MOCK = Mock()
 sys.modules['google.cloud'] = GOOGLE_MOCK
 
 import main
+import mapping_store
 
 STOCLIENT_MOCK = Mock()
 
+
+class FakeObjectBucket:
+    """Objects held as name -> (data, generation), with generation preconditions enforced as Cloud Storage does."""
+    def __init__(self, objects=None):
+        self.objects = {} if objects is None else objects
+        self.lock = threading.Lock()
+        self.reads = 0
+
+    def get_blob(self, name):
+        self.reads += 1
+        return FakeObjectBlob(self, name) if name in self.objects else None
+
+    def blob(self, name):
+        return FakeObjectBlob(self, name)
+
+
+class FakeObjectBlob:
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.generation = bucket.objects[name][1] if name in bucket.objects else None
+
+    def exists(self):
+        return self.name in self.bucket.objects
+
+    def download_as_bytes(self, if_generation_match=None):
+        data, generation = self.bucket.objects[self.name]
+        if if_generation_match is not None and if_generation_match != generation:
+            raise PreconditionFailed("conditionNotMet")
+        return data
+
+    def upload_from_string(self, data, content_type=None, if_generation_match=None):
+        with self.bucket.lock:
+            generation = self.bucket.objects[self.name][1] if self.name in self.bucket.objects else 0
+            if if_generation_match is not None and if_generation_match != generation:
+                raise PreconditionFailed("conditionNotMet")
+            self.bucket.objects[self.name] = (data.encode("utf-8") if isinstance(data, str) else data, generation + 1)
+            self.generation = generation + 1
+
+
+class FakeBucket:
+    """A bucket holding names, whose copies honour if_generation_match=0 as Cloud Storage does."""
+    def __init__(self, names=(), copy_seconds=0.0):
+        self.names = set(names)
+        self.copies = 0
+        self.copy_seconds = copy_seconds
+        self.lock = threading.Lock()
+        # the text of any object downloaded, such as a manifest
+        self.text = ""
+
+    def blob(self, name):
+        return SimpleNamespace(name=name, bucket=self, download_as_text=lambda: self.text)
+
+    def copy_blob(self, blob, destination_bucket, new_name=None, if_generation_match=None):
+        time.sleep(self.copy_seconds)
+        with self.lock:
+            self.copies += 1
+            if blob.name not in blob.bucket.names:
+                raise FileNotFoundError(f"No such object: {blob.name}")
+            if if_generation_match == 0 and new_name in destination_bucket.names:
+                raise PreconditionFailed("At least one of the pre-conditions you specified did not hold.")
+            destination_bucket.names.add(new_name)
+
+    def delete_blob(self, name):
+        self.names.remove(name)
+
+
+class FakeStorageClient:
+    def __init__(self, output_names=(), input_names=("file.jpg",), copy_seconds=0.0):
+        self.buckets = {"input": FakeBucket(input_names), "gpr_images": FakeBucket(output_names, copy_seconds)}
+
+    def bucket(self, name):
+        return self.buckets[name]
+
+    def list_blobs(self, bucket, prefix=None):
+        if bucket != "input":
+            raise AssertionError("allocating a name should not list the bucket")
+        return [SimpleNamespace(name=name) for name in sorted(self.buckets[bucket].names) if name.startswith(prefix)]
+
 @patch.dict(os.environ, {
     "PROJECT_ID":"id", 
     "INPUT_BUCKET":"input",
@@ -27,12 +113,15 @@ class TestImageReceipt(TestCase):
 
     def setUp(self, *args):
         # mock cloud storage functionality
-        STOCLIENT_MOCK.get_bucket.return_value = STOCLIENT_MOCK
-        STOCLIENT_MOCK.get_blob.return_value = STOCLIENT_MOCK
+        STOCLIENT_MOCK.bucket.return_value = STOCLIENT_MOCK
         # mapping from input filename to unique filename
-        STOCLIENT_MOCK.download_as_string.return_value = json.dumps({})
-        # file names currently in the image bucket
-        STOCLIENT_MOCK.list_blobs.return_value = []
+        self.mapping = mapping_store.MappingStore(FakeObjectBucket(), shards=4)
+        patcher = patch("main.MAPPING_STORE", self.mapping)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # copies succeed unless a test makes the destination name taken
+        STOCLIENT_MOCK.copy_blob.side_effect = None
+        STOCLIENT_MOCK.reset_mock()
 
         # set up a way to read the HTTP message generated by the receiveImage routine
         self.return_message = ""
@@ -61,8 +150,7 @@ class TestImageReceipt(TestCase):
 
 
     def test_edgeCase_filenameInMapping(self, *args):
-        STOCLIENT_MOCK.download_as_string.return_value = json.dumps({"file.jpg":"unique_name.jpg"})
-        STOCLIENT_MOCK.list_blobs.return_value = ["unique_name.jpg"]
+        self.mapping.put("file.jpg", "unique_name.jpg")
         st, num, l = main.receive_image(self.request, None)
         self.assertEqual(st, "Ok")
         self.assertEqual(num, 204)
@@ -72,11 +160,158 @@ class TestImageReceipt(TestCase):
     # patch the uuid module to guarantee that the first ID generated is not unique
     @patch("uuid.uuid4", side_effect = ["nonunique", "unique"])
     def test_edgeCase_nonUniqueFilenameGenerated(self, *args):
-        STOCLIENT_MOCK.list_blobs.return_value = ["nonunique.jpg"]
+        # the copy to the taken name fails its generation precondition
+        STOCLIENT_MOCK.copy_blob.side_effect = [PreconditionFailed("nonunique.jpg exists"), None]
         st, num, l = main.receive_image(self.request, None)
         self.assertEqual(st, "Ok")
         self.assertEqual(num, 204)
-        self.assertEqual(self.return_message["name"], "unique.jpg") 
+        self.assertEqual(self.return_message["name"], "unique.jpg")
+        self.assertEqual([c.kwargs["new_name"] for c in STOCLIENT_MOCK.copy_blob.call_args_list], ["nonunique.jpg", "unique.jpg"])
+        self.assertTrue(all(c.kwargs["if_generation_match"] == 0 for c in STOCLIENT_MOCK.copy_blob.call_args_list))
+        STOCLIENT_MOCK.list_blobs.assert_not_called()
+        self.assertEqual(self.mapping.unique_name("file.jpg"), "unique.jpg")
+        self.assertEqual(self.mapping.original_name("unique"), "file.jpg")
+
+
+    @patch.dict(os.environ, {"UNIQUE_NAME_ATTEMPTS":"2"})
+    @patch("uuid.uuid4", side_effect = ["taken", "taken"])
+    def test_failureCase_noUniqueFilename(self, *args):
+        storage = FakeStorageClient(["taken.jpg"])
+        with patch("main.STORAGE_CLIENT", storage):
+            self.assertRaises(main.UniqueNameException, main.copy_to_unique_name, "input", "file.jpg", "gpr_images")
+        self.assertEqual(storage.buckets["gpr_images"].copies, 2)
+
+
+    def test_edgeCase_uniqueFilenameFlatLatency(self, *args):
+        # allocating a name costs one copy whether the bucket holds a hundred images or a million
+        medians = {}
+        for n_objects in [100, 1000000]:
+            storage = FakeStorageClient(f"{i:08d}.jpg" for i in range(n_objects))
+            timings = []
+            with patch("main.STORAGE_CLIENT", storage):
+                for _ in range(50):
+                    start = time.perf_counter()
+                    main.copy_to_unique_name("input", "file.jpg", "gpr_images")
+                    timings.append(time.perf_counter() - start)
+            self.assertEqual(storage.buckets["gpr_images"].copies, 50)
+            medians[n_objects] = statistics.median(timings)
+        self.assertLess(medians[1000000], 10 * medians[100] + 0.001)
+
+
+    @patch("uuid.uuid4", side_effect = ["first", "second"])
+    def test_edgeCase_filenameMappedConcurrently(self, *args):
+        # another upload maps the file between the lookup and this upload's write
+        other = mapping_store.MappingStore(self.mapping.bucket, shards=4)
+        unique_name = self.mapping.unique_name
+        def lookup_then_race(name):
+            found = unique_name(name)
+            other.put(name, "other.jpg")
+            return found
+        with patch.object(self.mapping, "unique_name", side_effect=lookup_then_race):
+            st, num, l = main.receive_image(self.request, None)
+        self.assertEqual(num, 204)
+        self.assertEqual(self.return_message["name"], "other.jpg")
+        STOCLIENT_MOCK.delete_blob.assert_called_once_with("first.jpg")
+
+
+    def test_edgeCase_mappingStoreConcurrentWrites(self, *args):
+        bucket = FakeObjectBucket()
+        stores = [mapping_store.MappingStore(bucket, shards=2) for _ in range(4)]
+        def upload(i):
+            for j in range(25):
+                stores[i].put(f"site{i}/{j}.jpg", f"{i:02d}{j:04d}.jpg")
+        threads = [threading.Thread(target=upload, args=(i,)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # no instance overwrote another's entries, and every name reads back both ways from a fresh instance
+        reader = mapping_store.MappingStore(bucket, shards=2)
+        self.assertEqual(len(reader.all_mappings()), 100)
+        self.assertEqual(reader.unique_name("site3/7.jpg"), "030007.jpg")
+        self.assertEqual(reader.original_name("030007.jpg"), "site3/7.jpg")
+        self.assertEqual(reader.image_name("030007"), "030007.jpg")
+        # a name mapped already keeps its unique name
+        self.assertEqual(reader.put("site3/7.jpg", "new.jpg"), "030007.jpg")
+
+
+    def test_edgeCase_mappingStoreCache(self, *args):
+        bucket = FakeObjectBucket()
+        store = mapping_store.MappingStore(bucket, shards=4, cache_size=2)
+        store.put("a.jpg", "1.jpg")
+        store.put("b.jpg", "2.jpg")
+        store.put("c.jpg", "3.jpg")
+        reads = bucket.reads
+        self.assertEqual(store.unique_name("c.jpg"), "3.jpg")
+        self.assertEqual(bucket.reads, reads)
+        # a.jpg was evicted from the cache of two entries, and names not mapped are always read
+        self.assertEqual(store.unique_name("a.jpg"), "1.jpg")
+        self.assertIsNone(store.unique_name("d.jpg"))
+        self.assertEqual(bucket.reads, reads + 2)
+
+
+    def test_edgeCase_mappingStoreCompaction(self, *args):
+        bucket = FakeObjectBucket({"mapping.json": (json.dumps({"old.jpg": "0001.jpg", "a.jpg": "legacy.jpg"}).encode("utf-8"), 1)})
+        store = mapping_store.MappingStore(bucket, shards=2)
+        store.put("a.jpg", "1.jpg")
+        store.put("b.png", "2.png")
+        # the reverse entry of b.png was lost when its writer was interrupted
+        del bucket.objects[store.shard_name(mapping_store.UNIQUE, "2")]
+
+        resharded = mapping_store.MappingStore(bucket, prefix="mapping-v2", shards=8)
+        report = mapping_store.compact(store, resharded, bucket.blob("mapping.json"))
+        self.assertEqual(report, {"mappings": 3, "conflicts": 0})
+        self.assertEqual(resharded.all_mappings(), {"old.jpg": "0001.jpg", "a.jpg": "1.jpg", "b.png": "2.png"})
+        self.assertEqual(resharded.original_name("2.png"), "b.png")
+
+        report = mapping_store.compact(store, legacy_blob=bucket.blob("mapping.json"))
+        self.assertEqual(report["conflicts"], 0)
+        self.assertEqual(store.image_name("2"), "2.png")
+        self.assertEqual(store.unique_name("old.jpg"), "0001.jpg")
+
+
+    @patch.dict(os.environ, {"BULK_COPY_WORKERS":"16", "OUTPUT_BUCKET":"gpr_images"})
+    @patch("main.create_processing_task")
+    def test_edgeCase_bulkIngest(self, task_mock, *args):
+        input_names = [f"site/{i:03d}.jpg" for i in range(200)] + ["site/notes.txt", "other/000.jpg"]
+        storage = FakeStorageClient(input_names=input_names, copy_seconds=0.002)
+        self.mapping.put("site/000.jpg", "mapped.jpg")
+        with patch("main.STORAGE_CLIENT", storage), patch.object(self.mapping.bucket, "get_blob", wraps=self.mapping.bucket.get_blob) as reads:
+            st, num, l = main.receive_images_bulk(Mock(json={"prefix": "site/"}))
+        report = json.loads(st)
+
+        self.assertEqual(num, 200)
+        self.assertEqual((report["images"], report["newlyMapped"], report["failed"], report["tasks"]), (200, 199, {}, 200))
+        self.assertEqual(len(storage.buckets["gpr_images"].names), 200)
+        self.assertIn("mapped.jpg", storage.buckets["gpr_images"].names)
+        mappings = self.mapping.all_mappings()
+        self.assertEqual(len(mappings), 200)
+        self.assertEqual(self.mapping.original_name(mappings["site/123.jpg"]), "site/123.jpg")
+        # each of the four shards is read once for the lookups and once before its first write, whatever the image count
+        self.assertLessEqual(reads.call_count, 4 * 2 * 2)
+        self.assertEqual(sorted(c.args[1]["name"] for c in task_mock.call_args_list), sorted(mappings.values()))
+        # 200 copies of 2ms on 16 threads take well under the 400ms they would one by one
+        self.assertLess(report["timings"]["copy"], 0.2)
+        self.assertGreater(report["imagesPerSecond"], 0)
+
+
+    @patch.dict(os.environ, {"BATCH_URL":"batchUrl", "BULK_TASK_SIZE":"50", "OUTPUT_BUCKET":"gpr_images"})
+    @patch("main.create_processing_task")
+    def test_edgeCase_bulkIngestManifest(self, task_mock, *args):
+        storage = FakeStorageClient(input_names=[f"{i:03d}.png" for i in range(120)])
+        storage.buckets["input"].text = "\n".join([f"{i:03d}.png" for i in range(120)] + ["missing.jpg", "notes.txt", ""])
+        with patch("main.STORAGE_CLIENT", storage):
+            st, num, l = main.receive_images_bulk(Mock(json={"manifest": "manifest.txt"}))
+        report = json.loads(st)
+
+        self.assertEqual(num, 200)
+        self.assertEqual(report["images"], 120)
+        self.assertEqual(report["failed"], {"missing.jpg": "No such object: missing.jpg"})
+        self.assertEqual(report["tasks"], 3)
+        self.assertEqual([len(c.args[1]["names"]) for c in task_mock.call_args_list], [50, 50, 20])
+        self.assertTrue(all(c.args[0] == "batchUrl" for c in task_mock.call_args_list))
+        self.assertEqual(main.receive_images_bulk(Mock(json={}))[1], 400)
 
 
     def test_failureCase_unsupportedFileFormat(self, *args):
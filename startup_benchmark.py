@@ -0,0 +1,120 @@
+"""
+Measures the cold-start cost of every Cloud Function entry point.
+
+Each entry point is started in a fresh interpreter, which records how long `import main` takes, how long a malformed
+request takes to be rejected, and how long each of the `get_*_client()` accessors takes on its first call. Clients are
+created lazily, so the rejected request isolates the fixed per-instance cost. The accessor cost is reported as
+`client accessors`, in total and for each accessor below the table. It is a lower bound on what the first valid
+request adds, not a first-request time: no valid request is sent, so its own work is not measured.
+
+Usage: python startup_benchmark.py [--runs N] [--mock-google]
+
+Use --mock-google to stub out google.cloud and grpc the way the unit tests do, when the client libraries are not
+installed. The client timings then only measure the accessors themselves. Without it, they include creating the real
+clients, and connecting those that connect eagerly, so they need credentials.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# (package directory, entry point, trigger type, environment variables not listed in env.yaml)
+ENTRY_POINTS = [
+    ("receiveImage", "receive_image", "storage", {}),
+    ("processImage", "process_image", "http", {}),
+    ("processExtractedData", "process_extracted_data", "http", {}),
+    ("extractValue/totalWeight", "extract_total_weight", "http", {}),
+    ("extractValue/fieldValue", "extract_field_value", "http", {}),
+    ("databaseUpload", "database_upload", "storage",
+     {"PROJECT_ID": "id", "IMAGE_BUCKET": "gpr_images", "DATABASE_URL": "http://localhost"}),
+]
+
+CHILD = """
+import inspect, json, os, re, sys, time
+from unittest.mock import Mock
+if {mock_google}:
+    sys.modules['google.cloud'] = Mock()
+    sys.modules['grpc'] = Mock()
+sys.path.insert(0, os.getcwd())
+start = time.perf_counter()
+import main
+imported = time.perf_counter()
+entry_point = getattr(main, {entry_point!r})
+try:
+    if {trigger!r} == "http":
+        entry_point(Mock(json={{}}))
+    else:
+        entry_point({{}}, None)
+except Exception:
+    pass
+rejected = time.perf_counter()
+clients = {{}}
+for name in sorted(name for name in dir(main) if re.fullmatch(r"get_\\w+_client", name)):
+    accessor = getattr(main, name)
+    # the Document AI client is created per endpoint
+    args = [os.environ.get("LOCATION_SHORT", "eu")] if inspect.signature(accessor).parameters else []
+    client_start = time.perf_counter()
+    try:
+        accessor(*args)
+        clients[name] = time.perf_counter() - client_start
+    except Exception as e:
+        clients[name] = "failed: {{}}".format(e)
+print(json.dumps({{"import": imported - start, "rejectedRequest": rejected - imported, "clients": clients}}))
+"""
+
+
+def read_env(package_dir: str) -> dict:
+    env = {}
+    path = os.path.join(ROOT, package_dir, "env.yaml")
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                if ":" in line:
+                    key, value = line.split(":", 1)
+                    env[key.strip()] = value.strip().strip('"')
+    return env
+
+
+def measure(package_dir: str, entry_point: str, trigger: str, extra_env: dict, mock_google: bool) -> dict:
+    env = dict(os.environ)
+    env.update(read_env(package_dir))
+    env.update(extra_env)
+    code = CHILD.format(mock_google=mock_google, entry_point=entry_point, trigger=trigger)
+    result = subprocess.run([sys.executable, "-c", code], cwd=os.path.join(ROOT, package_dir), env=env,
+                            capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1])
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--mock-google", action="store_true")
+    args = parser.parse_args()
+
+    print(f"{'entry point':<50}{'import (ms)':>14}{'rejected request (ms)':>23}{'client accessors (ms)':>23}")
+    for package_dir, entry_point, trigger, extra_env in ENTRY_POINTS:
+        try:
+            runs = [measure(package_dir, entry_point, trigger, extra_env, args.mock_google) for _ in range(args.runs)]
+        except RuntimeError as e:
+            print(f"{package_dir + '.' + entry_point:<50}  failed: {e}")
+            continue
+        import_ms = statistics.median(run["import"] for run in runs) * 1000
+        request_ms = statistics.median(run["rejectedRequest"] for run in runs) * 1000
+        clients_ms = {}
+        for name, seconds in runs[0]["clients"].items():
+            timings = [run["clients"][name] for run in runs]
+            clients_ms[name] = statistics.median(timings) * 1000 if all(isinstance(t, float) for t in timings) \
+                else next(t for t in timings if isinstance(t, str))
+        total_ms = sum(ms for ms in clients_ms.values() if isinstance(ms, float))
+        print(f"{package_dir + '.' + entry_point:<50}{import_ms:>14.1f}{request_ms:>23.1f}{total_ms:>23.1f}")
+        for name, ms in clients_ms.items():
+            print(f"  {name + '()':<48}{ms:>60.1f}" if isinstance(ms, float) else f"  {name + '()':<48}  {ms}")
+
+if __name__ == "__main__":
+    main()